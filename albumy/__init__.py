@@ -6,14 +6,20 @@ from flask import Flask, render_template
 from flask_login import current_user
 from flask_wtf.csrf import CSRFError
 
+from albumy.autocomplete import init_autocomplete
 from albumy.blueprints.admin import admin_bp
 from albumy.blueprints.ajax import ajax_bp
 from albumy.blueprints.auth import auth_bp
 from albumy.blueprints.main import main_bp
 from albumy.blueprints.user import user_bp
+from albumy.emails import send_outbox
+from albumy.indexing import reindex as reindex_search, apply_search_changes
 from albumy.extensions import bootstrap, db, mail, moment, dropzone, avatars, csrf, login_manager, migrate, whooshee
-from albumy.models import User, Photo, Tag, Comment, Role, Notification
+from albumy.models import User, Photo, Tag, Comment, Role, Timeline, TagPopularity, PendingDelete
+from albumy.search import rebuild_fts
 from albumy.settings import config
+from albumy.storage import migrate_to_shards, collect_garbage
+from albumy.worker import run_worker
 
 
 def create_app(config_name=None):
@@ -45,6 +51,7 @@ def register_extensions(app):
     csrf.init_app(app)
     migrate.init_app(app, db)
     whooshee.init_app(app)
+    init_autocomplete(app)
 
 
 def register_blueprints(app):
@@ -66,7 +73,7 @@ def register_template_context(app):
     @app.context_processor
     def make_template_context():
         if current_user.is_authenticated:
-            notification_count = Notification.query.with_parent(current_user).filter_by(is_read=False).count()
+            notification_count = current_user.unread_notification_count
         else:
             notification_count = None
         return dict(notification_count=notification_count)
@@ -151,4 +158,91 @@ def register_commands(app):
         fake_collect(collect)
         click.echo('Generating %d comments...' % comment)
         fake_comment(comment)
+        click.echo('Building the timelines...')
+        Timeline.rebuild()
+        click.echo('Building the tag popularity...')
+        TagPopularity.rebuild()
         click.echo('Done.')
+
+    @app.cli.command()
+    def rebuild_timeline():
+        """Rebuild the home timelines from follows and photos."""
+        click.echo('Rebuilding the timelines...')
+        Timeline.rebuild()
+        click.echo('Done.')
+
+    @app.cli.command()
+    def rebuild_tag_popularity():
+        """Recompute the photo counts and hot scores of tags."""
+        click.echo('Rebuilding the tag popularity...')
+        TagPopularity.rebuild()
+        click.echo('Done.')
+
+    @app.cli.command()
+    def reconcile_counters():
+        """Recompute the denormalized counters to fix drift."""
+        click.echo('Reconciling the photo counters...')
+        drifted = Photo.reconcile_counters()
+        click.echo('Fixed %d photos.' % drifted)
+        click.echo('Reconciling the unread notification counters...')
+        drifted = User.reconcile_unread_notification_count()
+        click.echo('Fixed %d users.' % drifted)
+
+    @app.cli.command()
+    @click.option('--batch', default=500, help='Quantity of rows moved per transaction, default is 500.')
+    def shard_uploads(batch):
+        """Move existing uploads into the hashed directory layout."""
+        click.echo('Moving the uploaded files...')
+        updated = migrate_to_shards(batch)
+        click.echo('Updated %d rows.' % updated)
+
+    @app.cli.command()
+    @click.option('--min-age', default=None, type=int,
+                  help='Only remove files older than this many seconds, default is ALBUMY_GC_MIN_AGE.')
+    @click.option('--dry-run', is_flag=True, help='Only count the orphan files without removing them.')
+    def gc_uploads(min_age, dry_run):
+        """Remove the uploaded files that are no longer referenced."""
+        if min_age is None:
+            min_age = app.config['ALBUMY_GC_MIN_AGE']
+        click.echo('Sweeping the pending deletes...')
+        while PendingDelete.sweep():
+            pass
+        click.echo('Collecting the orphan files...')
+        count, size = collect_garbage(min_age, dry_run)
+        click.echo('%s %d files, %.1f MB.' % ('Found' if dry_run else 'Removed', count, size / 1024 / 1024))
+
+    @app.cli.command('albumy-worker')
+    @click.option('--workers', default=os.cpu_count() or 1, help='Quantity of worker processes, default is the CPU count.')
+    @click.option('--once', is_flag=True, help='Exit when there is no job ready.')
+    def albumy_worker(workers, once):
+        """Generate the photo thumbnails in the background."""
+        click.echo('Running the thumbnail worker with %d processes...' % workers)
+        finished = run_worker(workers, once)
+        click.echo('Finished %d jobs.' % finished)
+
+    @app.cli.command()
+    @click.option('--workers', default=os.cpu_count() or 1, help='Quantity of worker processes, default is the CPU count.')
+    @click.option('--batch', default=1000, help='Quantity of rows read and indexed per task, default is 1000.')
+    def reindex(workers, batch):
+        """Rebuild the Whoosh search indexes."""
+        click.echo('Rebuilding the search indexes with %d processes...' % workers)
+        count, seconds = reindex_search(workers, batch)
+        click.echo('Indexed %d rows in %.1f s, %.0f rows/s.' % (count, seconds, count / seconds if seconds else 0))
+        click.echo('Applying the changes made meanwhile...')
+        while apply_search_changes():
+            pass
+        click.echo('Done.')
+
+    @app.cli.command()
+    def rebuild_search_index():
+        """Rebuild the SQLite full-text search indexes."""
+        click.echo('Rebuilding the full-text search indexes...')
+        rebuild_fts()
+        click.echo('Done.')
+
+    @app.cli.command()
+    def send_mail():
+        """Send the due mails left in the outbox."""
+        click.echo('Sending the outbox...')
+        sent = send_outbox()
+        click.echo('Sent %d mails.' % sent)
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+import heapq
+import threading
+import time
+from bisect import bisect_left, insort
+
+from flask import current_app
+
+from albumy.extensions import db
+
+# 排在所有字符之后，用于确定前缀范围的上界
+_MAX_CHAR = '\U0010ffff'
+
+
+class PrefixIndex:
+    """按小写名称排序的列表，二分查找前缀对应的范围，再按分数取出前几项。
+
+    范围很大的短前缀（例如单个字母）第一次查询后缓存结果，名称变化时就地更新缓存，
+    只有删除或降低了缓存中的条目时才清除对应前缀的缓存。
+    """
+
+    def __init__(self, entries=(), cache_threshold=256, cache_size=10):
+        self.cache_threshold = cache_threshold
+        self.cache_size = cache_size
+        # 键为小写名称加原名，大小写不同的同名条目互不覆盖
+        self._entries = {self._key(name): (name, entry_id, score) for name, entry_id, score in entries}
+        self._keys = sorted(self._entries)
+        self._top = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    @staticmethod
+    def _key(name):
+        return name.lower() + '\x00' + name
+
+    @staticmethod
+    def _prefixes(key):
+        lower = key.split('\x00', 1)[0]
+        return (lower[:i] for i in range(1, len(lower) + 1))
+
+    def _update_top(self, key, score):
+        # 缓存的前几项按 (-分数, 键) 排序；新的分数能排进去时就地插入，不必重新计算整个范围
+        item = (-score, key)
+        for prefix in self._prefixes(key):
+            cached = self._top.get(prefix)
+            if cached is None:
+                continue
+            size, top = cached
+            old = next((i for i, (_, k) in enumerate(top) if k == key), None)
+            if old is not None:
+                if item > top[old] and len(top) == size:
+                    # 分数降低后，缓存之外的条目可能排到它前面
+                    del self._top[prefix]
+                    continue
+                del top[old]
+            if len(top) < size or item < top[-1]:
+                insort(top, item)
+                del top[size:]
+
+    def _discard_top(self, key):
+        for prefix in self._prefixes(key):
+            cached = self._top.get(prefix)
+            if cached is None:
+                continue
+            size, top = cached
+            if len(top) < size:
+                # 缓存包含范围内的全部条目，直接删除
+                top[:] = [item for item in top if item[1] != key]
+            elif any(k == key for _, k in top):
+                del self._top[prefix]
+
+    def add(self, name, entry_id, score=None):
+        # 不传 score 时保留已有条目的分数，重复添加同一个名称不会清零
+        key = self._key(name)
+        with self._lock:
+            if key not in self._entries:
+                insort(self._keys, key)
+            if score is None:
+                score = self._entries.get(key, (None, None, 0))[2]
+            self._entries[key] = (name, entry_id, score)
+            self._update_top(key, score)
+
+    def remove(self, name):
+        key = self._key(name)
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                del self._keys[bisect_left(self._keys, key)]
+                self._discard_top(key)
+
+    def rename(self, old_name, new_name, entry_id):
+        with self._lock:
+            score = self._entries.get(self._key(old_name), (None, None, None))[2]
+        self.remove(old_name)
+        self.add(new_name, entry_id, score)
+
+    def search(self, prefix, limit=10):
+        """Return up to ``limit`` ``(name, id)`` pairs starting with ``prefix``, ignoring case,
+        ordered by score and then by name.
+        """
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+        with self._lock:
+            keys, entries = self._keys, self._entries
+            cached = self._top.get(prefix)
+            if cached is None or cached[0] < limit:
+                lo = bisect_left(keys, prefix)
+                hi = bisect_left(keys, prefix + _MAX_CHAR, lo)
+                size = max(limit, self.cache_size)
+                # 分数相同时按字母顺序，即下标小的优先
+                top = heapq.nlargest(size, range(lo, hi), key=lambda i: (entries[keys[i]][2], -i))
+                top = [(-entries[keys[i]][2], keys[i]) for i in top]
+                if hi - lo > self.cache_threshold:
+                    self._top[prefix] = (size, top)
+            else:
+                top = cached[1]
+            return [entries[key][:2] for _, key in top[:limit]]
+
+
+def _load_tags():
+    from albumy.models import Tag, TagPopularity
+
+    return db.session.execute(db.select(Tag.name, Tag.id, db.func.coalesce(TagPopularity.photo_count, 0)).
+                              outerjoin(TagPopularity, TagPopularity.tag_id == Tag.id)).all()
+
+
+def _load_users():
+    from albumy.models import User, Follow
+
+    followers = db.select(Follow.followed_id, db.func.count().label('count')). \
+        group_by(Follow.followed_id).subquery()
+    return db.session.execute(db.select(User.username, User.id, db.func.coalesce(followers.c.count, 0)).
+                              outerjoin(followers, followers.c.followed_id == User.id)).all()
+
+
+_loaders = {'tag': _load_tags, 'user': _load_users}
+
+
+class Autocomplete:
+    """一个应用的标签和用户名前缀索引，收到第一个请求时在后台加载，加载完成前的查询等待同一次加载。
+
+    名称的增删改在提交后更新到索引，排序用的分数（图片数、粉丝数）每隔 ALBUMY_AUTOCOMPLETE_REFRESH
+    秒在后台线程中重新加载；其他进程中的修改同样在重新加载后可见。
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._indexes = {}
+        self._loaded_at = {}
+        self._refreshing = set()
+        # 加载期间提交的修改，加载完成后重放到新的索引上
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._load_locks = {kind: threading.RLock() for kind in _loaders}
+        self._warmed = False
+
+    def _load(self, kind):
+        with self._load_locks[kind]:
+            with self._lock:
+                self._pending[kind] = []
+            try:
+                index = PrefixIndex(_loaders[kind](), cache_size=self.app.config['ALBUMY_AUTOCOMPLETE_LIMIT'])
+            finally:
+                with self._lock:
+                    pending = self._pending.pop(kind)
+            with self._lock:
+                # 加载开始前已提交的修改可能已包含在结果中，重放的操作都是幂等的
+                for change in pending:
+                    self._apply(index, *change)
+                self._indexes[kind] = index
+                self._loaded_at[kind] = time.monotonic()
+                self._refreshing.discard(kind)
+        return index
+
+    def _refresh(self, kind):
+        with self.app.app_context():
+            try:
+                self._load(kind)
+            except Exception:
+                self.app.logger.exception('Failed to reload the %s autocomplete index.', kind)
+                with self._lock:
+                    self._refreshing.discard(kind)
+
+    def warm(self):
+        """Load the indexes in a background thread, once."""
+        with self._lock:
+            if self._warmed:
+                return
+            self._warmed = True
+        threading.Thread(target=self._warm, name='autocomplete-warm', daemon=True).start()
+
+    def _warm(self):
+        with self.app.app_context():
+            for kind in _loaders:
+                try:
+                    self.index(kind)
+                except Exception:
+                    self.app.logger.exception('Failed to load the %s autocomplete index.', kind)
+
+    def index(self, kind):
+        with self._lock:
+            index = self._indexes.get(kind)
+            expired = index is not None and kind not in self._refreshing and \
+                time.monotonic() - self._loaded_at[kind] > self.app.config['ALBUMY_AUTOCOMPLETE_REFRESH']
+            if expired:
+                self._refreshing.add(kind)
+        if index is None:
+            with self._load_locks[kind]:
+                # 等待期间可能已经由其他线程加载完成
+                index = self._indexes.get(kind)
+                if index is None:
+                    index = self._load(kind)
+            return index
+        if expired:
+            # 重新加载期间继续使用旧的索引
+            threading.Thread(target=self._refresh, args=(kind,), name='autocomplete-refresh', daemon=True).start()
+        return index
+
+    @staticmethod
+    def _apply(index, entry_id, old_name, new_name):
+        if old_name is None:
+            index.add(new_name, entry_id)
+        elif new_name is None:
+            index.remove(old_name)
+        else:
+            index.rename(old_name, new_name, entry_id)
+
+    def apply(self, changes):
+        """Apply ``(kind, id, old_name, new_name)`` changes to the indexes that are loaded, and
+        record them for the indexes being loaded.
+        """
+        for kind, entry_id, old_name, new_name in changes:
+            with self._lock:
+                index = self._indexes.get(kind)
+                if kind in self._pending:
+                    self._pending[kind].append((entry_id, old_name, new_name))
+            if index is not None:
+                self._apply(index, entry_id, old_name, new_name)
+
+
+def init_autocomplete(app):
+    # 启动时数据库可能还没有建表（例如运行迁移命令），所以在收到第一个请求时才开始加载
+    if not app.config['ALBUMY_AUTOCOMPLETE_WARM']:
+        return
+
+    @app.before_request
+    def warm_autocomplete():
+        get_autocomplete(app).warm()
+
+
+def get_autocomplete(app=None):
+    app = app or current_app._get_current_object()
+    autocomplete = app.extensions.get('albumy_autocomplete')
+    if autocomplete is None:
+        autocomplete = app.extensions.setdefault('albumy_autocomplete', Autocomplete(app))
+    return autocomplete
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import threading
+
+
+class BackgroundThread:
+    """按需启动的后台线程：提交后调用 wake() 唤醒，空闲时每隔 interval() 秒也执行一次 work()。
+
+    stop() 让线程在当前这一轮结束后退出并等待它结束，下次 wake() 时重新启动。
+    """
+
+    name = 'background'
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = None
+
+    def interval(self, app):
+        raise NotImplementedError
+
+    def work(self, app, woken):
+        """Do one round of work in an app context; ``woken`` is False when the interval elapsed."""
+        raise NotImplementedError
+
+    def wake(self, app):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(app, self._stop), name=self.name,
+                                                daemon=True)
+                self._thread.start()
+        self._event.set()
+
+    def sleep(self, seconds):
+        """Wait ``seconds`` and return False if the thread was stopped meanwhile."""
+        return not self._stop.wait(seconds)
+
+    def stop(self, timeout=None):
+        with self._lock:
+            thread, stop, self._thread = self._thread, self._stop, None
+        if thread is None:
+            return
+        stop.set()
+        self._event.set()
+        thread.join(timeout)
+
+    def _run(self, app, stop):
+        while not stop.is_set():
+            woken = self._event.wait(timeout=self.interval(app))
+            self._event.clear()
+            if stop.is_set():
+                break
+            with app.app_context():
+                try:
+                    self.work(app, woken)
+                except Exception:
+                    app.logger.exception('The %s thread failed.', self.name)
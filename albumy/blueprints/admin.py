@@ -1,11 +1,15 @@
 # -*- codeing = utf-8 -*-
-from flask import Blueprint, flash, render_template, request, current_app
+from flask import Blueprint, flash, render_template, request, current_app, jsonify, abort
 from flask_login import current_user, login_required
 
 from albumy.extensions import db
 from albumy.forms.admin import EditProfileAdminForm
 from albumy.models import User, Role, Tag, Comment, Photo
 from albumy.decorators import permission_required, admin_required
+from albumy.moderation import set_users_locked, set_users_active, unflag, delete_photos, delete_comments, \
+    delete_tags
+from albumy.pagination import keyset_paginate
+from albumy.statistics import get_statistics
 from albumy.utils import redirect_back
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
@@ -15,18 +19,15 @@ admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 @login_required
 @permission_required('MODERATE')
 def index():
-    user_count = User.query.count()
-    locked_user_count = User.query.filter_by(locked=True).count()
-    blocked_user_count = User.query.filter_by(active=False).count()
-    photo_count = Photo.query.count()
-    reported_photos_count = Photo.query.filter(Photo.flag > 0).count()
-    tag_count = Tag.query.count()
-    comment_count = Comment.query.count()
-    reported_comments_count = Comment.query.filter(Comment.flag > 0).count()
-    return render_template('admin/index.html', user_count=user_count, photo_count=photo_count,
-                           tag_count=tag_count, comment_count=comment_count, locked_user_count=locked_user_count,
-                           blocked_user_count=blocked_user_count, reported_comments_count=reported_comments_count,
-                           reported_photos_count=reported_photos_count)
+    return render_template('admin/index.html', **get_statistics())
+
+
+@admin_bp.route('/statistics')
+@login_required
+@permission_required('MODERATE')
+def statistics():
+    statistics = get_statistics()
+    return jsonify(dict(statistics, generated_at=statistics['generated_at'].isoformat() + 'Z'))
 
 
 @admin_bp.route('/lock/user/<int:user_id>', methods=['POST'])
@@ -40,6 +41,7 @@ def lock_user(user_id):
     if user.locked:
         flash('User already locked', 'warning')
     user.lock()
+    db.session.commit()
     flash('User locked', 'success')
     return redirect_back()
 
@@ -50,6 +52,7 @@ def lock_user(user_id):
 def unlock_user(user_id):
     user = User.query.get_or_404(user_id)
     user.unlock()
+    db.session.commit()
     flash('User unlocked', 'success')
     return redirect_back()
 
@@ -65,6 +68,7 @@ def block_user(user_id):
     if user.locked:
         flash('User already blocked', 'warning')
     user.block()
+    db.session.commit()
     flash('User blocked', 'success')
     return redirect_back()
 
@@ -75,6 +79,7 @@ def block_user(user_id):
 def unblock_user(user_id):
     user = User.query.get_or_404(user_id)
     user.unblock()
+    db.session.commit()
     flash('User unblocked', 'success')
     return redirect_back()
 
@@ -90,6 +95,90 @@ def delete_tag(tag_id):
     return redirect_back()
 
 
+def user_filter(filter_rule):
+    if filter_rule == 'locked':
+        return User.locked == db.true()
+    if filter_rule == 'blocked':
+        return User.active == db.false()
+    if filter_rule in ('administrator', 'moderator'):
+        role = Role.query.filter_by(name=filter_rule.capitalize()).first()
+        return User.role_id == role.id
+    return None
+
+
+def bulk_condition(model):
+    """Return the rows selected by the ``filter`` and ``author_id`` fields, or else by the ``ids`` list."""
+    filter_rule = request.form.get('filter')
+    if model is User:
+        condition = user_filter(filter_rule)
+    elif model is Tag:
+        # 没有图片的标签
+        condition = ~Tag.photos.any() if filter_rule == 'unused' else None
+    else:
+        conditions = []
+        if filter_rule == 'reported':
+            conditions.append(model.flag > 0)
+        author_id = request.form.get('author_id', type=int)
+        if author_id is not None:
+            conditions.append(model.author_id == author_id)
+        condition = db.and_(*conditions) if conditions else None
+    if condition is None:
+        ids = request.form.getlist('ids', type=int)
+        # 没有指定范围时不操作任何行，避免误改全部数据
+        if not ids:
+            abort(400)
+        condition = model.id.in_(ids)
+    return condition
+
+
+def bulk_response(count, message):
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(count=count)
+    flash(message % count, 'info')
+    return redirect_back()
+
+
+@admin_bp.route('/bulk/user/<any(lock, unlock, block, unblock):action>', methods=['POST'])
+@login_required
+@permission_required('MODERATE')
+def bulk_user(action):
+    # 和单个操作一样，不处理自己以及管理员和协管员
+    protected = db.select(Role.id).where(Role.name.in_(['Administrator', 'Moderator']))
+    condition = db.and_(bulk_condition(User), User.id != current_user.id, User.role_id.not_in(protected))
+    if action in ('lock', 'unlock'):
+        count = set_users_locked(condition, action == 'lock')
+    else:
+        count = set_users_active(condition, action == 'unblock')
+    return bulk_response(count, '%d users ' + action + 'ed.')
+
+
+@admin_bp.route('/bulk/photo/<any(delete, unflag):action>', methods=['POST'])
+@login_required
+@permission_required('MODERATE')
+def bulk_photo(action):
+    condition = bulk_condition(Photo)
+    if action == 'delete':
+        return bulk_response(delete_photos(condition), '%d photos deleted.')
+    return bulk_response(unflag(Photo, condition), '%d photos unflagged.')
+
+
+@admin_bp.route('/bulk/comment/<any(delete, unflag):action>', methods=['POST'])
+@login_required
+@permission_required('MODERATE')
+def bulk_comment(action):
+    condition = bulk_condition(Comment)
+    if action == 'delete':
+        return bulk_response(delete_comments(condition), '%d comments deleted.')
+    return bulk_response(unflag(Comment, condition), '%d comments unflagged.')
+
+
+@admin_bp.route('/bulk/tag/delete', methods=['POST'])
+@login_required
+@permission_required('MODERATE')
+def bulk_tag():
+    return bulk_response(delete_tags(bulk_condition(Tag)), '%d tags deleted.')
+
+
 @admin_bp.route('/manage/user')
 @login_required
 @permission_required('MODERATE')
@@ -98,18 +187,8 @@ def manage_user():
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_MANAGE_USER_PER_PAGE']
     
-    if filter_rule == 'locked':
-        filtered_users = User.query.filter_by(locked=True)
-    elif filter_rule == 'blocked':
-        filtered_users = User.query.filter_by(active=False)
-    elif filter_rule == 'administrator':
-        administrator = Role.query.filter_by(name='Administrator').first()
-        filtered_users = User.query.filter_by(role=administrator)
-    elif filter_rule == 'moderator':
-        moderator = Role.query.filter_by(name='Moderator').first()
-        filtered_users = User.query.filter_by(role=moderator)
-    else:
-        filtered_users = User.query
+    condition = user_filter(filter_rule)
+    filtered_users = User.query if condition is None else User.query.filter(condition)
     
     pagination = filtered_users.order_by(User.member_since.desc()).paginate(page=page, per_page=per_page)
     users = pagination.items
@@ -124,7 +203,14 @@ def manage_photo(order):
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_MANAGE_PHOTO_PER_PAGE']
     order_rule = 'flag'
-    if order == 'by_time':
+    if order == 'queue':
+        # 审核队列：只包含被举报的图片，举报多的在前，由 flag > 0 的部分索引支持
+        pagination = keyset_paginate(Photo.query.filter(Photo.flag > 0), (Photo.flag, Photo.id),
+                                     key=lambda photo: (photo.flag, photo.id), per_page=per_page,
+                                     cursor=request.args.get('cursor'))
+        pagination.total = Photo.query.filter(Photo.flag > 0).count()
+        order_rule = 'queue'
+    elif order == 'by_time':
         pagination = Photo.query.order_by(Photo.timestamp.desc()).paginate(page=page, per_page=per_page)
         order_rule = 'time'
     else:
@@ -152,7 +238,14 @@ def manage_comment(order):
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_MANAGE_COMMENT_PER_PAGE']
     order_rule = 'flag'
-    if order == 'by_time':
+    if order == 'queue':
+        # 审核队列：只包含被举报的评论，举报多的在前，由 flag > 0 的部分索引支持
+        pagination = keyset_paginate(Comment.query.filter(Comment.flag > 0), (Comment.flag, Comment.id),
+                                     key=lambda comment: (comment.flag, comment.id), per_page=per_page,
+                                     cursor=request.args.get('cursor'))
+        pagination.total = Comment.query.filter(Comment.flag > 0).count()
+        order_rule = 'queue'
+    elif order == 'by_time':
         pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(page=page, per_page=per_page)
         order_rule = 'time'
     else:
@@ -1,10 +1,17 @@
 # -*- codeing = utf-8 -*-
-from flask import Blueprint, render_template, jsonify
+import json
+import queue
+import time
+from datetime import datetime, timedelta
+
+from flask import Blueprint, render_template, jsonify, request, current_app, Response
 from flask_login import login_required, current_user
 
+from albumy.autocomplete import get_autocomplete
 from albumy.decorators import confirm_required, permission_required
-from albumy.models import User
-from albumy.nitifications import push_follow_notification
+from albumy.events import get_broker, user_channel
+from albumy.models import User, Photo, Notification
+from albumy.nitifications import push_follow_notification, push_collect_notification
 
 ajax_bp = Blueprint('ajax', __name__)
 
@@ -50,9 +57,140 @@ def followers_count(user_id):
     return jsonify(count=user.followers.count() - 1), 200
 
 
+@ajax_bp.route('/collectors-count/<int:photo_id>')
+def collectors_count(photo_id):
+    photo = Photo.query.get_or_404(photo_id)
+    return jsonify(count=photo.collectors_count), 200
+
+
+@ajax_bp.route('/collect/<int:photo_id>', methods=['POST'])
+def collect(photo_id):
+    if not current_user.is_authenticated:
+        return jsonify(message='Login required.'), 403
+    if not current_user.confirmed:
+        return jsonify(message='Please confirm your account.'), 400
+    if not current_user.can('COLLECT'):
+        return jsonify(message='Insufficient permissions.'), 403
+    
+    photo = Photo.query.get_or_404(photo_id)
+    if current_user.is_collecting(photo):
+        return jsonify(message='Already collected.'), 400
+    current_user.collect(photo)
+    if current_user != photo.author and photo.author.receive_collect_notification:
+        push_collect_notification(collector=current_user, photo_id=photo_id, receiver=photo.author)
+    return jsonify(message='Photo collected.'), 200
+
+
+@ajax_bp.route('/uncollect/<int:photo_id>', methods=['POST'])
+def uncollect(photo_id):
+    if not current_user.is_authenticated:
+        return jsonify(message='Login required.'), 403
+    photo = Photo.query.get_or_404(photo_id)
+    if not current_user.is_collecting(photo):
+        return jsonify(message='Not collect yet.'), 400
+    current_user.uncollect(photo)
+    return jsonify(message='Photo uncollected.'), 200
+
+
 @ajax_bp.route('/notifications-count')
 def notifications_count():
     if not current_user.is_authenticated:
         return jsonify(message='Login required.'), 403
-    count = current_user.notifications.filter_by(is_read=False).count()
-    return jsonify(count=count), 200
+    return jsonify(count=current_user.unread_notification_count), 200
+
+
+@ajax_bp.route('/notifications/stream')
+def notifications_stream():
+    """Stream the unread notification count as server-sent events.
+
+    The stream holds a worker for as long as it is open, so deploy it behind an async worker
+    (gevent or eventlet). It is closed after ``ALBUMY_EVENT_STREAM_TIMEOUT`` seconds and the
+    browser reconnects after ``ALBUMY_EVENT_RETRY`` milliseconds.
+    """
+    if not current_user.is_authenticated:
+        return jsonify(message='Login required.'), 403
+    broker = get_broker()
+    channel = user_channel(current_user.id)
+    subscription = broker.subscribe(channel)
+    count = current_user.unread_notification_count
+    keepalive = current_app.config['ALBUMY_EVENT_KEEPALIVE']
+    retry = current_app.config['ALBUMY_EVENT_RETRY']
+    deadline = time.monotonic() + current_app.config['ALBUMY_EVENT_STREAM_TIMEOUT']
+    
+    # 生成器在请求结束后才执行，不能再访问 current_user 和数据库
+    def generate():
+        try:
+            yield 'retry: %d\n\n' % retry
+            yield 'event: count\ndata: %s\n\n' % json.dumps({'event': 'count', 'count': count})
+            # 到期后结束响应释放 worker，重连时会重新发送最新的未读数
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    message = subscription.get(timeout=min(keepalive, remaining))
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield 'event: %s\ndata: %s\n\n' % (message['event'], json.dumps(message))
+        finally:
+            broker.unsubscribe(channel, subscription)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def _json_body():
+    # 没有请求体时视为空对象，不是 JSON 对象时返回 None
+    data = request.get_json(silent=True)
+    if data is None and not request.get_data():
+        return {}
+    return data if isinstance(data, dict) else None
+
+
+def _is_int(value):
+    # JSON 的 true/false 在 Python 中也是 int
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+@ajax_bp.route('/notifications/read', methods=['POST'])
+def read_notifications():
+    if not current_user.is_authenticated:
+        return jsonify(message='Login required.'), 403
+    data = _json_body()
+    if data is None:
+        return jsonify(message='Invalid request body.'), 400
+    # 不传 ids 时标记全部
+    notification_ids = data.get('ids')
+    if notification_ids is not None and not (isinstance(notification_ids, list) and
+                                             all(_is_int(i) for i in notification_ids)):
+        return jsonify(message='Invalid notification ids.'), 400
+    read = Notification.mark_read(current_user.id, notification_ids)
+    return jsonify(message='Notifications archived.', count=read, unread=current_user.unread_notification_count), 200
+
+
+@ajax_bp.route('/notifications/delete', methods=['POST'])
+def delete_notifications():
+    if not current_user.is_authenticated:
+        return jsonify(message='Login required.'), 403
+    data = _json_body()
+    if data is None:
+        return jsonify(message='Invalid request body.'), 400
+    days = data.get('days')
+    if days is not None and not (_is_int(days) and 0 <= days <= current_app.config['ALBUMY_NOTIFICATION_MAX_DAYS']):
+        return jsonify(message='Invalid days.'), 400
+    read_only = data.get('read_only', True)
+    if not isinstance(read_only, bool):
+        return jsonify(message='Invalid read_only.'), 400
+    before = datetime.utcnow() - timedelta(days=days) if days else None
+    deleted = Notification.delete_all(current_user.id, before, read_only=read_only)
+    return jsonify(message='Notifications deleted.', count=deleted), 200
+
+
+@ajax_bp.route('/autocomplete/<any(tag, user):kind>')
+def autocomplete(kind):
+    q = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', current_app.config['ALBUMY_AUTOCOMPLETE_LIMIT'], type=int),
+                       current_app.config['ALBUMY_AUTOCOMPLETE_LIMIT']))
+    results = get_autocomplete().index(kind).search(q, limit) if q else []
+    return jsonify(results=[{'id': entry_id, 'name': name} for name, entry_id in results])
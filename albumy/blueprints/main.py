@@ -1,18 +1,24 @@
 # -*- coding: utf-8 -*-
 import os
+from datetime import datetime, timedelta
 
-from flask import render_template, Blueprint, request, current_app, send_from_directory, redirect, flash, url_for, \
+from flask import render_template, Blueprint, request, current_app, redirect, flash, url_for, \
     abort, jsonify
-from flask_dropzone import random_filename
 from flask_login import login_required, current_user
-from sqlalchemy import func
+from werkzeug.security import safe_join
 
 from albumy.extensions import db
 from albumy.decorators import confirm_required, permission_required
 from albumy.forms.main import DescriptionForm, TagForm, CommentForm
-from albumy.models import Photo, Tag, Comment, Notification, Follow, Collect, User
+from albumy.models import Photo, Tag, Comment, Notification, Collect, User, Timeline, TagPopularity, DerivativeJob, \
+    Blob, Report
+from albumy.pagination import keyset_paginate
+from albumy.responsive import responsive_image
+from albumy.sampling import PhotoSample
+from albumy.search import SEARCH_INDEXES, full_text_search
+from albumy.storage import resolve_upload
 from albumy.nitifications import push_collect_notification, push_comment_notification
-from albumy.utils import flash_errors, redirect_back, resize_image
+from albumy.utils import flash_errors, redirect_back, derive_images, save_upload, send_upload
 
 main_bp = Blueprint('main', __name__)
 
@@ -20,30 +26,23 @@ main_bp = Blueprint('main', __name__)
 @main_bp.route('/')
 def index():
     if current_user.is_authenticated:
-        # filter和filter_by的区别:filter_by只能用于等值判断，filter可以用于其他判断
-        followed_photos = Photo.query. \
-            join(Follow, Follow.followed_id == Photo.author_id). \
-            filter(Follow.follower_id == current_user.id). \
-            order_by(Photo.timestamp.desc())
-        page = request.args.get('page', 1, type=int)
+        cursor = request.args.get('cursor')
         per_page = current_app.config['ALBUMY_PHOTO_PER_PAGE']
-        pagination = followed_photos.paginate(page=page, per_page=per_page)
+        pagination = Timeline.paginate_feed(current_user, per_page=per_page, cursor=cursor)
         photos = pagination.items
     else:
         pagination = None
         photos = None
-    tags = Tag.query. \
-        join(Tag.photos). \
-        group_by(Tag.id). \
-        order_by(func.count(Photo.id).desc()). \
-        limit(10)
+    tags = TagPopularity.top(10)
     return render_template('main/index.html', pagination=pagination, photos=photos, tags=tags, Collect=Collect)
 
 
 @main_bp.route('/explore')
 def explore():
-    photos = Photo.query.order_by(func.random()).limit(12)
-    return render_template('main/explore.html', photos=photos)
+    cursor = request.args.get('cursor')
+    sample = PhotoSample.from_cursor(cursor) if cursor else PhotoSample.create()
+    photos = sample.take(current_app.config['ALBUMY_PHOTO_PER_PAGE'])
+    return render_template('main/explore.html', photos=photos, sample=sample)
 
 
 @main_bp.route('/upload', methods=['GET', 'POST'])
@@ -56,36 +55,76 @@ def upload():
         # if not check_image(f):
         #     return 'Invalid image.', 400
         f = request.files.get('file')
-        filename = random_filename(f.filename)
-        f.save(os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename))
-        filename_s = resize_image(f, filename, current_app.config['ALBUMY_PHOTO_SIZE']['small'])
-        filename_m = resize_image(f, filename, current_app.config['ALBUMY_PHOTO_SIZE']['medium'])
-        photo = Photo(filename=filename,
-                      filename_s=filename_s,
-                      filename_m=filename_m,
+        path, content_hash = save_upload(f)
+        blob, created = Blob.acquire(content_hash, os.path.splitext(f.filename)[1].lower(), path)
+        if created:
+            if current_app.config['ALBUMY_ASYNC_DERIVATIVES']:
+                # 缩略图生成之前先用原图代替
+                blob.derivatives_ready = False
+                db.session.add(DerivativeJob(blob=blob))
+            else:
+                filenames, timings = derive_images(os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'],
+                                                                blob.filename), blob.filename)
+                blob.filename_s = filenames[current_app.config['ALBUMY_PHOTO_SIZE']['small']]
+                blob.filename_m = filenames[current_app.config['ALBUMY_PHOTO_SIZE']['medium']]
+        # 内容相同的文件已存在时直接复用它的缩略图
+        photo = Photo(filename=blob.filename,
+                      filename_s=blob.filename_s,
+                      filename_m=blob.filename_m,
+                      derivatives_ready=blob.derivatives_ready,
+                      blob=blob,
                       author=current_user._get_current_object(),
                       )
         db.session.add(photo)
         db.session.commit()
+        Timeline.fan_out(photo)
     return render_template('main/upload.html')
 
 
 @main_bp.route('/avatars/<path:filename>')
 def get_avatar(filename):
-    return send_from_directory(current_app.config['AVATARS_SAVE_PATH'], filename)
+    filename = resolve_upload(current_app.config['AVATARS_SAVE_PATH'], filename)
+    return send_upload(current_app.config['AVATARS_SAVE_PATH'], filename,
+                       max_age=current_app.config['ALBUMY_AVATAR_CACHE_MAX_AGE'])
 
 
 @main_bp.route('/uplodas/<path:filename>')
 def get_image(filename):
-    return send_from_directory(current_app.config['ALBUMY_UPLOAD_PATH'], filename)
+    filename = resolve_upload(current_app.config['ALBUMY_UPLOAD_PATH'], filename)
+    return send_upload(current_app.config['ALBUMY_UPLOAD_PATH'], filename,
+                       max_age=current_app.config['ALBUMY_IMAGE_CACHE_MAX_AGE'], immutable=True)
+
+
+@main_bp.route('/uplodas/w<int:width>/<image_format>/<path:filename>')
+def get_responsive_image(width, image_format, filename):
+    if width not in current_app.config['ALBUMY_RESPONSIVE_WIDTHS'] or \
+            image_format not in current_app.config['ALBUMY_RESPONSIVE_FORMATS']:
+        abort(404)
+    resolved = resolve_upload(current_app.config['ALBUMY_UPLOAD_PATH'], filename)
+    # 只接受图片的原图作为来源，头像、缓存和临时文件等不能用来生成
+    photo_files = Photo.query.filter(Photo.filename.in_({filename, resolved}))
+    if not db.session.query(photo_files.exists()).scalar():
+        abort(404)
+    source = safe_join(current_app.config['ALBUMY_UPLOAD_PATH'], resolved)
+    if source is None or not os.path.isfile(source):
+        abort(404)
+    try:
+        cached = responsive_image(resolved, width, image_format)
+    except OSError:
+        # 包括 PIL.UnidentifiedImageError，文件损坏或不是图片
+        abort(404)
+    return send_upload(current_app.config['ALBUMY_RESPONSIVE_CACHE_PATH'], cached,
+                       max_age=current_app.config['ALBUMY_IMAGE_CACHE_MAX_AGE'], immutable=True)
 
 
 @main_bp.route('/photo/<int:photo_id>')
 def show_photo(photo_id):
     photo = Photo.query.get_or_404(photo_id)
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     per_page = current_app.config['ALBUMY_COMMENT_PER_PAGE']
-    pagination = Comment.query.with_parent(photo).order_by(Comment.timestamp.asc()).paginate(page=page, per_page=per_page)
+    pagination = keyset_paginate(Comment.query.with_parent(photo), (Comment.timestamp, Comment.id),
+                                 key=lambda comment: (comment.timestamp, comment.id),
+                                 per_page=per_page, cursor=cursor, descending=False)
     comments = pagination.items
     
     comment_form = CommentForm()
@@ -157,10 +196,12 @@ def set_comment(photo_id):
 @login_required
 @confirm_required
 def report_photo(photo_id):
-    photo = Photo.query.git_or_404(photo_id)
-    photo.flag += 1
-    db.session.commit()
-    flash('Photo reported.', 'success')
+    photo = Photo.query.get_or_404(photo_id)
+    if Report.add(current_user, photo):
+        db.session.commit()
+        flash('Photo reported.', 'success')
+    else:
+        flash('You have already reported this photo.', 'info')
     return redirect(url_for('main.show_photo', photo_id=photo_id))
 
 
@@ -176,7 +217,7 @@ def collect(photo_id):
     current_user.collect(photo)
     flash('Photo collected.', 'success')
     if current_user != photo.author and photo.author.receive_collect_notification:
-        push_collect_notification(collector=current_user, photo_id=photo_id, recipient=photo.author)
+        push_collect_notification(collector=current_user, photo_id=photo_id, receiver=photo.author)
     return redirect(url_for('main.show_photo', photo_id=photo_id))
 
 
@@ -230,6 +271,7 @@ def new_tag(photo_id):
     
     form = TagForm()
     if form.validate_on_submit():
+        added_tags = []
         for name in form.tag.data.split():
             tag = Tag.query.filter_by(name=name).first()
             if tag is None:
@@ -237,6 +279,10 @@ def new_tag(photo_id):
                 db.session.add(tag)
             if tag not in photo.tags:
                 photo.tags.append(tag)
+                added_tags.append(tag)
+        if added_tags:
+            db.session.flush()
+            db.session.execute(TagPopularity.adjust([tag.id for tag in added_tags], photo, 1))
         db.session.commit()
         flash('Tag added.', 'success')
         return redirect(url_for('main.show_photo', photo_id=photo_id))
@@ -246,14 +292,18 @@ def new_tag(photo_id):
 @main_bp.route('/tag/<int:tag_id>/<order>')
 def show_tag(tag_id, order):
     tag = Tag.query.get_or_404(tag_id)
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     per_page = current_app.config['ALBUMY_PHOTO_PER_PAGE']
-    if order == 'by_time':
-        order_rule = 'time'
-        pagination = Photo.query.with_parent(tag).order_by(Photo.timestamp.desc()).paginate(page=page, per_page=per_page)
     if order == 'by_collects':
         order_rule = 'collects'
-        pagination = Photo.query.with_parent(tag).order_by(Photo.collectors_count.desc()).paginate(page=page, per_page=per_page)
+        pagination = keyset_paginate(Photo.query.with_parent(tag), (Photo.collectors_count, Photo.id),
+                                     key=lambda photo: (photo.collectors_count, photo.id),
+                                     per_page=per_page, cursor=cursor)
+    else:
+        order_rule = 'time'
+        pagination = keyset_paginate(Photo.query.with_parent(tag), (Photo.timestamp, Photo.id),
+                                     key=lambda photo: (photo.timestamp, photo.id),
+                                     per_page=per_page, cursor=cursor)
     photos = pagination.items
     
     return render_template('main/tag.html', tag=tag, photos=photos, pagination=pagination, order_rule=order_rule)
@@ -267,6 +317,7 @@ def delete_tag(photo_id, tag_id):
     if current_user != photo.author and not current_user.can('MODERATE'):
         abort(403)
     photo.tags.remove(tag)
+    db.session.execute(TagPopularity.adjust([tag.id], photo, -1))
     if not tag.photos:
         db.session.delete(tag)
     
@@ -280,7 +331,6 @@ def delete_tag(photo_id, tag_id):
 def new_comment(photo_id):
     photo = Photo.query.get_or_404(photo_id)
     form = CommentForm()
-    page = request.args.get('page', 1, type=int)
     if form.validate_on_submit():
         body = form.body.data
         author = current_user._get_current_object()
@@ -295,7 +345,7 @@ def new_comment(photo_id):
         if current_user != photo.author and photo.author.receive_comment_notification:
             push_comment_notification(photo_id=photo_id, receiver=photo.author)
     flash_errors(form)
-    return redirect(url_for('main.show_photo', photo_id=photo_id, page=page))
+    return redirect(url_for('main.show_photo', photo_id=photo_id, cursor='last') + '#comments')
 
 
 @main_bp.route('/reply/comment/<int:comment_id>')
@@ -314,9 +364,11 @@ def reply_comment(comment_id):
 @confirm_required
 def report_comment(comment_id):
     comment = Comment.query.get_or_404(comment_id)
-    comment.flag += 1
-    db.session.commit()
-    flash('Comment reported.', 'success')
+    if Report.add(current_user, comment):
+        db.session.commit()
+        flash('Comment reported.', 'success')
+    else:
+        flash('You have already reported this comment.', 'info')
     return redirect(url_for('main.show_photo', photo_id=comment.photo_id))
 
 
@@ -353,8 +405,7 @@ def read_notification(notification_id):
     notification = Notification.query.get_or_404(notification_id)
     if current_user != notification.receiver:
         abort(403)
-    notification.is_read = True
-    db.session.commit()
+    Notification.mark_read(current_user.id, [notification.id])
     flash('Notification archived.', 'success')
     return redirect(url_for('main.show_notifications'))
 
@@ -362,13 +413,35 @@ def read_notification(notification_id):
 @main_bp.route('/notifications/read/all', methods=['POST'])
 @login_required
 def read_all_notification():
-    for notification in current_user.notifications:
-        notification.is_read = True
-    db.session.commit()
+    Notification.mark_read(current_user.id)
     flash('All notifications archived.', 'success')
     return redirect(url_for('main.show_notifications'))
 
 
+@main_bp.route('/notifications/read', methods=['POST'])
+@login_required
+def read_notifications():
+    notification_ids = request.form.getlist('ids', type=int)
+    read = Notification.mark_read(current_user.id, notification_ids)
+    flash('%d notifications archived.' % read, 'success')
+    return redirect(url_for('main.show_notifications'))
+
+
+@main_bp.route('/notifications/delete', methods=['POST'])
+@login_required
+def delete_notifications():
+    days = request.form.get('days', type=int)
+    if days is not None and days < 0:
+        flash('Invalid days.', 'warning')
+        return redirect(url_for('main.show_notifications'))
+    if days:
+        days = min(days, current_app.config['ALBUMY_NOTIFICATION_MAX_DAYS'])
+    before = datetime.utcnow() - timedelta(days=days) if days else None
+    deleted = Notification.delete_all(current_user.id, before)
+    flash('%d read notifications deleted.' % deleted, 'info')
+    return redirect(url_for('main.show_notifications'))
+
+
 @main_bp.route('/search')
 def search():
     q = request.args.get('q', '')
@@ -376,13 +449,10 @@ def search():
         flash('Please enter keywords.', 'warning')
         return redirect_back()
     category = request.args.get('category', 'photo')
+    if category not in SEARCH_INDEXES:
+        abort(404)
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_SEARCH_RESULT_PER_PAGE']
-    if category == 'user':
-        pagination = User.query.whooshee_search(q).paginate(page=page, per_page=per_page)
-    if category == 'photo':
-        pagination = Photo.query.whooshee_search(q).paginate(page=page, per_page=per_page)
-    if category == 'tag':
-        pagination = Tag.query.whooshee_search(q).paginate(page=page, per_page=per_page)
+    pagination = full_text_search(category, q, per_page, page=page, cursor=request.args.get('cursor'))
     results = pagination.items
     return render_template('main/search.html', q=q, category=category, pagination=pagination, results=results)
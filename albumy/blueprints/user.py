@@ -9,7 +9,9 @@ from albumy.forms.user import UploadAvatarForm, CropAvatarForm, ChangePasswordFo
     PrivacySettingForm, DeleteAccountForm, EditProfileForm, ChangeEmailForm
 from albumy.models import User, Photo, Collect
 from albumy.nitifications import push_follow_notification
+from albumy.pagination import keyset_paginate
 from albumy.settings import Operations
+from albumy.storage import move_to_shard
 from albumy.utils import redirect_back, flash_errors, generate_token, validate_token
 
 user_bp = Blueprint('user', __name__)
@@ -24,9 +26,11 @@ def index(username):
     if user == current_user and not current_user.active:
         flash('You has been blocked', 'danger')
         logout_user()
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     per_page = current_app.config['ALBUMY_PHOTO_PER_PAGE']
-    pagination = Photo.query.with_parent(user).order_by(Photo.timestamp.desc()).paginate(page=page, per_page=per_page)
+    pagination = keyset_paginate(Photo.query.with_parent(user), (Photo.timestamp, Photo.id),
+                                 key=lambda photo: (photo.timestamp, photo.id),
+                                 per_page=per_page, cursor=cursor)
     photos = pagination.items
     return render_template('user/index.html', user=user, pagination=pagination, photos=photos)
 
@@ -34,9 +38,11 @@ def index(username):
 @user_bp.route('/<username>/collections')
 def show_collections(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     per_page = current_app.config['ALBUMY_PHOTO_PER_PAGE']
-    pagination = Collect.query.with_parent(user).order_by(Collect.timestamp.desc()).paginate(page=page, per_page=per_page)
+    pagination = keyset_paginate(Collect.query.with_parent(user), (Collect.timestamp, Collect.collected_id),
+                                 key=lambda collect: (collect.timestamp, collect.collected_id),
+                                 per_page=per_page, cursor=cursor)
     collects = pagination.items
     return render_template('user/collections.html', user=user, pagination=pagination, collects=collects)
 
@@ -52,7 +58,7 @@ def follow(username):
         return render_template('user/index.html', user=user)
     current_user.follow(user)
     flash('User followed.', 'success')
-    if current_user.receive_follow_notifications:
+    if user.receive_follow_notification:
         push_follow_notification(follower=current_user, receiver=user)
     return redirect_back()
 
@@ -126,7 +132,7 @@ def upload_avatar():
     if form.validate_on_submit():
         image = form.image.data
         filename = avatars.save_avatar(image)
-        current_user.avatar_raw = filename
+        current_user.avatar_raw = move_to_shard(current_app.config['AVATARS_SAVE_PATH'], filename)
         db.session.commit()
     flash_errors(form)
     return redirect(url_for('user.change_avatar'))
@@ -142,8 +148,9 @@ def crop_avatar():
         y = form.y.data
         w = form.w.data
         h = form.h.data
-        filename = avatars.crop_avatar(current_user.avatar_raw, x, y, w, h)
-        current_user.avatar_s, current_user.avatar_m, current_user.avatar_l = filename
+        filenames = [move_to_shard(current_app.config['AVATARS_SAVE_PATH'], filename)
+                     for filename in avatars.crop_avatar(current_user.avatar_raw, x, y, w, h)]
+        current_user.avatar_s, current_user.avatar_m, current_user.avatar_l = filenames
         
         db.session.commit()
         flash('Avatar uploaded.', 'success')
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+
+class TTLCache:
+    """进程内的键值缓存，每个条目在写入时指定存活秒数，超过 maxsize 时淘汰最早写入的条目。"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or item[0] < time.time():
+            return default
+        return item[1]
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            if len(self._data) >= self.maxsize:
+                # dict 按插入顺序迭代，第一个即最早写入的条目
+                del self._data[next(iter(self._data))]
+            self._data[key] = (time.time() + ttl, value)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -1,29 +1,176 @@
 # -*- codeing = utf-8 -*-
-from threading import Thread
+import queue
+import smtplib
+import threading
+from contextlib import ExitStack
 
 from flask import current_app, render_template
 from flask_mail import Message
 
-from albumy.extensions import mail
+from albumy.extensions import db, mail
+from albumy.models import OutboxMail
 
 
-def _send_async_mail(app, message):
-    # 此方法作用是在新的线程中发送邮件
-    with app.app_context():
-        # app_context()方法将app推入栈中，使其成为当前线程的代理对象
-        mail.send(message)
+class SMTPConnection:
+    """在多封邮件之间复用的 SMTP 连接，第一次发送时打开，出错后关闭，下次发送时重新连接。"""
+
+    def __init__(self):
+        self._stack = None
+        self._connection = None
+
+    def send(self, message):
+        if self._connection is None:
+            stack = ExitStack()
+            # 进入 mail.connect() 的上下文时连接服务器，测试时 MAIL_SUPPRESS_SEND 为真，不连接
+            self._connection = stack.enter_context(mail.connect())
+            self._stack = stack
+        try:
+            self._connection.send(message)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self.close()
+            raise
+
+    def close(self):
+        stack, self._stack, self._connection = self._stack, None, None
+        if stack is not None:
+            try:
+                stack.close()
+            except (smtplib.SMTPException, OSError):
+                pass
+
+
+def deliver(outbox_mails, connection):
+    """Send the claimed ``outbox_mails`` over ``connection`` and return the number sent."""
+    messages = [(outbox_mail.id, Message(outbox_mail.subject, recipients=[outbox_mail.recipient],
+                                         body=outbox_mail.body, html=outbox_mail.html))
+                for outbox_mail in outbox_mails]
+    sent = []
+    for mail_id, message in messages:
+        try:
+            connection.send(message)
+        except Exception as e:
+            current_app.logger.warning('Failed to send mail %d: %r', mail_id, e)
+            OutboxMail.fail(mail_id, repr(e))
+            continue
+        sent.append(mail_id)
+    # 发送后进程退出会在 ALBUMY_MAIL_TIMEOUT 后重新发送，宁可重复也不丢失
+    OutboxMail.sent(sent)
+    return len(sent)
+
+
+def send_outbox():
+    """Send every due mail in the outbox over one connection and return the number sent."""
+    batch_size = current_app.config['ALBUMY_MAIL_BATCH_SIZE']
+    connection = SMTPConnection()
+    sent = 0
+    try:
+        while True:
+            outbox_mails = OutboxMail.claim(batch_size)
+            if not outbox_mails:
+                break
+            sent += deliver(outbox_mails, connection)
+    finally:
+        connection.close()
+    return sent
+
+
+class MailQueue:
+    """有界的发送队列和固定数量的发送线程，每个线程保持自己的 SMTP 连接并按批发送。
+
+    队列中只保存 OutboxMail 的 id，邮件内容在数据库中，进程重启后由发送线程从发件箱中重新领取。
+    """
+
+    # 放入队列唤醒等待中的发送线程，让它检查是否需要退出
+    _WAKEUP = object()
+
+    def __init__(self):
+        self._queue = None
+        self._threads = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def put(self, app, mail_id):
+        with self._lock:
+            if self._queue is None:
+                self._queue = queue.Queue(app.config['ALBUMY_MAIL_QUEUE_SIZE'])
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < app.config['ALBUMY_MAIL_WORKERS']:
+                thread = threading.Thread(target=self._run, args=(app, self._stop), name='mail-sender', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        try:
+            # 队列满时让请求稍等，超时后邮件仍在发件箱中，由空闲的发送线程稍后领取
+            self._queue.put(mail_id, timeout=app.config['ALBUMY_MAIL_QUEUE_TIMEOUT'])
+        except queue.Full:
+            app.logger.warning('The mail queue is full, mail %d is left in the outbox.', mail_id)
+
+    def stop(self, timeout=None):
+        """Stop the sender threads after their current batch and wait for them to exit.
+
+        Mails still queued stay in the outbox and are claimed after the next ``put``.
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+            stop, self._stop = self._stop, threading.Event()
+        stop.set()
+        for _ in threads:
+            try:
+                self._queue.put_nowait(self._WAKEUP)
+            except queue.Full:
+                break
+        for thread in threads:
+            thread.join(timeout)
+
+    def _next_batch(self, batch_size, timeout):
+        try:
+            item = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        mail_ids = []
+        # 每个线程最多取走一个唤醒标记，其余的留给其他线程
+        while item is not self._WAKEUP:
+            mail_ids.append(item)
+            if len(mail_ids) >= batch_size:
+                break
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+        return mail_ids or None
+
+    def _run(self, app, stop):
+        batch_size = app.config['ALBUMY_MAIL_BATCH_SIZE']
+        connection = SMTPConnection()
+        while not stop.is_set():
+            mail_ids = self._next_batch(batch_size, app.config['ALBUMY_MAIL_IDLE_TIMEOUT'])
+            with app.app_context():
+                try:
+                    if mail_ids is not None:
+                        deliver(OutboxMail.claim(batch_size, mail_ids), connection)
+                        continue
+                    # 空闲时关闭连接，再领取到期重试的邮件以及队列满时留在发件箱中的邮件
+                    connection.close()
+                    while not stop.is_set() and deliver(OutboxMail.claim(batch_size), connection):
+                        pass
+                    connection.close()
+                except Exception:
+                    app.logger.exception('Failed to send the queued mails.')
+        connection.close()
+
+
+mail_queue = MailQueue()
 
 
 def send_mail(to, subject, template, **kwargs):
-    message = Message(current_app.config['ALBUMY_MAIL_SUBJECT_PREFIX'] + subject, recipients=[to])
-    # recipients:收件人列表 subject:邮件主题
-    message.body = render_template(template + '.txt', **kwargs)
-    message.html = render_template(template + '.html', **kwargs)
-    app = current_app._get_current_object()
-    # current_app是一个代理对象，需要使用_get_current_object()方法获取真实的app对象
-    thr = Thread(target=_send_async_mail, args=[app, message])
-    thr.start()
-    return thr
+    outbox_mail = OutboxMail(recipient=to, subject=current_app.config['ALBUMY_MAIL_SUBJECT_PREFIX'] + subject,
+                             body=render_template(template + '.txt', **kwargs),
+                             html=render_template(template + '.html', **kwargs))
+    db.session.add(outbox_mail)
+    db.session.commit()
+    if current_app.config['ALBUMY_MAIL_IN_BACKGROUND']:
+        mail_queue.put(current_app._get_current_object(), outbox_mail.id)
+    else:
+        send_outbox()
 
 
 def send_confirm_email(user, token, to=None):
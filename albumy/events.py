@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import json
+import queue
+import threading
+
+from flask import current_app
+from werkzeug.utils import import_string
+
+
+class LocalBroker:
+    """进程内的发布订阅，每个订阅者一个有界队列，队列满时丢弃最早的消息。
+
+    只能把事件发给同一进程中的连接，多进程部署时换成 RedisBroker 之类的实现。
+    """
+
+    def __init__(self, url=None, maxsize=100):
+        self.maxsize = maxsize
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        subscription = queue.Queue(self.maxsize)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, channel, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscribers.pop(channel, None)
+
+    def has_subscribers(self, channel):
+        return channel in self._subscribers
+
+    def publish(self, channel, message):
+        self._deliver(channel, message)
+
+    def _deliver(self, channel, message):
+        with self._lock:
+            subscriptions = list(self._subscribers.get(channel, ()))
+        for subscription in subscriptions:
+            while True:
+                try:
+                    subscription.put_nowait(message)
+                    break
+                except queue.Full:
+                    try:
+                        subscription.get_nowait()
+                    except queue.Empty:
+                        pass
+
+
+class RedisBroker(LocalBroker):
+    """通过 Redis 的发布订阅在多个进程间共享事件，需要安装 redis。"""
+
+    prefix = 'albumy:'
+
+    def __init__(self, url=None, maxsize=100):
+        import redis
+
+        super().__init__(url, maxsize)
+        self._redis = redis.Redis.from_url(url)
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(**{self.prefix + '*': self._on_message})
+        self._thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def has_subscribers(self, channel):
+        # 其他进程中可能有订阅者
+        return True
+
+    def publish(self, channel, message):
+        self._redis.publish(self.prefix + channel, json.dumps(message))
+
+    def _on_message(self, item):
+        channel = item['channel'].decode()[len(self.prefix):]
+        self._deliver(channel, json.loads(item['data']))
+
+
+def get_broker():
+    broker = current_app.extensions.get('albumy_broker')
+    if broker is None:
+        broker_class = import_string(current_app.config['ALBUMY_EVENT_BROKER'])
+        broker = current_app.extensions.setdefault('albumy_broker',
+                                                   broker_class(current_app.config['ALBUMY_EVENT_BROKER_URL']))
+    return broker
+
+
+def user_channel(user_id):
+    return 'user:%d' % user_id
+
+
+def publish_notification_event(user_id, message=None):
+    """Publish the unread count of a user, plus the notification ``message`` if given."""
+    from albumy.models import User
+
+    broker = get_broker()
+    channel = user_channel(user_id)
+    if not broker.has_subscribers(channel):
+        return
+    count = User.query.with_entities(User.unread_notification_count).filter_by(id=user_id).scalar()
+    if message is not None:
+        broker.publish(channel, {'event': 'notification', 'message': message, 'count': count})
+    else:
+        broker.publish(channel, {'event': 'count', 'count': count})
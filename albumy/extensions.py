@@ -26,7 +26,7 @@ whooshee = Whooshee()
 @login_manager.user_loader
 def load_user(user_id):
     from albumy.models import User
-    user = User.query.get(int(user_id))
+    user = User.get_cached(int(user_id))
     return user
 
 
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import time
+
+import whoosh.index
+from flask import current_app
+from whoosh.writing import CLEAR
+
+from albumy.background import BackgroundThread
+from albumy.extensions import db, whooshee
+
+
+def _search_indexes():
+    """Return ``{table: (model, whoosheer, fields)}`` for the models registered with Whooshee."""
+    indexes = {}
+    for whoosheer in whooshee.whoosheers:
+        model = whoosheer.models[0]
+        indexes[model.__tablename__] = (model, whoosheer, [name for name in whoosheer.schema.names() if name != 'id'])
+    return indexes
+
+
+def _document(row, fields):
+    return dict(id=row.id, **{field: '' if row[i + 1] is None else str(row[i + 1]) for i, field in enumerate(fields)})
+
+
+def _writer(index):
+    return index.writer(timeout=current_app.extensions['whooshee']['writer_timeout'])
+
+
+def apply_search_changes(limit=500):
+    """Apply up to ``limit`` logged changes to the Whoosh indexes and return the number applied.
+
+    Rows are read again when applied, so repeated changes of a row in a batch are indexed once.
+    Changes stay in the log if an index is locked, and are applied by a later call.
+    """
+    from albumy.models import SearchChange
+
+    app = current_app._get_current_object()
+    indexes = _search_indexes()
+    with db.engine.begin() as connection:
+        changes = connection.execute(db.select(SearchChange.id, SearchChange.category, SearchChange.target_id).
+                                     order_by(SearchChange.id).limit(limit)).all()
+        for category in {change.category for change in changes}:
+            model, whoosheer, fields = indexes[category]
+            target_ids = {change.target_id for change in changes if change.category == category}
+            rows = connection.execute(db.select(model.id, *[getattr(model, field) for field in fields]).
+                                      where(model.id.in_(target_ids))).all()
+            # 一批变更只打开一次写入器、提交一次；update_document 每次都会打开新的 searcher，
+            # 这里先用同一个 searcher 删除旧文档再全部添加
+            with _writer(whooshee.get_or_create_index(app, whoosheer)) as writer:
+                with writer.searcher() as searcher:
+                    for target_id in target_ids:
+                        writer.delete_by_term('id', target_id, searcher=searcher)
+                for row in rows:
+                    writer.add_document(**_document(row, fields))
+        if changes:
+            connection.execute(SearchChange.__table__.delete().
+                               where(SearchChange.id.in_([change.id for change in changes])))
+    return len(changes)
+
+
+class SearchIndexer(BackgroundThread):
+    """在后台线程中应用 SearchChange 记录的变更，提交后被唤醒，稍等片刻把同一时间的变更合并为一批。"""
+
+    name = 'search-indexer'
+
+    def interval(self, app):
+        # 空闲时也定期检查，应用因索引被锁定而留下的变更
+        return app.config['ALBUMY_SEARCH_INDEX_INTERVAL']
+
+    def work(self, app, woken):
+        if woken and not self.sleep(app.config['ALBUMY_SEARCH_INDEX_DELAY']):
+            return
+        try:
+            while apply_search_changes():
+                pass
+        except whoosh.index.LockError:
+            app.logger.info('The search index is locked, the changes will be applied later.')
+
+
+search_indexer = SearchIndexer()
+
+
+def reindex(workers, batch_size=1000):
+    """Rebuild the Whoosh indexes with ``workers`` processes and return ``(rows, seconds)``.
+
+    Rows are read by id ranges of ``batch_size`` and handed to Whoosh's multiprocess writer, whose
+    sub-writers each produce a segment. The commit replaces all the old segments with the new ones
+    in one table-of-contents write, so searches use the old index until the new one is complete.
+    The live index stays locked meanwhile; changes made during the rebuild wait in the log.
+    """
+    app = current_app._get_current_object()
+    # 内存中的索引无法在进程间共享
+    if app.extensions['whooshee']['memory_storage']:
+        workers = 1
+    started = time.perf_counter()
+    total = 0
+    for model, whoosheer, fields in _search_indexes().values():
+        index = whooshee.get_or_create_index(app, whoosheer)
+        if workers > 1:
+            # multisegment 不合并子进程写出的段，合并的代价比并行建立索引还高
+            writer = index.writer(procs=workers, batchsize=batch_size, multisegment=True,
+                                  timeout=app.extensions['whooshee']['writer_timeout'])
+        else:
+            writer = _writer(index)
+        try:
+            last_id = 0
+            while True:
+                rows = db.session.execute(db.select(model.id, *[getattr(model, field) for field in fields]).
+                                          where(model.id > last_id).order_by(model.id).limit(batch_size)).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                for row in rows:
+                    writer.add_document(**_document(row, fields))
+                total += len(rows)
+            # CLEAR 丢弃旧的段，只保留这次写入的段
+            writer.commit(mergetype=CLEAR)
+        except BaseException:
+            writer.cancel()
+            raise
+    return total, time.perf_counter() - started
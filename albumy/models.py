@@ -1,13 +1,26 @@
 # -*- codeing = utf-8 -*-
+import math
 import os
-from datetime import datetime
+import sqlite3
+import time
+from datetime import datetime, timedelta
 
 from flask import current_app
 from flask_avatars import Identicon
 from flask_login import UserMixin
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from albumy.autocomplete import get_autocomplete
+from albumy.caching import TTLCache
+from albumy.events import publish_notification_event
 from albumy.extensions import db, whooshee
+from albumy.indexing import search_indexer, apply_search_changes
+from albumy.pagination import keyset_paginate
+from albumy.storage import shard_path, move_to_shard, delete_sweeper
 
 roles_permissions = db.Table('roles_permissions',
                              db.Column('role_id', db.Integer, db.ForeignKey('role.id')),
@@ -22,7 +35,7 @@ tagging = db.Table('tagging',
 
 class Follow(db.Model):
     follower_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
-    followed_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    followed_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True, index=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     # follower 指的是粉丝，followed指的是关注的人
     follower = db.relationship('User', foreign_keys=[follower_id], back_populates='following', lazy='joined')
@@ -32,14 +45,15 @@ class Follow(db.Model):
 @whooshee.register_model('name', 'username')
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(20), unique=True, index=True)
+    # active_history: 对象过期后改名也会加载旧值，自动补全索引需要旧名称
+    username = db.column_property(db.Column(db.String(20), unique=True, index=True), active_history=True)
     email = db.Column(db.String(254), unique=True, index=True)
     password_hash = db.Column(db.String(128))
     name = db.Column(db.String(30))
     website = db.Column(db.String(255))
     bio = db.Column(db.String(120))
     location = db.Column(db.String(50))
-    member_since = db.Column(db.DateTime(), default=datetime.utcnow)
+    member_since = db.Column(db.DateTime(), default=datetime.utcnow, index=True)
     avatar_s = db.Column(db.String(64))
     avatar_m = db.Column(db.String(64))
     avatar_l = db.Column(db.String(64))
@@ -60,15 +74,23 @@ class User(db.Model, UserMixin):
                                 cascade='all')
     
     notifications = db.relationship('Notification', back_populates='receiver', cascade='all')
+    # 未读通知计数，推送通知时加一，标记已读时减一或清零，避免每次渲染页面都执行 COUNT
+    unread_notification_count = db.Column(db.Integer, default=0, nullable=False)
+    
+    # 进程内的身份缓存：{用户 id: 用户表字段快照}，load_user 命中时不再查询数据库
+    _identity_cache = TTLCache(maxsize=4096)
     receive_comment_notification = db.Column(db.Boolean, default=True)
     receive_follow_notification = db.Column(db.Boolean, default=True)
     receive_collect_notification = db.Column(db.Boolean, default=True)
     
     show_collections = db.Column(db.Boolean, default=True)
+    # 粉丝数超过 ALBUMY_TIMELINE_FANOUT_LIMIT 的用户不再写扩散，首页读取时再合并其图片
+    fanout_on_read = db.Column(db.Boolean, default=False)
     
     @property
     def is_admin(self):
-        return self.role.name == 'Administrator'
+        role = Role.get_cached(self.role_id)
+        return role is not None and role[0] == 'Administrator'
     
     @property
     def is_active(self):
@@ -93,21 +115,21 @@ class User(db.Model, UserMixin):
                 self.role = Role.query.filter_by(name='Administrator').first()
             else:
                 self.role = Role.query.filter_by(name='User').first()
-            db.session.commit()
     
     def generate_avatar(self):
         avatar = Identicon()
-        filenames = avatar.generate(text=self.username)
+        filenames = [move_to_shard(current_app.config['AVATARS_SAVE_PATH'], filename)
+                     for filename in avatar.generate(text=self.username)]
         self.avatar_s = filenames[0]
         self.avatar_m = filenames[1]
         self.avatar_l = filenames[2]
         db.session.commit()
     
     def can(self, permission_name):
-        permission = Permission.query.filter_by(name=permission_name).first()
-        return permission is not None and \
-            self.role is not None and \
-            permission in self.role.permissions
+        # 权限编译为角色的位掩码并缓存在进程内，这里只做一次整数与运算
+        role = Role.get_cached(self.role_id)
+        bit = Role.permission_bits().get(permission_name)
+        return role is not None and bit is not None and role[1] & bit == bit
     
     def collect(self, photo):
         if not self.is_collecting(photo):
@@ -130,12 +152,14 @@ class User(db.Model, UserMixin):
             follow = Follow(follower=self, followed=user)
             db.session.add(follow)
             db.session.commit()
+            Timeline.backfill(self, user)
     
     def unfollow(self, user):
         follow = self.following.filter_by(followed_id=user.id).first()
         if follow:
             db.session.delete(follow)
             db.session.commit()
+            Timeline.prune(self, user)
     
     def is_following(self, user):
         if user.id is None:  # when follow self, user.id will be None
@@ -145,22 +169,62 @@ class User(db.Model, UserMixin):
     def is_followed_by(self, user):
         return self.followers.filter_by(follower_id=user.id).first() is not None
     
+    # 锁定和封禁只修改属性，由调用者提交；身份缓存在 after_update 事件中清除
     def lock(self):
         self.locked = True
-        self.role = Role.query.filter_by(name='locked').first()
-        db.session.commit()
+        self.role = Role.query.filter_by(name='Locked').first()
     
     def unlock(self):
         self.locked = False
+        # 重新分配默认角色，管理员邮箱对应的账户恢复为 Administrator
+        self.role = None
         self.set_role()
     
     def block(self):
         self.active = False
-        db.session.commit()
     
     def unblock(self):
         self.active = True
+    
+    @staticmethod
+    def get_cached(user_id):
+        row = User._identity_cache.get(user_id)
+        if row is None:
+            user = db.session.get(User, user_id)
+            if user is not None:
+                row = {attr.key: getattr(user, attr.key) for attr in User.__mapper__.column_attrs}
+                User._identity_cache.set(user_id, row, current_app.config['ALBUMY_IDENTITY_CACHE_TTL'])
+            return user
+        # 用快照构造一个已持久化状态的对象并合并进会话，load=False 时不会发出 SELECT
+        user = User.__mapper__.class_manager.new_instance()
+        for key, value in row.items():
+            set_committed_value(user, key, value)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+    
+    @staticmethod
+    def clear_cached(user_id=None):
+        if user_id is None:
+            User._identity_cache.clear()
+        else:
+            User._identity_cache.pop(user_id)
+    
+    @staticmethod
+    def adjust_unread_notification_count(user_id, delta):
+        db.session.execute(db.update(User).where(User.id == user_id).
+                           values(unread_notification_count=User.unread_notification_count + delta))
+        User.clear_cached(user_id)
+    
+    @staticmethod
+    def reconcile_unread_notification_count():
+        unread_count = db.select(db.func.count()). \
+            where(Notification.receiver_id == User.id, Notification.is_read == False). \
+            scalar_subquery()
+        drifted = User.query.filter(User.unread_notification_count != unread_count). \
+            update({User.unread_notification_count: unread_count}, synchronize_session=False)
         db.session.commit()
+        User.clear_cached()
+        return drifted
     
     @staticmethod
     def init_role_permission():
@@ -181,6 +245,49 @@ class Role(db.Model):
     permissions = db.relationship('Permission', secondary=roles_permissions, back_populates='roles')
     users = db.relationship('User', back_populates='role')
     
+    # 进程内的角色权限缓存：(过期时间, {权限名: 位}, {角色 id: (角色名, 权限位掩码)})
+    _permission_cache = None
+    
+    @staticmethod
+    def _load_permission_cache():
+        permission_bits = {name: 1 << permission_id
+                           for permission_id, name in db.session.query(Permission.id, Permission.name)}
+        roles = {}
+        rows = db.session.query(Role.id, Role.name, Permission.name). \
+            outerjoin(roles_permissions, roles_permissions.c.role_id == Role.id). \
+            outerjoin(Permission, Permission.id == roles_permissions.c.permission_id)
+        for role_id, role_name, permission_name in rows:
+            name, mask = roles.get(role_id, (role_name, 0))
+            roles[role_id] = (name, mask | permission_bits.get(permission_name, 0))
+        expires = time.time() + current_app.config['ALBUMY_PERMISSION_CACHE_TTL']
+        Role._permission_cache = (expires, permission_bits, roles)
+        return Role._permission_cache
+    
+    @staticmethod
+    def _get_permission_cache():
+        cache = Role._permission_cache
+        if cache is None or cache[0] < time.time():
+            cache = Role._load_permission_cache()
+        return cache
+    
+    @staticmethod
+    def permission_bits():
+        return Role._get_permission_cache()[1]
+    
+    @staticmethod
+    def get_cached(role_id):
+        if role_id is None:
+            return None
+        roles = Role._get_permission_cache()[2]
+        if role_id not in roles:
+            # 其他进程新建的角色
+            roles = Role._load_permission_cache()[2]
+        return roles.get(role_id)
+    
+    @staticmethod
+    def clear_permission_cache():
+        Role._permission_cache = None
+    
     @staticmethod
     def init_role():
         roles_permissions_map = {
@@ -203,6 +310,7 @@ class Role(db.Model):
                     db.session.add(permission)
                 role.permissions.append(permission)
         db.session.commit()
+        Role.clear_permission_cache()
 
 
 class Permission(db.Model):
@@ -216,10 +324,10 @@ class Permission(db.Model):
 class Photo(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.String(255))
-    filename = db.Column(db.String(64))
+    filename = db.Column(db.String(64), index=True)
     filename_s = db.Column(db.String(64))
     filename_m = db.Column(db.String(64))
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     can_comment = db.Column(db.Boolean, default=True)
     flag = db.Column(db.Integer, default=0)
     
@@ -230,17 +338,154 @@ class Photo(db.Model):
     tags = db.relationship('Tag', back_populates='photos', secondary=tagging)
     
     collectors = db.relationship('Collect', back_populates='collected', cascade='all')
+    # 收藏数和评论数由 Collect 和 Comment 的插入/删除事件原子地更新
+    collectors_count = db.Column(db.Integer, default=0, nullable=False)
+    comments_count = db.Column(db.Integer, default=0, nullable=False)
+    # 异步生成缩略图完成前为 False，此时 filename_s 和 filename_m 指向原图
+    derivatives_ready = db.Column(db.Boolean, default=True, nullable=False)
+    # 按内容去重的文件，早于去重功能上传的图片没有 blob
+    blob_id = db.Column(db.Integer, db.ForeignKey('blob.id'), index=True)
+    blob = db.relationship('Blob', back_populates='photos')
     
-    @property
-    def collectors_count(self):
-        return len(self.collectors)
+    # 只索引被举报的图片，审核队列的查询和计数不随图片总数增长
+    __table_args__ = (db.Index('ix_photo_flagged', 'flag', 'id',
+                               sqlite_where=db.text('flag > 0'), postgresql_where=db.text('flag > 0')),)
+    
+    @staticmethod
+    def reconcile_counters():
+        collectors_count = db.select(db.func.count()). \
+            where(Collect.collected_id == Photo.id). \
+            scalar_subquery()
+        comments_count = db.select(db.func.count()). \
+            where(Comment.photo_id == Photo.id). \
+            scalar_subquery()
+        drifted = Photo.query.filter(db.or_(Photo.collectors_count != collectors_count,
+                                            Photo.comments_count != comments_count)). \
+            update({Photo.collectors_count: collectors_count, Photo.comments_count: comments_count},
+                   synchronize_session=False)
+        db.session.commit()
+        return drifted
 
 
 @whooshee.register_model('name')
 class Tag(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(30), unique=True)
+    # 同 User.username，改名时总是加载旧名称
+    name = db.column_property(db.Column(db.String(30), unique=True), active_history=True)
     photos = db.relationship('Photo', back_populates='tags', secondary=tagging)
+    popularity = db.relationship('TagPopularity', back_populates='tag', uselist=False, cascade='all')
+    
+    def __init__(self, **kwargs):
+        super(Tag, self).__init__(**kwargs)
+        if self.popularity is None:
+            self.popularity = TagPopularity()
+
+
+class TagPopularity(db.Model):
+    # 热门标签排行：每个标签的图片数量及随时间衰减的热度，随标签增删增量更新
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'), primary_key=True)
+    photo_count = db.Column(db.Integer, default=0, nullable=False)
+    # 热度为 log2(sum(2 ** ((图片时间 - HOT_EPOCH) / 半衰期)))，统一衰减不改变排序，所以只需累加；
+    # 以对数保存，指数随时间增长也不会溢出。数据库需要支持 ln 和 exp（SQLite 3.35 起内置）
+    hot_score = db.Column(db.Float, default=-1e9, nullable=False)
+    
+    tag = db.relationship('Tag', back_populates='popularity')
+    
+    __table_args__ = (
+        db.Index('ix_tag_popularity_photo_count', 'photo_count', 'tag_id'),
+        db.Index('ix_tag_popularity_hot_score', 'hot_score', 'tag_id'),
+    )
+    
+    HOT_EPOCH = datetime(2020, 1, 1)
+    # 没有图片时的热度，相当于 log2(0)
+    EMPTY_SCORE = -1e9
+    
+    @staticmethod
+    def hot_weight(timestamp):
+        """Return the weight of a photo taken at ``timestamp`` in log space."""
+        half_life = current_app.config['ALBUMY_TAG_HOT_HALF_LIFE']
+        if not half_life:
+            return 0
+        return (timestamp - TagPopularity.HOT_EPOCH).total_seconds() / half_life
+    
+    @staticmethod
+    def add_scores(score, weight):
+        # log2(2 ** score + 2 ** weight)，提出较大的一项，剩下的部分不会溢出
+        high, low = max(score, weight), min(score, weight)
+        return high + math.log2(1 + 2 ** (low - high))
+    
+    @staticmethod
+    def _log2_1p(exponent):
+        # log2(1 + 2 ** exponent)，exponent <= 0；太小时结果在浮点精度内为 0，跳过 exp 以免下溢报错
+        return db.case((exponent < -60, 0.0),
+                       else_=db.func.ln(1 + db.func.exp(exponent * math.log(2))) / math.log(2))
+    
+    @staticmethod
+    def add_score_clause(score, weight):
+        """Return the SQL expression of ``score`` with ``weight`` added, both in log space."""
+        return db.case((score >= weight, score + TagPopularity._log2_1p(weight - score)),
+                       else_=weight + TagPopularity._log2_1p(score - weight))
+    
+    @staticmethod
+    def subtract_score_clause(score, weight):
+        """Return the SQL expression of ``score`` with ``weight`` removed, both in log space."""
+        exponent = weight - score
+        # 减去全部热度或浮点误差使结果不为正时视为没有图片，剩余的图片数量由 photo_count 记录
+        remaining = score + db.func.ln(1 - db.func.exp(exponent * math.log(2))) / math.log(2)
+        return db.case((exponent < -60, score), (exponent < -1e-9, remaining), else_=TagPopularity.EMPTY_SCORE)
+    
+    @staticmethod
+    def adjust(tag_ids, photo, delta):
+        # 返回更新语句，视图中用 db.session 执行，flush 事件中用 connection 执行；delta 为 1 或 -1
+        weight = TagPopularity.hot_weight(photo.timestamp)
+        if delta > 0:
+            hot_score = TagPopularity.add_score_clause(TagPopularity.hot_score, weight)
+        else:
+            hot_score = TagPopularity.subtract_score_clause(TagPopularity.hot_score, weight)
+        return db.update(TagPopularity). \
+            where(TagPopularity.tag_id.in_(tag_ids)). \
+            values(photo_count=TagPopularity.photo_count + delta, hot_score=hot_score)
+    
+    @staticmethod
+    def top(limit):
+        if current_app.config['ALBUMY_TAG_RANKING'] == 'hot':
+            order_by = (TagPopularity.hot_score.desc(), TagPopularity.tag_id.desc())
+        else:
+            order_by = (TagPopularity.photo_count.desc(), TagPopularity.tag_id.desc())
+        return Tag.query. \
+            join(Tag.popularity). \
+            options(db.contains_eager(Tag.popularity)). \
+            filter(TagPopularity.photo_count > 0). \
+            order_by(*order_by). \
+            limit(limit)
+    
+    @staticmethod
+    def rebuild():
+        for tag in Tag.query.filter(~Tag.popularity.has()):
+            tag.popularity = TagPopularity()
+        db.session.flush()
+        scores = {}
+        rows = db.session.execute(db.select(tagging.c.tag_id, Photo.timestamp).
+                                  join(Photo, Photo.id == tagging.c.photo_id))
+        for tag_id, timestamp in rows:
+            count, score = scores.get(tag_id, (0, TagPopularity.EMPTY_SCORE))
+            scores[tag_id] = (count + 1, TagPopularity.add_scores(score, TagPopularity.hot_weight(timestamp)))
+        for popularity in TagPopularity.query:
+            popularity.photo_count, popularity.hot_score = scores.get(popularity.tag_id,
+                                                                      (0, TagPopularity.EMPTY_SCORE))
+        db.session.commit()
+
+
+@db.event.listens_for(Engine, 'connect')
+def add_sqlite_math_functions(dbapi_connection, connection_record):
+    # 热度的更新语句用到 ln 和 exp，没有编译数学函数（SQLITE_ENABLE_MATH_FUNCTIONS）的 SQLite 由 Python 提供
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    try:
+        dbapi_connection.execute('SELECT ln(1), exp(0)')
+    except sqlite3.OperationalError:
+        dbapi_connection.create_function('ln', 1, math.log, deterministic=True)
+        dbapi_connection.create_function('exp', 1, math.exp, deterministic=True)
 
 
 class Collect(db.Model):
@@ -273,6 +518,134 @@ class Comment(db.Model):
     replies = db.relationship('Comment', back_populates='replied', cascade='all')
     # remote_side=[id]的意思是，这个replied属性指向的是Comment表中的id字段
     replied = db.relationship('Comment', back_populates='replies', remote_side=[id])
+    
+    __table_args__ = (db.Index('ix_comment_flagged', 'flag', 'id',
+                               sqlite_where=db.text('flag > 0'), postgresql_where=db.text('flag > 0')),)
+
+
+class Report(db.Model):
+    """用户对图片或评论的举报，每个用户对同一目标只记录一次，目标的 flag 为举报的人数。"""
+    id = db.Column(db.Integer, primary_key=True)
+    reporter_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # photo 或 comment
+    target_type = db.Column(db.String(10), nullable=False)
+    target_id = db.Column(db.Integer, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.UniqueConstraint('reporter_id', 'target_type', 'target_id', name='uq_report_reporter_target'),
+                      db.Index('ix_report_target', 'target_type', 'target_id'))
+    
+    @staticmethod
+    def add(reporter, target):
+        """Record a report of ``target`` by ``reporter``; return False if they have reported it before."""
+        model = type(target)
+        try:
+            with db.session.begin_nested():
+                db.session.add(Report(reporter_id=reporter.id, target_type=target.__tablename__, target_id=target.id))
+        except IntegrityError:
+            return False
+        # 在数据库中原子地加一，并发的举报不会互相覆盖
+        model.query.filter_by(id=target.id).update({model.flag: model.flag + 1}, synchronize_session=False)
+        return True
+    
+    @staticmethod
+    def delete_for(connection, target_type, target_ids):
+        # target_ids 可以是 id 列表，也可以是查询 id 的子查询
+        connection.execute(Report.__table__.delete().
+                           where(Report.target_type == target_type, Report.target_id.in_(target_ids)))
+
+
+class Timeline(db.Model):
+    # 首页时间线：上传图片时写入所有粉丝的时间线，首页只需读取自己的一段索引范围
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    photo_id = db.Column(db.Integer, db.ForeignKey('photo.id'), primary_key=True, index=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_timeline_user_timestamp', 'user_id', 'timestamp', 'photo_id'),
+        db.Index('ix_timeline_user_author', 'user_id', 'author_id'),
+    )
+    
+    @staticmethod
+    def fan_out(photo):
+        author = photo.author
+        if not author.fanout_on_read:
+            followers_count = Follow.query.filter_by(followed_id=author.id).count()
+            if followers_count > current_app.config['ALBUMY_TIMELINE_FANOUT_LIMIT']:
+                author.fanout_on_read = True
+            else:
+                select = db.select(Follow.follower_id,
+                                   db.literal(photo.id),
+                                   db.literal(author.id),
+                                   db.literal(photo.timestamp, db.DateTime)). \
+                    where(Follow.followed_id == author.id)
+                db.session.execute(Timeline.__table__.insert().from_select(
+                    ['user_id', 'photo_id', 'author_id', 'timestamp'], select))
+        db.session.commit()
+    
+    @staticmethod
+    def backfill(follower, followed):
+        # 大V的图片在读取时合并，不需要回填
+        if followed.fanout_on_read:
+            return
+        select = db.select(db.literal(follower.id), Photo.id, Photo.author_id, Photo.timestamp). \
+            where(Photo.author_id == followed.id). \
+            order_by(Photo.timestamp.desc()). \
+            limit(current_app.config['ALBUMY_TIMELINE_BACKFILL'])
+        db.session.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'photo_id', 'author_id', 'timestamp'], select))
+        db.session.commit()
+    
+    @staticmethod
+    def prune(follower, followed):
+        Timeline.query.filter_by(user_id=follower.id, author_id=followed.id).delete()
+        db.session.commit()
+    
+    @staticmethod
+    def feed_query(user):
+        return Timeline._feed(user)[0]
+    
+    @staticmethod
+    def paginate_feed(user, per_page, cursor=None):
+        query, columns = Timeline._feed(user)
+        return keyset_paginate(query, columns, key=lambda photo: (photo.timestamp, photo.id),
+                               per_page=per_page, cursor=cursor)
+    
+    @staticmethod
+    def _feed(user):
+        fanout_on_read_ids = db.select(Follow.followed_id). \
+            join(User, User.id == Follow.followed_id). \
+            where(Follow.follower_id == user.id, User.fanout_on_read == True)
+        if not db.session.query(fanout_on_read_ids.exists()).scalar():
+            columns = (Timeline.timestamp, Timeline.photo_id)
+            query = Photo.query. \
+                join(Timeline, Timeline.photo_id == Photo.id). \
+                filter(Timeline.user_id == user.id)
+        else:
+            # 关注了大V时，时间线与大V的图片在读取时合并
+            columns = (Photo.timestamp, Photo.id)
+            timeline_ids = db.select(Timeline.photo_id).where(Timeline.user_id == user.id)
+            query = Photo.query. \
+                filter(db.or_(Photo.id.in_(timeline_ids), Photo.author_id.in_(fanout_on_read_ids)))
+        return query.order_by(*[column.desc() for column in columns]), columns
+    
+    @staticmethod
+    def rebuild():
+        limit = current_app.config['ALBUMY_TIMELINE_FANOUT_LIMIT']
+        followers_count = db.select(db.func.count()). \
+            where(Follow.followed_id == User.id). \
+            scalar_subquery()
+        User.query.update({User.fanout_on_read: followers_count > limit}, synchronize_session=False)
+        User.clear_cached()
+        Timeline.query.delete()
+        select = db.select(Follow.follower_id, Photo.id, Photo.author_id, Photo.timestamp). \
+            join(Photo, Photo.author_id == Follow.followed_id). \
+            join(User, User.id == Photo.author_id). \
+            where(User.fanout_on_read == False)
+        db.session.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'photo_id', 'author_id', 'timestamp'], select))
+        db.session.commit()
 
 
 class Notification(db.Model):
@@ -282,23 +655,529 @@ class Notification(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     receiver = db.relationship('User', back_populates='notifications')
+    # 同一接收者、类型和对象的未读通知在一段时间内合并为一条，actor 为最近一次操作的用户
+    kind = db.Column(db.String(20))
+    target_id = db.Column(db.Integer)
+    actor_id = db.Column(db.Integer)
+    actor_count = db.Column(db.Integer, default=1, nullable=False)
+    actors = db.relationship('NotificationActor', cascade='all')
+    
+    __table_args__ = (db.Index('ix_notification_receiver_read_timestamp', 'receiver_id', 'is_read', 'timestamp'),
+                      db.Index('ix_notification_coalesce', 'receiver_id', 'kind', 'target_id', 'is_read'))
+    
+    @staticmethod
+    def mark_read(user_id, notification_ids=None):
+        """Mark the unread notifications of a user as read, only those in ``notification_ids``
+        if given, and return how many were changed.
+        """
+        query = Notification.query.filter_by(receiver_id=user_id, is_read=False)
+        if notification_ids is not None:
+            query = query.filter(Notification.id.in_(notification_ids))
+        read = query.update({Notification.is_read: True}, synchronize_session=False)
+        # 按实际更新的行数调整计数，期间新推送的通知不受影响
+        if read:
+            User.adjust_unread_notification_count(user_id, -read)
+        db.session.commit()
+        if read:
+            publish_notification_event(user_id)
+        return read
+    
+    @staticmethod
+    def delete_all(user_id, before=None, read_only=True):
+        """Delete the read notifications of a user, or all of them without ``read_only``, only those
+        older than ``before`` if given, and return how many were deleted.
+        """
+        query = Notification.query.filter_by(receiver_id=user_id)
+        if before is not None:
+            query = query.filter(Notification.timestamp < before)
+        
+        def delete(is_read):
+            selected = query.filter_by(is_read=is_read)
+            NotificationActor.query.filter(NotificationActor.notification_id.in_(
+                selected.with_entities(Notification.id).scalar_subquery())).delete(synchronize_session=False)
+            return selected.delete(synchronize_session=False)
+        
+        deleted = delete(True)
+        if not read_only:
+            unread = delete(False)
+            if unread:
+                User.adjust_unread_notification_count(user_id, -unread)
+            deleted += unread
+        db.session.commit()
+        if not read_only and unread:
+            publish_notification_event(user_id)
+        return deleted
+
+
+class NotificationActor(db.Model):
+    """合并通知的操作者，每个用户只记录一次，用来统计不重复的操作人数。"""
+    notification_id = db.Column(db.Integer, db.ForeignKey('notification.id'), primary_key=True)
+    actor_id = db.Column(db.Integer, primary_key=True)
+    
+    @staticmethod
+    def add(notification_id, actor_id):
+        """Record ``actor_id`` as an actor of the notification; return False if it was recorded before."""
+        try:
+            with db.session.begin_nested():
+                db.session.add(NotificationActor(notification_id=notification_id, actor_id=actor_id))
+        except IntegrityError:
+            return False
+        return True
+
+
+class Blob(db.Model):
+    """按内容哈希保存的上传文件，内容相同的图片共用一份原图和缩略图，引用数归零时才删除文件。"""
+    id = db.Column(db.Integer, primary_key=True)
+    hash = db.Column(db.String(40), unique=True, nullable=False)
+    filename = db.Column(db.String(64))
+    filename_s = db.Column(db.String(64))
+    filename_m = db.Column(db.String(64))
+    derivatives_ready = db.Column(db.Boolean, default=True, nullable=False)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    photos = db.relationship('Photo', back_populates='blob')
+    
+    @staticmethod
+    def acquire(content_hash, ext, path):
+        """Return ``(blob, created)`` for the file at ``path`` with one more reference taken.
+
+        A new blob takes over ``path`` as its original; otherwise ``path`` is a duplicate and is removed.
+        """
+        filename = shard_path(content_hash + ext)
+        target = os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename)
+        # 先取得引用再删除重复的文件；引用数为 0 的 blob 正在被删除，改为新建
+        taken = Blob._take(Blob.hash == content_hash, Blob.ref_count > 0)
+        while not taken:
+            if path != target:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(path, target)
+                path = target
+            try:
+                with db.session.begin_nested():
+                    blob = Blob(hash=content_hash, filename=filename, filename_s=filename, filename_m=filename,
+                                ref_count=1)
+                    db.session.add(blob)
+                return blob, True
+            except IntegrityError:
+                # 另一个请求同时上传了相同内容，或者同一个 blob 还没删除完；删除语句以引用数为条件，
+                # 这里取得引用后它就不会被删除，行已经不存在时再次新建
+                taken = Blob._take(Blob.hash == content_hash)
+        blob = Blob.query.filter_by(hash=content_hash).one()
+        if path != os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], blob.filename) and os.path.exists(path):
+            os.remove(path)
+        return blob, False
+    
+    @staticmethod
+    def _take(*conditions):
+        return db.session.execute(db.update(Blob).where(*conditions).values(ref_count=Blob.ref_count + 1)).rowcount
+
+
+class DerivativeJob(db.Model):
+    """为上传的图片生成缩略图的任务，由 flask albumy-worker 领取执行，成功后删除。"""
+    id = db.Column(db.Integer, primary_key=True)
+    # pending: 等待执行，running: 已被 worker 领取，failed: 重试次数用尽
+    status = db.Column(db.String(10), default='pending', nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    run_after = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    blob_id = db.Column(db.Integer, db.ForeignKey('blob.id'), index=True)
+    blob = db.relationship('Blob')
+    
+    __table_args__ = (db.Index('ix_derivative_job_status_run_after', 'status', 'run_after'),)
+    
+    @staticmethod
+    def _claimable(now):
+        stale = now - timedelta(seconds=current_app.config['ALBUMY_JOB_TIMEOUT'])
+        return db.or_(db.and_(DerivativeJob.status == 'pending', DerivativeJob.run_after <= now),
+                      db.and_(DerivativeJob.status == 'running', DerivativeJob.locked_at < stale))
+    
+    @staticmethod
+    def claim(limit):
+        now = datetime.utcnow()
+        job_ids = db.session.scalars(db.select(DerivativeJob.id).where(DerivativeJob._claimable(now)).
+                                     order_by(DerivativeJob.run_after).limit(limit)).all()
+        claimed = []
+        for job_id in job_ids:
+            # 带着领取条件更新，多个 worker 同时领取同一个任务时只有一个能成功
+            if DerivativeJob.query.filter(DerivativeJob.id == job_id, DerivativeJob._claimable(now)). \
+                    update({DerivativeJob.status: 'running', DerivativeJob.locked_at: now,
+                            DerivativeJob.attempts: DerivativeJob.attempts + 1}, synchronize_session=False):
+                claimed.append(job_id)
+        db.session.commit()
+        return DerivativeJob.query.filter(DerivativeJob.id.in_(claimed)).all() if claimed else []
+    
+    @staticmethod
+    def complete(job_id, blob_id, filenames):
+        sizes = current_app.config['ALBUMY_PHOTO_SIZE']
+        blob = db.session.get(Blob, blob_id)
+        if blob is None:
+            # 生成期间引用这份文件的图片都已被删除
+            PendingDelete.record(db.session, 'photo', filenames.values())
+            db.session.commit()
+            return
+        blob.filename_s = filenames[sizes['small']]
+        blob.filename_m = filenames[sizes['medium']]
+        blob.derivatives_ready = True
+        Photo.query.filter_by(blob_id=blob_id). \
+            update({Photo.filename_s: blob.filename_s, Photo.filename_m: blob.filename_m,
+                    Photo.derivatives_ready: True}, synchronize_session=False)
+        DerivativeJob.query.filter_by(id=job_id).delete()
+        db.session.commit()
+    
+    @staticmethod
+    def fail(job_id, error):
+        job = db.session.get(DerivativeJob, job_id)
+        if job is None:
+            return
+        job.last_error = error
+        job.locked_at = None
+        if job.attempts >= current_app.config['ALBUMY_JOB_MAX_ATTEMPTS']:
+            job.status = 'failed'
+        else:
+            job.status = 'pending'
+            delay = current_app.config['ALBUMY_JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+            job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+        db.session.commit()
+
+
+class PendingDelete(db.Model):
+    """等待删除的文件。和删除数据的操作在同一个事务中写入，回滚时文件不会被删除，提交后再由清理线程删除。"""
+    id = db.Column(db.Integer, primary_key=True)
+    # photo: 位于上传目录，avatar: 位于头像目录
+    kind = db.Column(db.String(10), nullable=False)
+    filename = db.Column(db.String(64), nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    @staticmethod
+    def directory(kind):
+        return current_app.config['AVATARS_SAVE_PATH' if kind == 'avatar' else 'ALBUMY_UPLOAD_PATH']
+    
+    @staticmethod
+    def record(connection, kind, filenames):
+        rows = [{'kind': kind, 'filename': filename, 'timestamp': datetime.utcnow()}
+                for filename in set(filenames) if filename is not None]
+        if rows:
+            connection.execute(PendingDelete.__table__.insert(), rows)
+            db.session.info['pending_deletes'] = True
+    
+    @staticmethod
+    def _referenced(connection, kind, filenames):
+        if kind == 'avatar':
+            columns = [User.avatar_s, User.avatar_m, User.avatar_l, User.avatar_raw]
+        else:
+            columns = [Photo.filename, Photo.filename_s, Photo.filename_m,
+                       Blob.filename, Blob.filename_s, Blob.filename_m]
+        referenced = set()
+        for column in columns:
+            referenced.update(connection.scalars(db.select(column).where(column.in_(filenames))))
+        return referenced
+    
+    @staticmethod
+    def sweep(limit=500):
+        """Delete the files of up to ``limit`` committed rows and return how many rows were handled."""
+        with db.engine.begin() as connection:
+            rows = connection.execute(db.select(PendingDelete.id, PendingDelete.kind, PendingDelete.filename).
+                                      order_by(PendingDelete.id).limit(limit)).all()
+            for kind in {row.kind for row in rows}:
+                filenames = {row.filename for row in rows if row.kind == kind}
+                # 按内容命名的文件可能在删除后又被重新上传，仍被引用的文件只删除记录
+                for filename in filenames - PendingDelete._referenced(connection, kind, filenames):
+                    try:
+                        os.remove(os.path.join(PendingDelete.directory(kind), filename))
+                    except FileNotFoundError:
+                        pass
+            if rows:
+                connection.execute(PendingDelete.__table__.delete().
+                                   where(PendingDelete.id.in_([row.id for row in rows])))
+        return len(rows)
+
+
+class SearchChange(db.Model):
+    """等待写入 Whoosh 索引的变更。和数据在同一事务中写入，由 indexing.search_indexer 在后台批量应用。"""
+    id = db.Column(db.Integer, primary_key=True)
+    # 被修改的表名：user、photo 或 tag
+    category = db.Column(db.String(10), nullable=False)
+    target_id = db.Column(db.Integer, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    @staticmethod
+    def record(connection, target):
+        SearchChange.record_many(connection, target.__tablename__, [target.id])
+    
+    @staticmethod
+    def record_many(connection, category, target_ids):
+        if current_app.config['ALBUMY_SEARCH_BACKEND'] != 'whooshee' or not target_ids:
+            return
+        now = datetime.utcnow()
+        connection.execute(SearchChange.__table__.insert(),
+                           [{'category': category, 'target_id': target_id, 'timestamp': now}
+                            for target_id in target_ids])
+        db.session.info['search_changes'] = True
+
+
+class OutboxMail(db.Model):
+    """待发送的邮件，由 emails.mail_queue 的发送线程领取，发送成功后删除，重启后未发送的邮件仍会被发出。"""
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(254), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    # pending: 等待发送，sending: 已被发送线程领取，failed: 重试次数用尽
+    status = db.Column(db.String(10), default='pending', nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    run_after = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.Index('ix_outbox_mail_status_run_after', 'status', 'run_after'),)
+    
+    @staticmethod
+    def _claimable(now):
+        stale = now - timedelta(seconds=current_app.config['ALBUMY_MAIL_TIMEOUT'])
+        return db.or_(db.and_(OutboxMail.status == 'pending', OutboxMail.run_after <= now),
+                      db.and_(OutboxMail.status == 'sending', OutboxMail.locked_at < stale))
+    
+    @staticmethod
+    def claim(limit, mail_ids=None):
+        """Claim up to ``limit`` due mails, only among ``mail_ids`` if given."""
+        now = datetime.utcnow()
+        query = db.select(OutboxMail.id).where(OutboxMail._claimable(now))
+        if mail_ids is not None:
+            query = query.where(OutboxMail.id.in_(mail_ids))
+        mail_ids = db.session.scalars(query.order_by(OutboxMail.run_after).limit(limit)).all()
+        claimed = []
+        for mail_id in mail_ids:
+            # 多个进程的发送线程可能同时领取同一封邮件，只有一个能更新成功
+            if OutboxMail.query.filter(OutboxMail.id == mail_id, OutboxMail._claimable(now)). \
+                    update({OutboxMail.status: 'sending', OutboxMail.locked_at: now,
+                            OutboxMail.attempts: OutboxMail.attempts + 1}, synchronize_session=False):
+                claimed.append(mail_id)
+        db.session.commit()
+        return OutboxMail.query.filter(OutboxMail.id.in_(claimed)).order_by(OutboxMail.id).all() if claimed else []
+    
+    @staticmethod
+    def sent(mail_ids):
+        if mail_ids:
+            OutboxMail.query.filter(OutboxMail.id.in_(mail_ids)).delete(synchronize_session=False)
+            db.session.commit()
+    
+    @staticmethod
+    def fail(mail_id, error):
+        outbox_mail = db.session.get(OutboxMail, mail_id)
+        if outbox_mail is None:
+            return
+        outbox_mail.last_error = error
+        outbox_mail.locked_at = None
+        if outbox_mail.attempts >= current_app.config['ALBUMY_MAIL_MAX_ATTEMPTS']:
+            outbox_mail.status = 'failed'
+        else:
+            outbox_mail.status = 'pending'
+            delay = current_app.config['ALBUMY_MAIL_RETRY_DELAY'] * 2 ** (outbox_mail.attempts - 1)
+            outbox_mail.run_after = datetime.utcnow() + timedelta(seconds=delay)
+        db.session.commit()
 
 
 @db.event.listens_for(Photo, 'after_delete', named=True)  # 这里的named=True是为了让target这个参数可以被传入
 def delete_photo(**kwargs):
     target = kwargs['target']
-    for filename in [target.filename, target.filename_s, target.filename_m]:
-        if filename is not None:
-            path = os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename)
-            if os.path.exists(path):
-                os.remove(path)
+    kwargs['connection'].execute(Timeline.__table__.delete().where(Timeline.photo_id == target.id))
+    if target.tags:
+        kwargs['connection'].execute(TagPopularity.adjust([tag.id for tag in target.tags], target, -1))
+    filenames = [target.filename, target.filename_s, target.filename_m]
+    if target.blob_id is not None:
+        connection = kwargs['connection']
+        connection.execute(db.update(Blob).where(Blob.id == target.blob_id).values(ref_count=Blob.ref_count - 1))
+        # 以引用数为条件删除，不依赖单独读取的值
+        orphaned = db.select(Blob.id).where(Blob.id == target.blob_id, Blob.ref_count <= 0)
+        connection.execute(DerivativeJob.__table__.delete().where(DerivativeJob.blob_id.in_(orphaned)))
+        if not connection.execute(Blob.__table__.delete().
+                                  where(Blob.id == target.blob_id, Blob.ref_count <= 0)).rowcount:
+            # 还有其他图片引用这份文件
+            filenames = []
+    PendingDelete.record(kwargs['connection'], 'photo', filenames)
+
+
+@db.event.listens_for(Photo, 'after_delete', named=True)
+@db.event.listens_for(Comment, 'after_delete', named=True)
+def delete_reports(**kwargs):
+    target = kwargs['target']
+    Report.delete_for(kwargs['connection'], target.__tablename__, [target.id])
+
+
+@db.event.listens_for(User, 'before_delete', named=True)
+def delete_user_reports(**kwargs):
+    # 撤销用户的举报：先减去对应的举报数再删除记录，在删除用户之前执行以满足外键约束
+    target, connection = kwargs['target'], kwargs['connection']
+    for model in (Photo, Comment):
+        reported = db.select(Report.target_id).where(Report.reporter_id == target.id,
+                                                      Report.target_type == model.__tablename__)
+        connection.execute(db.update(model).where(model.id.in_(reported), model.flag > 0).
+                           values(flag=model.flag - 1))
+    connection.execute(Report.__table__.delete().where(Report.reporter_id == target.id))
 
 
 @db.event.listens_for(User, 'after_delete', named=True)
 def delete_avatar(**kwargs):
     target = kwargs['target']
-    for filename in [target.avatar_s, target.avatar_m, target.avatar_l, target.avatar_raw]:
-        if filename is not None:
-            path = os.path.join(current_app.config['AVATARS_SAVE_PATH'], filename)
-            if os.path.exists(path):
-                os.remove(path)
+    PendingDelete.record(kwargs['connection'], 'avatar',
+                         [target.avatar_s, target.avatar_m, target.avatar_l, target.avatar_raw])
+
+
+@db.event.listens_for(User, 'after_delete', named=True)
+def delete_timeline(**kwargs):
+    target = kwargs['target']
+    kwargs['connection'].execute(Timeline.__table__.delete().where(Timeline.user_id == target.id))
+
+
+@db.event.listens_for(User, 'after_insert', named=True)
+@db.event.listens_for(User, 'after_update', named=True)
+@db.event.listens_for(User, 'after_delete', named=True)
+def clear_cached_identity(**kwargs):
+    # 新插入的用户也要清除，SQLite 可能复用被删除用户的 id
+    User.clear_cached(kwargs['target'].id)
+
+
+@db.event.listens_for(Collect, 'after_insert', named=True)
+def increase_collectors_count(**kwargs):
+    target = kwargs['target']
+    kwargs['connection'].execute(db.update(Photo).where(Photo.id == target.collected_id).
+                                 values(collectors_count=Photo.collectors_count + 1))
+
+
+@db.event.listens_for(Collect, 'after_delete', named=True)
+def decrease_collectors_count(**kwargs):
+    target = kwargs['target']
+    kwargs['connection'].execute(db.update(Photo).where(Photo.id == target.collected_id).
+                                 values(collectors_count=Photo.collectors_count - 1))
+
+
+@db.event.listens_for(Comment, 'after_insert', named=True)
+def increase_comments_count(**kwargs):
+    target = kwargs['target']
+    kwargs['connection'].execute(db.update(Photo).where(Photo.id == target.photo_id).
+                                 values(comments_count=Photo.comments_count + 1))
+
+
+@db.event.listens_for(Comment, 'after_delete', named=True)
+def decrease_comments_count(**kwargs):
+    target = kwargs['target']
+    kwargs['connection'].execute(db.update(Photo).where(Photo.id == target.photo_id).
+                                 values(comments_count=Photo.comments_count - 1))
+
+
+@db.event.listens_for(User, 'after_insert', named=True)
+@db.event.listens_for(User, 'after_delete', named=True)
+@db.event.listens_for(Photo, 'after_insert', named=True)
+@db.event.listens_for(Photo, 'after_delete', named=True)
+@db.event.listens_for(Tag, 'after_insert', named=True)
+@db.event.listens_for(Tag, 'after_delete', named=True)
+def record_search_change(**kwargs):
+    SearchChange.record(kwargs['connection'], kwargs['target'])
+
+
+@db.event.listens_for(User, 'after_update', named=True)
+@db.event.listens_for(Photo, 'after_update', named=True)
+@db.event.listens_for(Tag, 'after_update', named=True)
+def record_search_update(**kwargs):
+    target = kwargs['target']
+    state = db.inspect(target)
+    # 只有被索引的列变化时才需要更新索引，例如登录、修改头像不会产生记录
+    if any(state.attrs[name].history.has_changes() for name in target._whoosheer_.schema.names() if name != 'id'):
+        SearchChange.record(kwargs['connection'], target)
+
+
+def record_autocomplete_change(kind, target_id, old_name, new_name):
+    changes = db.session.info.setdefault('autocomplete_changes', [])
+    changes.append((kind, target_id, old_name, new_name))
+
+
+@db.event.listens_for(Tag, 'after_insert', named=True)
+def add_tag_autocomplete(**kwargs):
+    record_autocomplete_change('tag', kwargs['target'].id, None, kwargs['target'].name)
+
+
+@db.event.listens_for(Tag, 'after_update', named=True)
+def rename_tag_autocomplete(**kwargs):
+    target = kwargs['target']
+    history = db.inspect(target).attrs.name.history
+    if history.deleted:
+        record_autocomplete_change('tag', target.id, history.deleted[0], target.name)
+
+
+@db.event.listens_for(Tag, 'after_delete', named=True)
+def remove_tag_autocomplete(**kwargs):
+    record_autocomplete_change('tag', kwargs['target'].id, kwargs['target'].name, None)
+
+
+@db.event.listens_for(User, 'after_insert', named=True)
+def add_user_autocomplete(**kwargs):
+    record_autocomplete_change('user', kwargs['target'].id, None, kwargs['target'].username)
+
+
+@db.event.listens_for(User, 'after_update', named=True)
+def rename_user_autocomplete(**kwargs):
+    target = kwargs['target']
+    history = db.inspect(target).attrs.username.history
+    if history.deleted:
+        record_autocomplete_change('user', target.id, history.deleted[0], target.username)
+
+
+@db.event.listens_for(User, 'after_delete', named=True)
+def remove_user_autocomplete(**kwargs):
+    record_autocomplete_change('user', kwargs['target'].id, kwargs['target'].username, None)
+
+
+@db.event.listens_for(User.role, 'set', named=True)
+def sync_role_id(**kwargs):
+    # 修改角色后立即同步 role_id，让 can() 和 is_admin 在提交前也能使用新角色
+    target, value = kwargs['target'], kwargs['value']
+    if value is None:
+        target.role_id = None
+    elif value.id is not None:
+        target.role_id = value.id
+
+
+@db.event.listens_for(Session, 'after_commit')
+def sweep_pending_deletes(session):
+    if session.info.pop('pending_deletes', False):
+        if current_app.config['ALBUMY_DELETE_IN_BACKGROUND']:
+            delete_sweeper.wake(current_app._get_current_object())
+        else:
+            PendingDelete.sweep()
+
+
+@db.event.listens_for(Session, 'after_commit')
+def index_search_changes(session):
+    if session.info.pop('search_changes', False):
+        if current_app.config['ALBUMY_SEARCH_INDEX_IN_BACKGROUND']:
+            search_indexer.wake(current_app._get_current_object())
+        else:
+            while apply_search_changes():
+                pass
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def discard_pending_deletes(session):
+    session.info.pop('pending_deletes', None)
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def discard_search_changes(session):
+    session.info.pop('search_changes', None)
+
+
+@db.event.listens_for(Session, 'after_commit')
+def update_autocomplete(session):
+    changes = session.info.pop('autocomplete_changes', None)
+    if changes:
+        get_autocomplete().apply(changes)
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def discard_autocomplete_changes(session):
+    session.info.pop('autocomplete_changes', None)
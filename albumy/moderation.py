@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+from collections import Counter, defaultdict
+
+from flask import current_app
+
+from albumy.extensions import db
+from albumy.models import User, Role, Photo, Tag, TagPopularity, Comment, Collect, Timeline, Blob, DerivativeJob, \
+    PendingDelete, SearchChange, Report, tagging, record_autocomplete_change
+
+# 批量操作绕过了 ORM 的删除级联和 after_delete 事件，这里用集合语句完成同样的清理，
+# 所有语句在同一个事务中执行，提交后由 PendingDelete 的清理线程删除文件
+
+
+def _ids(condition, model):
+    return db.session.scalars(db.select(model.id).where(condition)).all()
+
+
+def set_users_locked(condition, locked):
+    """Lock or unlock the users matching ``condition`` and return how many were updated."""
+    if locked:
+        role_id = Role.query.filter_by(name='Locked').first().id
+    else:
+        # 与 User.unlock 一致，管理员邮箱对应的账户恢复为 Administrator
+        role_id = db.case((User.email == current_app.config['ALBUMY_ADMIN_EMAIL'],
+                           Role.query.filter_by(name='Administrator').first().id),
+                          else_=Role.query.filter_by(name='User').first().id)
+    count = User.query.filter(condition). \
+        update({User.locked: locked, User.role_id: role_id}, synchronize_session=False)
+    db.session.commit()
+    User.clear_cached()
+    return count
+
+
+def set_users_active(condition, active):
+    """Block or unblock the users matching ``condition`` and return how many were updated."""
+    count = User.query.filter(condition).update({User.active: active}, synchronize_session=False)
+    db.session.commit()
+    User.clear_cached()
+    return count
+
+
+def unflag(model, condition):
+    """Clear the reports of the photos or comments matching ``condition``."""
+    # 清除举报记录后用户可以再次举报
+    Report.delete_for(db.session, model.__tablename__, db.select(model.id).where(condition, model.flag > 0))
+    count = model.query.filter(condition, model.flag > 0).update({model.flag: 0}, synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def _delete_comments(connection, comment_ids):
+    # 回复随被回复的评论一起删除，逐层查找
+    comment_ids = set(comment_ids)
+    replied_ids = comment_ids
+    while replied_ids:
+        replied_ids = set(connection.scalars(db.select(Comment.id).where(Comment.replied_id.in_(replied_ids)))) - \
+            comment_ids
+        comment_ids |= replied_ids
+    if not comment_ids:
+        return 0
+    counts = connection.execute(db.select(Comment.photo_id, db.func.count().label('count')).
+                                where(Comment.id.in_(comment_ids)).group_by(Comment.photo_id)).all()
+    photo = Photo.__table__
+    connection.execute(photo.update().where(photo.c.id == db.bindparam('b_photo_id')).
+                       values(comments_count=photo.c.comments_count - db.bindparam('b_count')),
+                       [{'b_photo_id': row.photo_id, 'b_count': row.count} for row in counts if row.photo_id])
+    Report.delete_for(connection, 'comment', comment_ids)
+    connection.execute(Comment.__table__.delete().where(Comment.id.in_(comment_ids)))
+    return len(comment_ids)
+
+
+def delete_comments(condition):
+    """Delete the comments matching ``condition`` with their replies and return how many were deleted."""
+    count = _delete_comments(db.session.connection(), _ids(condition, Comment))
+    db.session.commit()
+    return count
+
+
+def delete_photos(condition):
+    """Delete the photos matching ``condition`` with their comments, collections, tags and timeline
+    entries, and return how many were deleted. Their files are removed after commit.
+    """
+    connection = db.session.connection()
+    photos = connection.execute(db.select(Photo.id, Photo.timestamp, Photo.blob_id, Photo.filename,
+                                          Photo.filename_s, Photo.filename_m).where(condition)).all()
+    if not photos:
+        return 0
+    photo_ids = [photo.id for photo in photos]
+    _delete_comments(connection, connection.scalars(db.select(Comment.id).where(Comment.photo_id.in_(photo_ids))))
+    connection.execute(Collect.__table__.delete().where(Collect.collected_id.in_(photo_ids)))
+    connection.execute(Timeline.__table__.delete().where(Timeline.photo_id.in_(photo_ids)))
+
+    timestamps = {photo.id: photo.timestamp for photo in photos}
+    popularity = defaultdict(lambda: [0, TagPopularity.EMPTY_SCORE])
+    for tag_id, photo_id in connection.execute(db.select(tagging.c.tag_id, tagging.c.photo_id).
+                                               where(tagging.c.photo_id.in_(photo_ids))):
+        popularity[tag_id][0] += 1
+        popularity[tag_id][1] = TagPopularity.add_scores(popularity[tag_id][1],
+                                                         TagPopularity.hot_weight(timestamps[photo_id]))
+    if popularity:
+        table = TagPopularity.__table__
+        hot_score = TagPopularity.subtract_score_clause(table.c.hot_score, db.bindparam('b_score', type_=db.Float))
+        connection.execute(table.update().where(table.c.tag_id == db.bindparam('b_tag_id')).
+                           values(photo_count=table.c.photo_count - db.bindparam('b_count'), hot_score=hot_score),
+                           [{'b_tag_id': tag_id, 'b_count': count, 'b_score': score}
+                            for tag_id, (count, score) in popularity.items()])
+        connection.execute(tagging.delete().where(tagging.c.photo_id.in_(photo_ids)))
+
+    Report.delete_for(connection, 'photo', photo_ids)
+    connection.execute(Photo.__table__.delete().where(Photo.id.in_(photo_ids)))
+    references = Counter(photo.blob_id for photo in photos if photo.blob_id is not None)
+    if references:
+        table = Blob.__table__
+        connection.execute(table.update().where(table.c.id == db.bindparam('b_blob_id')).
+                           values(ref_count=table.c.ref_count - db.bindparam('b_count')),
+                           [{'b_blob_id': blob_id, 'b_count': count} for blob_id, count in references.items()])
+        orphaned = connection.scalars(db.select(Blob.id).
+                                      where(Blob.id.in_(list(references)), Blob.ref_count <= 0)).all()
+        if orphaned:
+            connection.execute(DerivativeJob.__table__.delete().where(DerivativeJob.blob_id.in_(orphaned)))
+            connection.execute(Blob.__table__.delete().where(Blob.id.in_(orphaned), Blob.ref_count <= 0))
+    # 仍被其他图片或 blob 引用的文件在清理时会被跳过
+    PendingDelete.record(connection, 'photo', [filename for photo in photos for filename in photo[3:]])
+    SearchChange.record_many(connection, 'photo', photo_ids)
+    db.session.commit()
+    return len(photo_ids)
+
+
+def delete_tags(condition):
+    """Delete the tags matching ``condition`` and return how many were deleted."""
+    connection = db.session.connection()
+    tags = connection.execute(db.select(Tag.id, Tag.name).where(condition)).all()
+    if not tags:
+        return 0
+    tag_ids = [tag.id for tag in tags]
+    connection.execute(tagging.delete().where(tagging.c.tag_id.in_(tag_ids)))
+    connection.execute(TagPopularity.__table__.delete().where(TagPopularity.tag_id.in_(tag_ids)))
+    connection.execute(Tag.__table__.delete().where(Tag.id.in_(tag_ids)))
+    SearchChange.record_many(connection, 'tag', tag_ids)
+    for tag in tags:
+        record_autocomplete_change('tag', tag.id, tag.name, None)
+    db.session.commit()
+    return len(tag_ids)
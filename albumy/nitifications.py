@@ -1,30 +1,76 @@
 # -*- codeing = utf-8 -*-
-from flask import url_for
+from datetime import datetime, timedelta
 
+from flask import url_for, current_app
+
+from albumy.events import publish_notification_event
 from albumy.extensions import db
-from albumy.models import Notification
+from albumy.models import Notification, NotificationActor, User
 
 
-def push_follow_notification(follower, receiver):
-    message = f'User <a href="{url_for("user.index", username=follower.username)}">' \
-              f'{follower.username}</a> followed you.'
-    notification = Notification(message=message, receiver=receiver)
+def push_notification(receiver, kind, target_id, actor, render):
+    """Push a notification, or merge it into an unread one of the same kind and target pushed
+    within ``ALBUMY_NOTIFICATION_COALESCE_WINDOW``. ``render(actor, others)`` builds the message.
+    """
+    now = datetime.utcnow()
+    actor_id = actor.id if actor is not None else None
+    window = current_app.config['ALBUMY_NOTIFICATION_COALESCE_WINDOW']
+    notification = Notification.query. \
+        filter_by(receiver_id=receiver.id, kind=kind, target_id=target_id, is_read=False). \
+        filter(Notification.timestamp >= now - timedelta(seconds=window)). \
+        order_by(Notification.timestamp.desc()).first() if window else None
+    if notification is not None:
+        # 只统计不重复的操作者，评论通知没有操作者，按次数计数
+        counted = actor_id is None or NotificationActor.add(notification.id, actor_id)
+        actor_count = notification.actor_count + counted
+        message = render(actor, actor_count - 1)
+        # 以未读为条件更新，期间被标记为已读时改为插入新的通知
+        merged = Notification.query.filter_by(id=notification.id, is_read=False). \
+            update({Notification.message: message, Notification.actor_id: actor_id,
+                    Notification.actor_count: actor_count, Notification.timestamp: now},
+                   synchronize_session=False)
+        if merged:
+            db.session.commit()
+            publish_notification_event(receiver.id, message)
+            return
+    message = render(actor, 0)
+    notification = Notification(message=message, receiver=receiver, kind=kind, target_id=target_id,
+                                actor_id=actor_id, timestamp=now)
+    if actor_id is not None:
+        notification.actors.append(NotificationActor(actor_id=actor_id))
     db.session.add(notification)
+    User.adjust_unread_notification_count(receiver.id, 1)
     db.session.commit()
+    publish_notification_event(receiver.id, message)
 
 
-def push_comment_notification(photo_id, receiver, page=1):
-    message = f'<a href="{url_for("main.show_photo", photo_id=photo_id, page=page)}#comments">This photo</a>' \
-              f' has new comment/reply.'
-    notification = Notification(message=message, receiver=receiver)
-    db.session.add(notification)
-    db.session.commit()
+def _others(others):
+    if not others:
+        return ''
+    return ' and %d other%s' % (others, 's' if others > 1 else '')
+
+
+def push_follow_notification(follower, receiver):
+    def render(actor, others):
+        return f'User <a href="{url_for("user.index", username=actor.username)}">' \
+               f'{actor.username}</a>{_others(others)} followed you.'
+
+    push_notification(receiver, 'follow', None, follower, render)
+
+
+def push_comment_notification(photo_id, receiver):
+    def render(actor, others):
+        comments = 'new comment/reply' if not others else '%d new comments/replies' % (others + 1)
+        return f'<a href="{url_for("main.show_photo", photo_id=photo_id, cursor="last")}#comments">This photo</a>' \
+               f' has {comments}.'
+
+    push_notification(receiver, 'comment', photo_id, None, render)
 
 
 def push_collect_notification(collector, photo_id, receiver):
-    message = f'User <a href="{url_for("user.index", username=collector.username)}">"{collector.username}"</a>' \
-              f'collected your ' \
-              f'<a href="{url_for("main.show_photo", photo_id=photo_id)}">photo</a>'
-    notification = Notification(message=message, receiver=receiver)
-    db.session.add(notification)
-    db.session.commit()
+    def render(actor, others):
+        return f'User <a href="{url_for("user.index", username=actor.username)}">"{actor.username}"</a>' \
+               f'{_others(others)} collected your ' \
+               f'<a href="{url_for("main.show_photo", photo_id=photo_id)}">photo</a>'
+
+    push_notification(receiver, 'collect', photo_id, collector, render)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+from datetime import datetime
+
+from flask import request, url_for
+
+from albumy.extensions import db
+
+
+def encode_cursor(values, direction):
+    data = [direction] + [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def _decode_value(column, value):
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    # bool 是 int 的子类，也不是有效的键值
+    if isinstance(value, bool) or not isinstance(value, (int, float) if python_type is float else python_type):
+        raise TypeError(value)
+    return value
+
+
+def decode_cursor(cursor, columns):
+    # 游标无效时返回 None，视为第一页
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(data, list) or len(data) != len(columns) + 1 or data[0] not in ('next', 'prev'):
+            return None
+        values = [_decode_value(column, value) for column, value in zip(columns, data[1:])]
+    except (ValueError, TypeError, NotImplementedError):
+        return None
+    return data[0], values
+
+
+class KeysetPagination:
+    """按 (timestamp, id) 等键值翻页，不执行 COUNT，也不使用 OFFSET。"""
+
+    def __init__(self, items, per_page, has_next, has_prev, key):
+        self.items = items
+        self.per_page = per_page
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.next_cursor = encode_cursor(key(items[-1]), 'next') if has_next else None
+        self.prev_cursor = encode_cursor(key(items[0]), 'prev') if has_prev else None
+
+    def _url_for(self, cursor, **kwargs):
+        args = request.args.to_dict()
+        args.pop('page', None)
+        args.update(request.view_args)
+        args.update(kwargs)
+        args['cursor'] = cursor
+        return url_for(request.endpoint, **args)
+
+    def next_url(self, **kwargs):
+        return self._url_for(self.next_cursor, **kwargs) if self.has_next else None
+
+    def prev_url(self, **kwargs):
+        return self._url_for(self.prev_cursor, **kwargs) if self.has_prev else None
+
+
+def _after(columns, values, descending):
+    # 构造 (a, b) < (va, vb) 形式的行比较，展开为 OR 以兼容不支持行值比较的数据库
+    clauses = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        compare = column < value if descending else column > value
+        clauses.append(db.and_(*[c == v for c, v in zip(columns[:i], values[:i])], compare))
+    return db.or_(*clauses)
+
+
+def keyset_paginate(query, columns, key, per_page, cursor=None, descending=True):
+    """Paginate ``query`` ordered by ``columns``.
+
+    ``key`` maps an item to its values for ``columns``; ``cursor`` is a token from a
+    previous page, or ``'last'`` for the last page.
+    """
+    query = query.order_by(None)
+    if cursor == 'last':
+        direction, values = 'prev', None
+    else:
+        direction, values = (decode_cursor(cursor, columns) if cursor else None) or ('next', None)
+
+    # 向前翻页时反向排序查询，取出后再翻转
+    reverse = direction == 'prev'
+    if values is not None:
+        query = query.filter(_after(columns, values, descending != reverse))
+    if descending != reverse:
+        query = query.order_by(*[column.desc() for column in columns])
+    else:
+        query = query.order_by(*[column.asc() for column in columns])
+    items = query.limit(per_page + 1).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+
+    if reverse:
+        items.reverse()
+        return KeysetPagination(items, per_page, has_next=cursor != 'last' and bool(items),
+                                has_prev=has_more, key=key)
+    return KeysetPagination(items, per_page, has_next=has_more, has_prev=values is not None and bool(items),
+                            key=key)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from PIL import Image
+from flask import current_app
+
+
+class DerivativeCache:
+    """按需生成的图片尺寸的磁盘缓存，总大小超过 max_bytes 时按最近使用时间淘汰。
+
+    文件的修改时间记录最近一次使用，重启后扫描目录即可恢复淘汰顺序。
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._entries = None
+        self._size = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _load(self):
+        os.makedirs(self.path, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        self._entries = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self._size = sum(self._entries.values())
+
+    def _touch(self, name):
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            if name not in self._entries:
+                return False
+            self._entries.move_to_end(name)
+        try:
+            os.utime(os.path.join(self.path, name))
+        except FileNotFoundError:
+            # 被其他进程淘汰
+            with self._lock:
+                self._size -= self._entries.pop(name, 0)
+            return False
+        return True
+
+    def _add(self, name, size):
+        with self._lock:
+            self._size += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                evicted, evicted_size = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                try:
+                    os.remove(os.path.join(self.path, evicted))
+                except FileNotFoundError:
+                    pass
+
+    def get(self, source, name, generate):
+        """Return the cached file name for ``name``, calling ``generate(source, path)`` to
+        create it on a miss. Concurrent misses for the same name in this process generate once.
+        """
+        if self._touch(name):
+            return name
+        with self._lock:
+            key_lock = self._key_locks.setdefault(name, threading.Lock())
+        try:
+            with key_lock:
+                # 等待锁期间可能已经由其他线程生成
+                if not self._touch(name):
+                    path = os.path.join(self.path, name)
+                    if not os.path.exists(path):
+                        # 先写临时文件再原子地改名，其他进程不会读到写了一半的文件
+                        tmp_path = os.path.join(self.path, uuid.uuid4().hex + '.tmp')
+                        try:
+                            generate(source, tmp_path)
+                            os.replace(tmp_path, path)
+                        finally:
+                            if os.path.exists(tmp_path):
+                                os.remove(tmp_path)
+                    self._add(name, os.path.getsize(path))
+        finally:
+            with self._lock:
+                self._key_locks.pop(name, None)
+        return name
+
+
+_caches = {}
+
+
+def get_derivative_cache():
+    path = current_app.config['ALBUMY_RESPONSIVE_CACHE_PATH']
+    if path not in _caches:
+        _caches[path] = DerivativeCache(path, current_app.config['ALBUMY_RESPONSIVE_CACHE_SIZE'])
+    return _caches[path]
+
+
+def derivative_name(filename, width, image_format):
+    name = os.path.splitext(filename)[0].replace('/', '_')
+    return '%s_w%d.%s' % (name, width, image_format)
+
+
+def resize_to(source, path, width, image_format):
+    with Image.open(source) as img:
+        if img.format == 'JPEG' and img.size[0] > width:
+            img.draft(img.mode, (width, img.size[1] * width // img.size[0]))
+        if img.size[0] > width:
+            img = img.resize((width, round(img.size[1] * width / img.size[0])), Image.LANCZOS, reducing_gap=3.0)
+        if image_format == 'jpeg' and img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(path, current_app.config['ALBUMY_RESPONSIVE_FORMATS'][image_format], quality=80)
+
+
+def responsive_image(filename, width, image_format):
+    """Return the cached file name of ``filename`` scaled to ``width`` in ``image_format``."""
+    source = os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename)
+    return get_derivative_cache().get(source, derivative_name(filename, width, image_format),
+                                      lambda source, path: resize_to(source, path, width, image_format))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import random
+
+from flask import current_app
+
+from albumy.extensions import db
+from albumy.models import Photo
+
+
+class PhotoSample:
+    """在 [lower, upper] 的 id 区间上按种子生成一个不重复的伪随机排列，逐段探测存在的图片。
+
+    第 i 个探测的 id 为 lower + permute(i)，permute 是以种子为密钥、在 [0, n) 上的 Feistel 置换
+    （超出范围时继续置换，即 cycle walking），整个区间内每个 id 只会出现一次，相邻的探测之间也没有固定的间隔，
+    “加载更多”时只需记住探测到的位置即可避免重复。
+    """
+
+    rounds = 4
+
+    def __init__(self, seed, lower, upper, position=0):
+        self.seed = seed
+        self.lower = lower
+        self.upper = upper
+        self.position = position
+        self.span = upper - lower + 1 if upper >= lower else 0
+        rng = random.Random(seed)
+        self._keys = [rng.getrandbits(32) for _ in range(self.rounds)]
+        # 两半各 half 位，覆盖 [0, span) 的最小偶数位宽
+        self._half = max(1, (max(self.span - 1, 1).bit_length() + 1) // 2)
+
+    @classmethod
+    def _bounds(cls):
+        lower, upper = db.session.query(db.func.min(Photo.id), db.func.max(Photo.id)).one()
+        if lower is None:
+            return 1, 0
+        return lower, upper
+
+    @classmethod
+    def create(cls):
+        lower, upper = cls._bounds()
+        return cls(random.getrandbits(32), lower, upper)
+
+    @classmethod
+    def from_cursor(cls, cursor):
+        try:
+            seed, lower, upper, position = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            seed, lower, upper, position = int(seed), int(lower), int(upper), int(position)
+        except (ValueError, TypeError):
+            return cls.create()
+        # 区间收缩到现有图片的 id 范围内，客户端伪造的超大 id 不会传给数据库
+        min_id, max_id = cls._bounds()
+        lower, upper = max(lower, min_id), min(upper, max_id)
+        if lower > upper or not 0 <= position <= upper - lower + 1:
+            return cls.create()
+        return cls(seed, lower, upper, position)
+
+    def _permute(self, index):
+        mask = (1 << self._half) - 1
+        while True:
+            left, right = index >> self._half, index & mask
+            for key in self._keys:
+                left, right = right, left ^ (hash((key, right)) & mask)
+            index = (left << self._half) | right
+            if index < self.span:
+                return index
+
+    @property
+    def exhausted(self):
+        return self.position >= self.span
+
+    @property
+    def cursor(self):
+        data = json.dumps([self.seed, self.lower, self.upper, self.position], separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+    def _probe_ids(self, count):
+        end = min(self.position + count, self.span)
+        ids = [self.lower + self._permute(i) for i in range(self.position, end)]
+        self.position = end
+        return ids
+
+    def take(self, count):
+        photos = []
+        max_probes = current_app.config['ALBUMY_EXPLORE_MAX_PROBES']
+        probes = 0
+        while len(photos) < count and not self.exhausted and probes < max_probes:
+            # 被删除的 id 会探测落空，每轮多探测一些
+            ids = self._probe_ids(min((count - len(photos)) * 2, max_probes - probes))
+            probes += len(ids)
+            found = {photo.id: photo for photo in Photo.query.filter(Photo.id.in_(ids))}
+            for photo_id in ids:
+                if photo_id in found and len(photos) < count:
+                    photos.append(found[photo_id])
+                elif photo_id in found:
+                    # 本页已满，剩下的留给下一页
+                    self.position -= len(ids) - ids.index(photo_id)
+                    break
+        return photos
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import re
+
+from flask import current_app
+
+from albumy.extensions import db
+from albumy.models import User, Photo, Tag
+from albumy.pagination import keyset_paginate
+
+# 搜索类别对应的模型、被索引的列以及 BM25 中各列的权重
+SEARCH_INDEXES = {
+    'user': (User, ('name', 'username'), (1.0, 2.0)),
+    'photo': (Photo, ('description',), (1.0,)),
+    'tag': (Tag, ('name',), (1.0,)),
+}
+
+
+def fts_ddl(table, columns):
+    """Return the statements creating the FTS5 index of ``table`` and the triggers that keep it
+    in sync, so the index is updated in the same transaction as the rows.
+    """
+    fts = table + '_fts'
+    names = ', '.join(columns)
+    new = ', '.join('new.' + column for column in columns)
+    old = ', '.join('old.' + column for column in columns)
+    delete = f"INSERT INTO {fts}({fts}, rowid, {names}) VALUES ('delete', old.id, {old});"
+    insert = f"INSERT INTO {fts}(rowid, {names}) VALUES (new.id, {new});"
+    return [
+        # 外部内容表，只保存索引，原文从 content 表中读取
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({names}, content='{table}', content_rowid='id', "
+        f"tokenize='unicode61 remove_diacritics 2')",
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON "{table}" BEGIN {insert} END',
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON "{table}" BEGIN {delete} END',
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {names} ON "{table}" BEGIN {delete} {insert} END',
+    ]
+
+
+def _create_fts(target, connection, **kwargs):
+    if connection.dialect.name != 'sqlite':
+        return
+    columns = next(columns for model, columns, _ in SEARCH_INDEXES.values() if model.__table__ is target)
+    for statement in fts_ddl(target.name, columns):
+        connection.exec_driver_sql(statement)
+
+
+def _drop_fts(target, connection, **kwargs):
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql('DROP TABLE IF EXISTS %s_fts' % target.name)
+
+
+for _model, _, _ in SEARCH_INDEXES.values():
+    db.event.listen(_model.__table__, 'after_create', _create_fts)
+    db.event.listen(_model.__table__, 'before_drop', _drop_fts)
+
+
+def rebuild_fts():
+    """Rebuild the FTS5 indexes from their content tables."""
+    for model, _, _ in SEARCH_INDEXES.values():
+        fts = model.__tablename__ + '_fts'
+        db.session.execute(db.text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+    db.session.commit()
+
+
+class WhoosheeBackend:
+    """通过 Flask-Whooshee 的 Whoosh 索引搜索，按相关度排序，按页码分页。"""
+
+    def search(self, category, q, per_page, page=1, cursor=None):
+        model = SEARCH_INDEXES[category][0]
+        # whooshee_search 向 case() 传入列表，SQLAlchemy 2.0 不再支持，这里自己按相关度排序
+        ids = model.whoosh_search(q, values_of='id')
+        if not ids:
+            return model.query.filter(db.false()).paginate(page=page, per_page=per_page)
+        relevance = db.case({target_id: i for i, target_id in enumerate(ids)}, value=model.id)
+        return model.query.filter(model.id.in_(ids)).order_by(relevance).paginate(page=page, per_page=per_page)
+
+
+class FTS5Backend:
+    """通过 SQLite FTS5 搜索，按 BM25 排序并用游标分页，每个词都按前缀匹配。"""
+
+    @staticmethod
+    def match_expression(q):
+        # 只保留词本身再加引号，避免用户输入被解析为 FTS5 的查询语法
+        return ' '.join('"%s"*' % term for term in re.findall(r'\w+', q))
+
+    def search(self, category, q, per_page, page=1, cursor=None):
+        model, _, weights = SEARCH_INDEXES[category]
+        fts = model.__tablename__ + '_fts'
+        match = self.match_expression(q)
+        fts_table = db.table(fts, db.column('rowid', db.Integer))
+        rank = db.func.bm25(db.literal_column(fts), *weights, type_=db.Float)
+        query = model.query.join(fts_table, fts_table.c.rowid == model.id).add_columns(rank)
+        # 没有可以检索的词时返回空结果
+        query = query.filter(db.literal_column(fts).op('MATCH')(match) if match else db.false())
+        # BM25 越小越相关
+        pagination = keyset_paginate(query, (rank, model.id), key=lambda row: (row[1], row[0].id),
+                                     per_page=per_page, cursor=cursor, descending=False)
+        pagination.items = [row[0] for row in pagination.items]
+        return pagination
+
+
+search_backends = {
+    'whooshee': WhoosheeBackend(),
+    'fts5': FTS5Backend(),
+}
+
+
+def full_text_search(category, q, per_page, page=1, cursor=None):
+    """Search ``category`` with the backend selected by ``ALBUMY_SEARCH_BACKEND``."""
+    backend = search_backends[current_app.config['ALBUMY_SEARCH_BACKEND']]
+    return backend.search(category, q, per_page, page=page, cursor=cursor)
@@ -31,6 +31,30 @@ class BaseConfig:
     ALBUMY_MANAGE_COMMENT_PER_PAGE = 30
     ALBUMY_SEARCH_RESULT_PER_PAGE = 20
     ALBUMY_MAIL_SUBJECT_PREFIX = '[Albumy]'
+    # 粉丝数超过该值的用户上传图片时不再写入粉丝的时间线，改为读取时合并
+    ALBUMY_TIMELINE_FANOUT_LIMIT = 1000
+    # 关注用户时回填其最近的图片数量
+    ALBUMY_TIMELINE_BACKFILL = 500
+    # 首页热门标签的排序方式：'count' 按图片数量，'hot' 按随时间衰减的热度
+    ALBUMY_TAG_RANKING = 'count'
+    # 热度的半衰期（秒），设为 None 则不计算热度
+    ALBUMY_TAG_HOT_HALF_LIFE = 7 * 24 * 3600
+    # 角色权限缓存的有效期（秒），多进程部署时其他进程修改角色后最多延迟这么久生效
+    ALBUMY_PERMISSION_CACHE_TTL = 300
+    # 登录用户身份缓存的有效期（秒），本进程内修改用户时立即失效，其他进程最多延迟这么久
+    ALBUMY_IDENTITY_CACHE_TTL = 30
+    # 后台首页统计数据的缓存时间（秒）以及增长曲线包含的天数
+    ALBUMY_STATISTICS_CACHE_TTL = 60
+    ALBUMY_STATISTICS_DAYS = 30
+    # 探索页每次请求最多探测的图片 id 数量
+    ALBUMY_EXPLORE_MAX_PROBES = 600
+    # 上传后交给 flask albumy-worker 异步生成缩略图，关闭时在上传请求中同步生成
+    ALBUMY_ASYNC_DERIVATIVES = True
+    # 缩略图任务最多尝试的次数，第 n 次失败后等待 ALBUMY_JOB_RETRY_DELAY * 2^(n-1) 秒再重试
+    ALBUMY_JOB_MAX_ATTEMPTS = 5
+    ALBUMY_JOB_RETRY_DELAY = 30
+    # 任务被领取后超过这么多秒仍未完成，视为 worker 已退出，允许重新领取
+    ALBUMY_JOB_TIMEOUT = 600
 
     ALBUMY_UPLOAD_PATH = os.path.join(basedir, 'uploads')
     ALBUMY_PHOTO_SIZE = {'small': 400,
@@ -42,6 +66,51 @@ class BaseConfig:
 
     AVATARS_SAVE_PATH = os.path.join(ALBUMY_UPLOAD_PATH, 'avatars')
     AVATARS_SIZE_TUPLE = (30, 100, 200)
+    # 图片以内容哈希或随机字符串命名，内容不会改变，允许浏览器长期缓存
+    ALBUMY_IMAGE_CACHE_MAX_AGE = 365 * 24 * 3600
+    # 默认头像以用户名命名，同名文件可能被重新生成，缓存较短时间并通过 ETag 重新验证
+    ALBUMY_AVATAR_CACHE_MAX_AGE = 24 * 3600
+    # 按需生成的响应式图片：允许的宽度和格式，缓存目录及其最大字节数（超过后淘汰最久未使用的文件）
+    ALBUMY_RESPONSIVE_WIDTHS = (200, 400, 800, 1200)
+    ALBUMY_RESPONSIVE_FORMATS = {'jpeg': 'JPEG', 'webp': 'WEBP'}
+    ALBUMY_RESPONSIVE_CACHE_PATH = os.path.join(ALBUMY_UPLOAD_PATH, 'cache')
+    ALBUMY_RESPONSIVE_CACHE_SIZE = 1024 * 1024 * 1024
+    # 删除图片和用户后由后台线程删除文件，关闭时在提交后立即删除；清理线程也会每隔这么多秒检查一次遗留的记录
+    ALBUMY_DELETE_IN_BACKGROUND = True
+    ALBUMY_DELETE_SWEEP_INTERVAL = 60
+    # flask gc-uploads 只清理修改时间早于这么多秒的孤立文件，避免删除正在上传、尚未提交的文件
+    ALBUMY_GC_MIN_AGE = 3600
+    # 在这么多秒内同一张图片的收藏、评论以及关注通知合并为一条，设为 0 则不合并
+    ALBUMY_NOTIFICATION_COALESCE_WINDOW = 24 * 3600
+    # 按天数删除通知时允许的最大天数，更大的值会使时间计算溢出
+    ALBUMY_NOTIFICATION_MAX_DAYS = 3650
+    # 实时通知的发布订阅实现，多进程部署时改为 albumy.events.RedisBroker 并设置 Redis 地址
+    ALBUMY_EVENT_BROKER = os.getenv('ALBUMY_EVENT_BROKER', 'albumy.events.LocalBroker')
+    ALBUMY_EVENT_BROKER_URL = os.getenv('ALBUMY_EVENT_BROKER_URL')
+    # 通知事件流没有消息时每隔这么多秒发送一次心跳，让代理和浏览器保持连接
+    ALBUMY_EVENT_KEEPALIVE = 15
+    # 每个事件流连接最多保持这么多秒，之后由服务器关闭，浏览器在 ALBUMY_EVENT_RETRY 毫秒后自动重连。
+    # 事件流在整个连接期间占用一个 worker，同步的 WSGI 服务器只适合很少的连接，
+    # 生产环境应使用 gevent/eventlet 之类的异步 worker，例如 gunicorn -k gevent
+    ALBUMY_EVENT_STREAM_TIMEOUT = 300
+    ALBUMY_EVENT_RETRY = 5000
+    # 邮件先写入发件箱再由固定数量的线程发送，关闭时在请求中直接发送；
+    # 队列满时请求最多等待 ALBUMY_MAIL_QUEUE_TIMEOUT 秒，之后邮件留在发件箱中由空闲的线程领取
+    ALBUMY_MAIL_IN_BACKGROUND = True
+    ALBUMY_MAIL_WORKERS = 2
+    ALBUMY_MAIL_QUEUE_SIZE = 1000
+    ALBUMY_MAIL_QUEUE_TIMEOUT = 1
+    # 每个线程一次最多领取的邮件数，以及连接空闲多少秒后关闭
+    ALBUMY_MAIL_BATCH_SIZE = 20
+    ALBUMY_MAIL_IDLE_TIMEOUT = 30
+    # 发送失败的重试次数和首次重试的等待秒数（之后每次翻倍），领取后超过 ALBUMY_MAIL_TIMEOUT 秒未完成的邮件重新发送
+    ALBUMY_MAIL_MAX_ATTEMPTS = 5
+    ALBUMY_MAIL_RETRY_DELAY = 60
+    ALBUMY_MAIL_TIMEOUT = 600
+    # 由前端代理发送文件：nginx 设置为映射到上传目录的 internal location，例如 /_uploads/；
+    # Apache/lighttpd 可以改为开启 USE_X_SENDFILE
+    ALBUMY_X_ACCEL_REDIRECT_PREFIX = os.getenv('ALBUMY_X_ACCEL_REDIRECT_PREFIX')
+    USE_X_SENDFILE = os.getenv('USE_X_SENDFILE', 'false').lower() == 'true'
 
     SECRET_KEY = os.getenv('SECRET_KEY', 'secret string')
     MAX_CONTENT_LENGTH = 3 * 1024 * 1024
@@ -49,8 +118,9 @@ class BaseConfig:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
     MAIL_SERVER = os.getenv('MAIL_SERVER')
-    MAIL_PORT = 465
-    MAIL_USE_SSL = True
+    # 本地调试时可以使用 python -m aiosmtpd -n -l localhost:8025，并设置 MAIL_PORT=8025、MAIL_USE_SSL=false
+    MAIL_PORT = int(os.getenv('MAIL_PORT', 465))
+    MAIL_USE_SSL = os.getenv('MAIL_USE_SSL', 'true').lower() == 'true'
     MAIL_USERNAME = os.getenv('MAIL_USERNAME')
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = ('Albumy Admin', MAIL_USERNAME)
@@ -60,7 +130,24 @@ class BaseConfig:
     DROPZONE_MAX_FILES = 30
     DROPZONE_ENABLE_CSRF = True
 
+    # 搜索后端：whooshee 使用 Whoosh 文件索引，fts5 使用 SQLite 的全文索引（由触发器在同一事务中维护）
+    ALBUMY_SEARCH_BACKEND = os.getenv('ALBUMY_SEARCH_BACKEND', 'whooshee')
+
+    # 使用 Whoosh 时索引的变更先记录在 SearchChange 中，由后台线程稍等 ALBUMY_SEARCH_INDEX_DELAY 秒后批量写入，
+    # 关闭时在提交后立即写入；索引被锁定时留下的变更每隔 ALBUMY_SEARCH_INDEX_INTERVAL 秒重试
+    ALBUMY_SEARCH_INDEX_IN_BACKGROUND = True
+    ALBUMY_SEARCH_INDEX_DELAY = 1
+    ALBUMY_SEARCH_INDEX_INTERVAL = 60
+
+    # 自动补全最多返回的条数，以及重新加载前缀索引（更新图片数、粉丝数排序）的间隔秒数
+    ALBUMY_AUTOCOMPLETE_LIMIT = 10
+    ALBUMY_AUTOCOMPLETE_REFRESH = 600
+    # 收到第一个请求时在后台预先加载前缀索引，关闭时在第一次查询时加载
+    ALBUMY_AUTOCOMPLETE_WARM = True
+
     WHOOSHEE_MIN_STRING_LEN = 1
+    # 索引由 albumy.indexing 更新，不在每次提交时同步写入
+    WHOOSHEE_ENABLE_INDEXING = False
     
 class DevelopmentConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = \
@@ -72,6 +159,11 @@ class TestingConfig(BaseConfig):
     TESTING = True
     WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///'  # in-memory database
+    ALBUMY_DELETE_IN_BACKGROUND = False
+    ALBUMY_MAIL_IN_BACKGROUND = False
+    ALBUMY_SEARCH_INDEX_IN_BACKGROUND = False
+    ALBUMY_AUTOCOMPLETE_WARM = False
+    WHOOSHEE_MEMORY_STORAGE = True
 
 
 class ProductionConfig(BaseConfig):
@@ -62,6 +62,131 @@ $(function () {
 
     $('.profile-popover').hover(show_profile_popover.bind(this), hide_profile_popover.bind(this));
 
+    // 收藏数直接读取图片表中的计数字段
+    function update_collectors_count(id) {
+        var $el = $('#collectors-count-' + id);
+        $.ajax({
+            type: 'GET',
+            url: $el.data('href'),
+            success: function (data) {
+                $el.text(data.count);
+            }
+        });
+    }
+
+    function collect(e) {
+        var $el = $(e.target).closest('.collect-btn');
+        var id = $el.data('id');
+        $.ajax({
+            type: 'POST',
+            url: $el.data('href'),
+            headers: {'X-CSRFToken': csrf_token},
+            success: function (data) {
+                $el.prev().show();
+                $el.hide();
+                update_collectors_count(id);
+                toast(data.message);
+            },
+            error: function (error) {
+                toast(error.responseJSON ? error.responseJSON.message : 'Server error, please try again later.');
+            }
+        });
+    }
+
+    function uncollect(e) {
+        var $el = $(e.target).closest('.uncollect-btn');
+        var id = $el.data('id');
+        $.ajax({
+            type: 'POST',
+            url: $el.data('href'),
+            headers: {'X-CSRFToken': csrf_token},
+            success: function (data) {
+                $el.next().show();
+                $el.hide();
+                update_collectors_count(id);
+                toast(data.message);
+            },
+            error: function (error) {
+                toast(error.responseJSON ? error.responseJSON.message : 'Server error, please try again later.');
+            }
+        });
+    }
+
+    $(document).on('click', '.collect-btn', collect.bind(this));
+    $(document).on('click', '.uncollect-btn', uncollect.bind(this));
+
+    // 输入时从自动补全接口获取建议并填入关联的 datalist，标签输入框只补全最后一个词
+    var autocomplete_timer = null;
+
+    function autocomplete(e) {
+        var $input = $(e.target);
+        var $list = $('#' + $input.attr('list'));
+        var multiple = $list.data('multiple');
+        var words = $input.val().split(' ');
+        var q = multiple ? words.pop() : $input.val();
+        var before = multiple && words.length ? words.join(' ') + ' ' : '';
+        clearTimeout(autocomplete_timer);
+        if (!q.trim()) {
+            $list.empty();
+            return;
+        }
+        autocomplete_timer = setTimeout(function () {
+            var requests = $.map(String($list.data('href')).split(' '), function (url) {
+                return $.getJSON(url, {q: q});
+            });
+            $.when.apply($, requests).done(function () {
+                var responses = requests.length > 1 ? arguments : [arguments];
+                $list.empty();
+                $.each(responses, function (i, response) {
+                    $.each(response[0].results, function (j, item) {
+                        $list.append($('<option>').attr('value', before + item.name));
+                    });
+                });
+            });
+        }, 150);
+    }
+
+    $(document).on('input', 'input[list]', autocomplete.bind(this));
+
+    // 未读通知数优先通过事件流实时更新，浏览器不支持时退回定时轮询
+    function update_notifications_count() {
+        var $el = $('#notification-badge');
+        $.ajax({
+            type: 'GET',
+            url: $el.data('href'),
+            success: function (data) {
+                set_notifications_count(data.count);
+            }
+        });
+    }
+
+    function set_notifications_count(count) {
+        var $el = $('#notification-badge');
+        if (count === 0) {
+            $el.addClass('hide');
+        } else {
+            $el.removeClass('hide');
+            $el.text(count);
+        }
+    }
+
+    var $badge = $('#notification-badge');
+    if ($badge.length) {
+        if (window.EventSource) {
+            var source = new EventSource($badge.data('stream'));
+            source.addEventListener('count', function (e) {
+                set_notifications_count(JSON.parse(e.data).count);
+            });
+            source.addEventListener('notification', function (e) {
+                var data = JSON.parse(e.data);
+                set_notifications_count(data.count);
+                toast($('<div>').html(data.message).text());
+            });
+        } else {
+            setInterval(update_notifications_count, 30000);
+        }
+    }
+
     // hide or show tag edit form
     $('#tag-btn').click(function () {
         $('#tags').hide();
@@ -84,6 +209,10 @@ $(function () {
     $('#confirm-delete').on('show.bs.modal', function (e) {
         $('.delete-form').attr('action', $(e.relatedTarget).data('href'));
     });
+    // select all rows for bulk actions
+    $('.select-all').change(function () {
+        $(this).closest('table').find('input[name=ids]').prop('checked', this.checked);
+    });
 
     $("[data-toggle='tooltip']").tooltip({title: moment($(this).data('timestamp')).format('lll')})
 });
\ No newline at end of file
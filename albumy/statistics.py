@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from albumy.caching import TTLCache
+from albumy.extensions import db
+from albumy.models import User, Photo, Tag, Comment
+
+
+def _counts():
+    """Return the dashboard counters from one statement that scans each table once."""
+    users = db.select(db.func.count().label('user_count'),
+                      db.func.count(db.case((User.locked == db.true(), 1))).label('locked_user_count'),
+                      db.func.count(db.case((User.active == db.false(), 1))).label('blocked_user_count')).subquery()
+    photos = db.select(db.func.count().label('photo_count'),
+                       db.func.count(db.case((Photo.flag > 0, 1))).label('reported_photos_count')).subquery()
+    tags = db.select(db.func.count().label('tag_count')).select_from(Tag).subquery()
+    comments = db.select(db.func.count().label('comment_count'),
+                         db.func.count(db.case((Comment.flag > 0, 1))).label('reported_comments_count')).subquery()
+    # 每个子查询只有一行，用 ON 1 连接，避免笛卡尔积警告
+    statement = db.select(users, photos, tags, comments).select_from(
+        users.join(photos, db.true()).join(tags, db.true()).join(comments, db.true()))
+    return dict(db.session.execute(statement).one()._mapping)
+
+
+def _growth(days):
+    """Return the days and the new users and photos of each day, for the last ``days`` days."""
+    today = datetime.utcnow().date()
+    first = today - timedelta(days=days - 1)
+    since = datetime.combine(first, datetime.min.time())
+    series = []
+    for kind, column in (('users', User.member_since), ('photos', Photo.timestamp)):
+        day = db.func.date(column)
+        series.append(db.select(db.literal(kind).label('kind'), day.label('day'), db.func.count().label('count')).
+                      where(column >= since).group_by(day))
+    counts = {(row.kind, str(row.day)): row.count for row in db.session.execute(db.union_all(*series))}
+    dates = [str(first + timedelta(days=i)) for i in range(days)]
+    return {'days': dates,
+            'users': [counts.get(('users', date), 0) for date in dates],
+            'photos': [counts.get(('photos', date), 0) for date in dates]}
+
+
+def compute_statistics():
+    statistics = _counts()
+    statistics['growth'] = _growth(current_app.config['ALBUMY_STATISTICS_DAYS'])
+    statistics['generated_at'] = datetime.utcnow()
+    return statistics
+
+
+def get_statistics(refresh=False):
+    """Return the dashboard statistics, computed at most once per ``ALBUMY_STATISTICS_CACHE_TTL`` seconds."""
+    app = current_app._get_current_object()
+    cache = app.extensions.setdefault('albumy_statistics', TTLCache(maxsize=1))
+    statistics = None if refresh else cache.get('statistics')
+    if statistics is None:
+        statistics = compute_statistics()
+        cache.set('statistics', statistics, app.config['ALBUMY_STATISTICS_CACHE_TTL'])
+    return statistics
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import time
+
+from flask import current_app
+
+from albumy.background import BackgroundThread
+
+
+def shard_path(filename):
+    """Return ``filename`` under its two-level hashed directory, e.g. ``3f/a2/<filename>``."""
+    digest = hashlib.md5(filename.encode()).hexdigest()
+    return '/'.join((digest[:2], digest[2:4], filename))
+
+
+def move_to_shard(directory, filename):
+    """Move the flat ``filename`` in ``directory`` into its hashed directory and return the new name.
+
+    Names that are already sharded are returned unchanged, and a file moved earlier is not touched,
+    so this can be repeated after an interruption.
+    """
+    if filename is None or '/' in filename:
+        return filename
+    sharded = shard_path(filename)
+    source = os.path.join(directory, filename)
+    if os.path.exists(source):
+        target = os.path.join(directory, sharded)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+    return sharded
+
+
+def resolve_upload(directory, filename):
+    # 迁移期间数据库里可能还是旧的文件名，而文件已经移到了分级目录下
+    if '/' not in filename and not os.path.exists(os.path.join(directory, filename)):
+        sharded = shard_path(filename)
+        if os.path.exists(os.path.join(directory, sharded)):
+            return sharded
+    return filename
+
+
+def migrate_to_shards(batch_size=500):
+    """Move the files of existing photos, blobs and avatars into the hashed layout, committing
+    every ``batch_size`` rows. Rows are picked by their flat names, so an interrupted run resumes
+    where it stopped. Return the number of rows updated.
+    """
+    from albumy.extensions import db
+    from albumy.models import Photo, Blob, User
+
+    upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+    tables = [(Photo, ('filename', 'filename_s', 'filename_m'), upload_path),
+              (Blob, ('filename', 'filename_s', 'filename_m'), upload_path),
+              (User, ('avatar_s', 'avatar_m', 'avatar_l', 'avatar_raw'), current_app.config['AVATARS_SAVE_PATH'])]
+    updated = 0
+    for model, columns, directory in tables:
+        flat = db.or_(*[getattr(model, column).notlike('%/%') for column in columns])
+        while True:
+            rows = model.query.filter(flat).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            # 先移动文件再更新数据库，两者之间的请求由 resolve_upload 找到新位置
+            for row in rows:
+                for column in columns:
+                    setattr(row, column, move_to_shard(directory, getattr(row, column)))
+            db.session.commit()
+            updated += len(rows)
+    return updated
+
+
+class DeleteSweeper(BackgroundThread):
+    """在后台线程中删除 PendingDelete 记录的文件，提交后被唤醒，空闲时定期检查遗留的记录。"""
+
+    name = 'delete-sweeper'
+
+    def interval(self, app):
+        return app.config['ALBUMY_DELETE_SWEEP_INTERVAL']
+
+    def work(self, app, woken):
+        from albumy.models import PendingDelete
+
+        while PendingDelete.sweep():
+            pass
+
+
+delete_sweeper = DeleteSweeper()
+
+
+def _walk_files(directory, skip):
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [name for name in dirs if os.path.join(root, name) not in skip]
+        for name in files:
+            yield os.path.relpath(os.path.join(root, name), directory).replace(os.sep, '/')
+
+
+def collect_garbage(min_age, dry_run=False):
+    """Remove the files in the upload and avatar directories that no row references and that
+    were last modified more than ``min_age`` seconds ago. Return ``(count, bytes)`` reclaimed.
+    """
+    from albumy.extensions import db
+    from albumy.models import Photo, Blob, User
+
+    upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+    avatar_path = current_app.config['AVATARS_SAVE_PATH']
+    directories = [
+        (upload_path, [Photo.filename, Photo.filename_s, Photo.filename_m,
+                       Blob.filename, Blob.filename_s, Blob.filename_m]),
+        (avatar_path, [User.avatar_s, User.avatar_m, User.avatar_l, User.avatar_raw]),
+    ]
+    # 头像目录单独处理，按需生成的图片缓存由自己的 LRU 管理
+    skip = {avatar_path, current_app.config['ALBUMY_RESPONSIVE_CACHE_PATH']}
+    deadline = time.time() - min_age
+    count = size = 0
+    for directory, columns in directories:
+        referenced = set()
+        for column in columns:
+            referenced.update(db.session.scalars(db.select(column).where(column.isnot(None))))
+        for filename in _walk_files(directory, skip):
+            path = os.path.join(directory, filename)
+            # 迁移到分级目录之前的记录仍使用平铺的文件名
+            if filename in referenced or os.path.basename(filename) in referenced:
+                continue
+            stat = os.stat(path)
+            if stat.st_mtime > deadline:
+                continue
+            if not dry_run:
+                os.remove(path)
+            count += 1
+            size += stat.st_size
+    return count, size
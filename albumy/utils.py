@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import mimetypes
 import os
+import time
 import uuid
 
 from PIL import Image
@@ -14,7 +17,8 @@ try:
 except ImportError:
     from urllib.parse import urlparse, urljoin
 
-from flask import request, url_for, redirect, flash, current_app
+from flask import request, url_for, redirect, flash, current_app, send_from_directory, abort
+from werkzeug.security import safe_join
 
 
 def generate_token(user, operation, **kwargs):
@@ -59,18 +63,91 @@ def rename_image(old_filename):
     return new_filename
 
 
-def resize_image(image, filename, base_width):
-    filename, ext = os.path.splitext(filename)
-    img = Image.open(image)
-    if img.size[0] <= base_width:
-        return filename + ext
-    w_percent = (base_width / float(img.size[0]))
-    h_size = int((float(img.size[1]) * float(w_percent)))
-    img = img.resize((base_width, h_size), Image.ANTIALIAS)
+def send_upload(directory, filename, max_age, immutable=False):
+    """Send a file from the upload directories with caching headers.
+
+    With ``ALBUMY_X_ACCEL_REDIRECT_PREFIX`` set, only the headers are returned and the front proxy
+    sends the file; otherwise ``send_from_directory`` answers conditional and Range requests itself
+    (or passes the file to the server when ``USE_X_SENDFILE`` is enabled).
+    """
+    prefix = current_app.config['ALBUMY_X_ACCEL_REDIRECT_PREFIX']
+    if prefix:
+        path = safe_join(directory, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        location = os.path.relpath(path, current_app.config['ALBUMY_UPLOAD_PATH']).replace(os.sep, '/')
+        response = current_app.response_class(
+            mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + location
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    else:
+        response = send_from_directory(directory, filename, max_age=max_age)
+    response.cache_control.immutable = immutable
+    return response
+
+
+def save_upload(file):
+    """Stream an uploaded ``file`` into the upload directory under a temporary name while
+    hashing its content. Return ``(path, content_hash)``.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    path = os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], uuid.uuid4().hex + '.tmp')
+    with open(path, 'wb') as f:
+        for chunk in iter(lambda: file.stream.read(64 * 1024), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    return path, digest.hexdigest()
+
+
+def derive_images(path, filename):
+    """Decode the image at ``path`` once and save a resized copy for every width in
+    ``ALBUMY_PHOTO_SIZE``, each one scaled from the next larger copy.
+
+    Return ``(filenames, timings)``: ``filenames`` maps each width to the saved file name, or to
+    ``filename`` itself when the image is not wider than that; ``timings`` maps each stage to seconds.
+    """
+    filenames, timings = _derive_images(path, filename, current_app.config['ALBUMY_UPLOAD_PATH'],
+                                        current_app.config['ALBUMY_PHOTO_SUFFIX'])
+    log_derive_timings(filename, timings)
+    return filenames, timings
+
+
+def log_derive_timings(filename, timings):
+    current_app.logger.debug('Derived images for %s: %s', filename,
+                             ', '.join('%s %.1fms' % (stage, seconds * 1000) for stage, seconds in timings.items()))
+
+
+def _derive_images(path, filename, upload_path, suffixes):
+    # 不依赖应用上下文，可以在 worker 的子进程中执行
+    name, ext = os.path.splitext(filename)
+    widths = sorted(suffixes, reverse=True)
+    filenames, timings = {}, {}
+    
+    start = time.perf_counter()
+    img = Image.open(path)
+    original_width = img.size[0]
+    if img.format == 'JPEG' and original_width > widths[0]:
+        # JPEG 可以在解码时按 1/2、1/4、1/8 缩小，得到的尺寸不小于最大的目标尺寸
+        img.draft(img.mode, (widths[0], img.size[1] * widths[0] // img.size[0]))
+    img.load()
+    timings['decode'] = time.perf_counter() - start
     
-    filename += current_app.config['ALBUMY_PHOTO_SUFFIX'][base_width] + ext
-    img.save(os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename), optimize=True, quality=85)
-    return filename
+    for width in widths:
+        if original_width <= width:
+            filenames[width] = filename
+            continue
+        if img.size[0] > width:
+            start = time.perf_counter()
+            # reducing_gap 先用 reduce() 整数倍缩小，再用 LANCZOS 缩放到目标尺寸
+            img = img.resize((width, round(img.size[1] * width / img.size[0])), Image.LANCZOS, reducing_gap=3.0)
+            timings['resize_%d' % width] = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        filenames[width] = name + suffixes[width] + ext
+        img.save(os.path.join(upload_path, filenames[width]), optimize=True, quality=85)
+        timings['save_%d' % width] = time.perf_counter() - start
+    return filenames, timings
 
 
 def is_safe_url(target):
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from flask import current_app
+
+from albumy.models import DerivativeJob
+from albumy.utils import _derive_images, log_derive_timings
+
+
+def run_worker(workers, once=False, poll_interval=1.0):
+    """Run derivative jobs in a pool of ``workers`` processes and return the number finished.
+
+    The database is only touched from this process; the pool just decodes and writes images.
+    With ``once`` the worker exits when no job is ready instead of polling for new ones.
+    """
+    upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+    suffixes = current_app.config['ALBUMY_PHOTO_SUFFIX']
+    finished_count = 0
+    running = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # 只领取空闲进程数量的任务，其余的留给其他 worker
+            if len(running) < workers:
+                for job in DerivativeJob.claim(workers - len(running)):
+                    filename = job.blob.filename
+                    future = executor.submit(_derive_images, os.path.join(upload_path, filename), filename,
+                                             upload_path, suffixes)
+                    running[future] = (job.id, job.blob_id, filename)
+            if not running:
+                if once:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            finished, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in finished:
+                job_id, blob_id, filename = running.pop(future)
+                try:
+                    filenames, timings = future.result()
+                except Exception as e:
+                    current_app.logger.warning('Derivative job %d failed: %r', job_id, e)
+                    DerivativeJob.fail(job_id, repr(e))
+                    continue
+                log_derive_timings(filename, timings)
+                DerivativeJob.complete(job_id, blob_id, filenames)
+                finished_count += 1
+    return finished_count
@@ -0,0 +1,39 @@
+"""store tag hot score in log space
+
+Revision ID: 6d9c2b7e4a18
+Revises: 0b6e3f9a2d74
+Create Date: 2026-10-19 00:26:43.190874
+
+"""
+import math
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6d9c2b7e4a18'
+down_revision = '0b6e3f9a2d74'
+branch_labels = None
+depends_on = None
+
+tag_popularity = sa.table('tag_popularity', sa.column('tag_id', sa.Integer), sa.column('hot_score', sa.Float))
+
+
+def _convert(convert):
+    connection = op.get_bind()
+    rows = connection.execute(sa.select(tag_popularity.c.tag_id, tag_popularity.c.hot_score)).all()
+    if not rows:
+        return
+    connection.execute(tag_popularity.update().where(tag_popularity.c.tag_id == sa.bindparam('b_tag_id')).
+                       values(hot_score=sa.bindparam('b_hot_score')),
+                       [{'b_tag_id': tag_id, 'b_hot_score': convert(hot_score)} for tag_id, hot_score in rows])
+
+
+def upgrade():
+    # 只改变热度的保存方式，没有结构变化；也可以之后运行 flask rebuild-tag-popularity 重新计算
+    _convert(lambda hot_score: math.log2(hot_score) if hot_score > 0 else -1e9)
+
+
+def downgrade():
+    _convert(lambda hot_score: 2 ** min(hot_score, 1023) if hot_score > -1e9 else 0)
@@ -0,0 +1,47 @@
+"""add sqlite full-text search indexes
+
+Revision ID: 8d2b7f4e0c61
+Revises: 3e9a6c1d7f20
+Create Date: 2026-10-18 17:21:09.583142
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2b7f4e0c61'
+down_revision = '3e9a6c1d7f20'
+branch_labels = None
+depends_on = None
+
+# 表名和被索引的列，与 albumy.search.SEARCH_INDEXES 一致
+indexes = [('user', ('name', 'username')), ('photo', ('description',)), ('tag', ('name',))]
+
+
+def upgrade():
+    # FTS5 只用于 SQLite，其他数据库继续使用 Whoosh
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for table, columns in indexes:
+        fts = table + '_fts'
+        names = ', '.join(columns)
+        new = ', '.join('new.' + column for column in columns)
+        old = ', '.join('old.' + column for column in columns)
+        delete = f"INSERT INTO {fts}({fts}, rowid, {names}) VALUES ('delete', old.id, {old});"
+        insert = f"INSERT INTO {fts}(rowid, {names}) VALUES (new.id, {new});"
+        op.execute(f"CREATE VIRTUAL TABLE {fts} USING fts5({names}, content='{table}', content_rowid='id', "
+                   f"tokenize='unicode61 remove_diacritics 2')")
+        op.execute(f'CREATE TRIGGER {fts}_ai AFTER INSERT ON "{table}" BEGIN {insert} END')
+        op.execute(f'CREATE TRIGGER {fts}_ad AFTER DELETE ON "{table}" BEGIN {delete} END')
+        op.execute(f'CREATE TRIGGER {fts}_au AFTER UPDATE OF {names} ON "{table}" BEGIN {delete} {insert} END')
+        op.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for table, _ in indexes:
+        for suffix in ('ai', 'ad', 'au'):
+            op.execute(f'DROP TRIGGER IF EXISTS {table}_fts_{suffix}')
+        op.execute(f'DROP TABLE IF EXISTS {table}_fts')
@@ -1,16 +1,29 @@
 # -*- codeing = utf-8 -*-
+import os
+import shutil
+import tempfile
 import unittest
 
 from flask import url_for
 
 from albumy import create_app
+from albumy.emails import mail_queue
 from albumy.extensions import db
+from albumy.indexing import search_indexer
 from albumy.models import Role, User, Photo, Comment, Tag
+from albumy.storage import delete_sweeper
 
 
 class BaseTestCase(unittest.TestCase):
     def setUp(self) -> None:
         app = create_app('testing')
+        # 上传的文件、头像、缓存和搜索索引都写入临时目录，不改动工作区
+        self.upload_path = tempfile.mkdtemp()
+        app.config['ALBUMY_UPLOAD_PATH'] = self.upload_path
+        app.config['AVATARS_SAVE_PATH'] = os.path.join(self.upload_path, 'avatars')
+        app.config['ALBUMY_RESPONSIVE_CACHE_PATH'] = os.path.join(self.upload_path, 'cache')
+        app.extensions['whooshee']['index_path_root'] = os.path.join(self.upload_path, 'whooshee')
+        os.makedirs(app.config['AVATARS_SAVE_PATH'])
         self.context = app.test_request_context()
         self.context.push()
         self.client = app.test_client(use_cookies=True)
@@ -21,18 +34,18 @@ class BaseTestCase(unittest.TestCase):
         Role.init_role()
         
         admin_user = User(email='admin@helloflask.com', name='Admin', username='admin', confirmed=True)
-        admin_user.set_password('123456')
+        admin_user.set_password('12345678')
         
         normal_user = User(email='normal@helloflask.com', name='Normal User', username='normal', confirmed=True)
-        normal_user.set_password('123456')
+        normal_user.set_password('12345678')
         
         unconfirmed_user = User(email='unconfirmed@helloflask.com', name='Unconfirmed', username='unconfirmed',
                                 confirmed=False)
-        unconfirmed_user.set_password('123456')
+        unconfirmed_user.set_password('12345678')
         
         locked_user = User(email='locked@helloflask.com', name='Locked User', username='locked',
                            confirmed=True, locked=True)
-        locked_user.set_password('123456')
+        locked_user.set_password('12345678')
         locked_user.lock()
         
         blocked_user = User(email='blocked@helloflask.com', name='Blocked User', username='blocked',
@@ -50,17 +63,23 @@ class BaseTestCase(unittest.TestCase):
         
         photo.tags.append(tag)
         
-        db.session.add_all([admin_user, normal_user, unconfirmed_user, locked_user, blocked_user])
+        db.session.add_all([admin_user, normal_user, unconfirmed_user, locked_user, blocked_user, photo, photo2])
         db.session.commit()
     
     def tearDown(self) -> None:
+        # 先停止后台线程，避免它们在删除数据表后继续访问数据库
+        self.doCleanups()
+        delete_sweeper.stop()
+        search_indexer.stop()
+        mail_queue.stop()
         db.drop_all()
         self.context.pop()
+        shutil.rmtree(self.upload_path, ignore_errors=True)
     
     def login(self, email=None, password=None):
         if email is None and password is None:
             email = 'normal@helloflask.com'
-            password = '123456'
+            password = '12345678'
         
         return self.client.post(url_for('auth.login'), data=dict(
             email=email,
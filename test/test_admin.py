@@ -1 +1,103 @@
 # -*- codeing = utf-8 -*-
+import os
+
+from flask import current_app, url_for
+
+from albumy.extensions import db
+from albumy.moderation import set_users_locked
+from albumy.models import User, Photo, Tag, TagPopularity, Comment, Collect, PendingDelete
+from albumy.statistics import get_statistics
+from test.base import BaseTestCase
+
+
+class AdminTestCase(BaseTestCase):
+    
+    def test_dashboard_statistics(self):
+        self.login(email='admin@helloflask.com', password='12345678')
+        data = self.client.get(url_for('admin.statistics')).get_json()
+        self.assertEqual((data['user_count'], data['locked_user_count'], data['blocked_user_count']), (5, 1, 1))
+        self.assertEqual((data['photo_count'], data['reported_photos_count']), (2, 0))
+        self.assertEqual((data['tag_count'], data['comment_count'], data['reported_comments_count']), (1, 1, 0))
+        self.assertEqual(len(data['growth']['days']), current_app.config['ALBUMY_STATISTICS_DAYS'])
+        self.assertEqual((data['growth']['users'][-1], data['growth']['photos'][-1]), (5, 2))
+        self.assertEqual(sum(data['growth']['users']), 5)
+        
+        db.session.add(Photo(filename='test3.jpg', description='Photo 3', flag=1))
+        db.session.commit()
+        # 缓存有效期内返回同一份快照
+        self.assertEqual(self.client.get(url_for('admin.statistics')).get_json()['photo_count'], 2)
+        statistics = get_statistics(refresh=True)
+        self.assertEqual((statistics['photo_count'], statistics['reported_photos_count']), (3, 1))
+        self.assertEqual(statistics['growth']['photos'][-1], 3)
+        
+        data = self.client.get(url_for('admin.index')).get_data(as_text=True)
+        self.assertIn('Reported: 1', data)
+        self.assertIn('New photos: 3', data)
+    
+    def test_bulk_moderation(self):
+        self.login(email='admin@helloflask.com', password='12345678')
+        headers = {'Accept': 'application/json'}
+        for endpoint in ('admin.manage_user', 'admin.manage_photo', 'admin.manage_comment', 'admin.manage_tag'):
+            self.assertIn('form="bulk-form"', self.client.get(url_for(endpoint)).get_data(as_text=True))
+        admin_user = User.query.filter_by(username='admin').first()
+        normal_user = User.query.filter_by(username='normal').first()
+        # 不会锁定自己和管理员
+        response = self.client.post(url_for('admin.bulk_user', action='lock'), headers=headers,
+                                    data={'ids': [admin_user.id, normal_user.id]})
+        self.assertEqual(response.get_json(), {'count': 1})
+        self.assertTrue(db.session.get(User, normal_user.id).locked)
+        self.assertEqual(db.session.get(User, normal_user.id).role.name, 'Locked')
+        response = self.client.post(url_for('admin.bulk_user', action='unblock'), headers=headers,
+                                    data={'filter': 'blocked'})
+        self.assertEqual(response.get_json(), {'count': 1})
+        self.assertEqual(User.query.filter_by(active=False).count(), 0)
+        # 解锁时管理员邮箱对应的账户恢复为 Administrator
+        admin_user.lock()
+        db.session.commit()
+        self.assertEqual(set_users_locked(User.id.in_([admin_user.id, normal_user.id]), False), 2)
+        self.assertEqual(db.session.get(User, admin_user.id).role.name, 'Administrator')
+        self.assertEqual(db.session.get(User, normal_user.id).role.name, 'User')
+        
+        upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+        photo = Photo.query.filter_by(description='Photo 1').first()
+        photo2 = Photo.query.filter_by(description='Photo 2').first()
+        photo.filename = 'bulk-test.jpg'
+        photo2.flag = 2
+        TagPopularity.rebuild()
+        comment = photo.comments[0]
+        db.session.add(Comment(body='reply', photo=photo, author=admin_user, replied=comment))
+        normal_user.collect(photo)
+        path = os.path.join(upload_path, 'bulk-test.jpg')
+        with open(path, 'wb') as f:
+            f.write(b'bulk')
+        try:
+            response = self.client.post(url_for('admin.bulk_photo', action='delete'), headers=headers,
+                                        data={'ids': [photo.id]})
+            self.assertEqual(response.get_json(), {'count': 1})
+            self.assertFalse(os.path.exists(path))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        self.assertEqual(Photo.query.count(), 1)
+        self.assertEqual(Comment.query.count(), 0)
+        self.assertEqual(Collect.query.count(), 0)
+        self.assertEqual(TagPopularity.query.one().photo_count, 0)
+        self.assertEqual(PendingDelete.query.count(), 0)
+        
+        response = self.client.post(url_for('admin.bulk_photo', action='unflag'), headers=headers,
+                                    data={'filter': 'reported'})
+        self.assertEqual(response.get_json(), {'count': 1})
+        response = self.client.post(url_for('admin.bulk_tag'), data={'filter': 'unused'}, follow_redirects=True)
+        self.assertIn('1 tags deleted.', response.get_data(as_text=True))
+        self.assertEqual((Tag.query.count(), TagPopularity.query.count()), (0, 0))
+        
+        comment = Comment(body='spam', photo=photo2, author=normal_user)
+        db.session.add(Comment(body='reply', photo=photo2, author=admin_user, replied=comment))
+        db.session.commit()
+        self.assertEqual(db.session.get(Photo, photo2.id).comments_count, 2)
+        response = self.client.post(url_for('admin.bulk_comment', action='delete'), headers=headers,
+                                    data={'ids': [comment.id]})
+        self.assertEqual(response.get_json(), {'count': 2})
+        self.assertEqual(db.session.get(Photo, photo2.id).comments_count, 0)
+        # 没有指定 ids 或过滤条件时拒绝
+        self.assertEqual(self.client.post(url_for('admin.bulk_comment', action='delete')).status_code, 400)
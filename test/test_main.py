@@ -0,0 +1,916 @@
+# -*- codeing = utf-8 -*-
+import base64
+import io
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+from flask import current_app, url_for
+from PIL import Image
+
+from albumy.autocomplete import PrefixIndex, Autocomplete
+from albumy.emails import send_confirm_email, deliver, send_outbox, MailQueue
+from albumy.events import LocalBroker, get_broker, user_channel
+from albumy.extensions import db, mail
+from albumy.indexing import SearchIndexer
+from albumy.models import User, Photo, Timeline, Tag, TagPopularity, Role, Notification, DerivativeJob, \
+    Blob, PendingDelete, OutboxMail, SearchChange, Comment, Report, NotificationActor
+from albumy.moderation import delete_photos
+from albumy.nitifications import push_follow_notification, push_comment_notification, \
+    push_collect_notification
+from albumy.pagination import keyset_paginate
+from albumy.responsive import DerivativeCache
+from albumy.sampling import PhotoSample
+from albumy.search import FTS5Backend
+from albumy.storage import shard_path
+from test.base import BaseTestCase
+
+
+class MainTestCase(BaseTestCase):
+    
+    def test_timeline_follow_and_unfollow(self):
+        normal_user = User.query.filter_by(username='normal').first()
+        admin_user = User.query.filter_by(username='admin').first()
+        self.assertEqual(Timeline.feed_query(normal_user).count(), 0)
+        
+        normal_user.follow(admin_user)
+        self.assertEqual([p.description for p in Timeline.feed_query(normal_user)], ['Photo 1'])
+        
+        normal_user.unfollow(admin_user)
+        self.assertEqual(Timeline.feed_query(normal_user).count(), 0)
+    
+    def test_timeline_fan_out(self):
+        normal_user = User.query.filter_by(username='normal').first()
+        admin_user = User.query.filter_by(username='admin').first()
+        normal_user.follow(admin_user)
+        
+        photo = Photo(filename='new.jpg', filename_s='new.jpg', filename_m='new.jpg',
+                      description='Photo 3', author=admin_user)
+        db.session.add(photo)
+        db.session.commit()
+        Timeline.fan_out(photo)
+        self.assertEqual(Timeline.query.filter_by(photo_id=photo.id).count(), 2)
+        self.assertEqual(Timeline.feed_query(normal_user).first().id, photo.id)
+        
+        db.session.delete(photo)
+        db.session.commit()
+        self.assertEqual(Timeline.query.filter_by(photo_id=photo.id).count(), 0)
+    
+    def test_timeline_fanout_on_read(self):
+        current_app.config['ALBUMY_TIMELINE_FANOUT_LIMIT'] = 0
+        normal_user = User.query.filter_by(username='normal').first()
+        admin_user = User.query.filter_by(username='admin').first()
+        normal_user.follow(admin_user)
+        
+        photo = Photo(filename='new.jpg', filename_s='new.jpg', filename_m='new.jpg',
+                      description='Photo 3', author=admin_user)
+        db.session.add(photo)
+        db.session.commit()
+        Timeline.fan_out(photo)
+        self.assertTrue(admin_user.fanout_on_read)
+        self.assertEqual(Timeline.query.filter_by(photo_id=photo.id).count(), 0)
+        self.assertIn(photo, Timeline.feed_query(normal_user).all())
+    
+    def test_keyset_pagination(self):
+        admin_user = User.query.filter_by(username='admin').first()
+        for i in range(4):
+            db.session.add(Photo(filename='%d.jpg' % i, filename_s='%d.jpg' % i, description='Page %d' % i, author=admin_user,
+                                 timestamp=datetime(2020, 1, 1, i)))
+        db.session.commit()
+        query = Photo.query.with_parent(admin_user)
+        columns = (Photo.timestamp, Photo.id)
+        key = lambda photo: (photo.timestamp, photo.id)
+        
+        first = keyset_paginate(query, columns, key=key, per_page=2)
+        self.assertEqual([p.description for p in first.items], ['Photo 1', 'Page 3'])
+        self.assertTrue(first.has_next)
+        self.assertFalse(first.has_prev)
+        
+        second = keyset_paginate(query, columns, key=key, per_page=2, cursor=first.next_cursor)
+        self.assertEqual([p.description for p in second.items], ['Page 2', 'Page 1'])
+        self.assertTrue(second.has_prev)
+        
+        last = keyset_paginate(query, columns, key=key, per_page=2, cursor='last')
+        self.assertEqual([p.description for p in last.items], ['Page 1', 'Page 0'])
+        self.assertFalse(last.has_next)
+        
+        previous = keyset_paginate(query, columns, key=key, per_page=2, cursor=second.prev_cursor)
+        self.assertEqual([p.description for p in previous.items], ['Photo 1', 'Page 3'])
+        self.assertFalse(previous.has_prev)
+        
+        response = self.client.get(url_for('user.index', username='admin', cursor=first.next_cursor))
+        data = response.get_data(as_text=True)
+        self.assertIn('/1.jpg', data)
+        self.assertNotIn('/3.jpg', data)
+        
+        # 无效的游标按第一页处理
+        dict_cursor = base64.urlsafe_b64encode(b'{"next": 1}').decode()
+        wrong_type = base64.urlsafe_b64encode(b'["next", "2020-01-01T00:00:00", "1"]').decode()
+        for cursor in ('garbage', 'zz', dict_cursor, wrong_type):
+            page = keyset_paginate(query, columns, key=key, per_page=2, cursor=cursor)
+            self.assertEqual([p.description for p in page.items], ['Photo 1', 'Page 3'])
+            response = self.client.get(url_for('user.index', username='admin', cursor=cursor))
+            self.assertEqual(response.status_code, 200)
+    
+    def test_tag_popularity(self):
+        self.login(email='admin@helloflask.com', password='12345678')
+        photo = Photo.query.filter_by(description='Photo 1').first()
+        tag = Tag.query.filter_by(name='test tag').first()
+        TagPopularity.rebuild()
+        self.assertEqual(tag.popularity.photo_count, 1)
+        
+        self.client.post(url_for('main.new_tag', photo_id=photo.id), data=dict(tag='foo bar'))
+        foo = Tag.query.filter_by(name='foo').first()
+        self.assertEqual(foo.popularity.photo_count, 1)
+        self.assertGreater(foo.popularity.hot_score, 0)
+        self.assertIn(foo, TagPopularity.top(10).all())
+        
+        self.client.post(url_for('main.delete_tag', photo_id=photo.id, tag_id=foo.id))
+        self.assertIsNone(Tag.query.filter_by(name='foo').first())
+        self.assertIsNone(TagPopularity.query.get(foo.id))
+        
+        db.session.delete(photo)
+        db.session.commit()
+        bar = Tag.query.filter_by(name='bar').first()
+        self.assertEqual(bar.popularity.photo_count, 0)
+        self.assertNotIn(bar, TagPopularity.top(10).all())
+    
+    def test_tag_hot_score_small_half_life(self):
+        # 半衰期很短时 2 ** (秒数 / 半衰期) 早已溢出，热度以对数保存
+        current_app.config['ALBUMY_TAG_HOT_HALF_LIFE'] = 60
+        current_app.config['ALBUMY_TAG_RANKING'] = 'hot'
+        self.login(email='admin@helloflask.com', password='12345678')
+        photo = Photo.query.filter_by(description='Photo 1').first()
+        older = Photo(filename='older.jpg', author=photo.author, timestamp=photo.timestamp - timedelta(seconds=90))
+        db.session.add(older)
+        db.session.commit()
+        self.client.post(url_for('main.new_tag', photo_id=photo.id), data=dict(tag='fresh shared'))
+        self.client.post(url_for('main.new_tag', photo_id=older.id), data=dict(tag='stale shared'))
+        fresh, stale, shared = (Tag.query.filter_by(name=name).first() for name in ('fresh', 'stale', 'shared'))
+        self.assertEqual([tag.name for tag in TagPopularity.top(3)], ['shared', 'fresh', 'stale'])
+        self.assertAlmostEqual(shared.popularity.hot_score - fresh.popularity.hot_score, math.log2(1 + 2 ** -1.5))
+        scores = {tag.id: tag.popularity.hot_score for tag in (fresh, stale, shared)}
+        TagPopularity.rebuild()
+        for tag in fresh, stale, shared:
+            self.assertAlmostEqual(tag.popularity.hot_score, scores[tag.id], places=6)
+        
+        self.client.post(url_for('main.delete_tag', photo_id=photo.id, tag_id=shared.id))
+        self.assertAlmostEqual(shared.popularity.hot_score, stale.popularity.hot_score, places=6)
+        self.assertEqual(delete_photos(Photo.id == older.id), 1)
+        self.assertEqual(stale.popularity.photo_count, 0)
+        self.assertEqual(stale.popularity.hot_score, TagPopularity.EMPTY_SCORE)
+        self.assertEqual([tag.name for tag in TagPopularity.top(3)], ['fresh', 'test tag'])
+    
+    def test_explore_sample(self):
+        admin_user = User.query.filter_by(username='admin').first()
+        photos = [Photo(filename='%d.jpg' % i, filename_s='%d.jpg' % i, author=admin_user) for i in range(10)]
+        db.session.add_all(photos)
+        db.session.commit()
+        for photo in photos[::3]:
+            db.session.delete(photo)
+        db.session.commit()
+        
+        sample = PhotoSample.create()
+        seen = []
+        while not sample.exhausted:
+            sample = PhotoSample.from_cursor(sample.cursor)
+            seen.extend(photo.id for photo in sample.take(3))
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(sorted(seen), sorted(photo.id for photo in Photo.query))
+        
+        current_app.config['ALBUMY_PHOTO_PER_PAGE'] = 3
+        response = self.client.get(url_for('main.explore'))
+        self.assertIn('Load more', response.get_data(as_text=True))
+        
+        # 伪造的区间收缩到现有的 id 范围，位置为负时重新开始
+        lower, upper = PhotoSample._bounds()
+        for data in [1, 0, 10 ** 30, 0], [1, -10 ** 30, 10 ** 30, 0], [1, 0, 10, -1], [1, 5, 4, 0]:
+            cursor = base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+            sample = PhotoSample.from_cursor(cursor)
+            self.assertTrue(lower <= sample.lower and sample.upper <= upper)
+            self.assertGreaterEqual(sample.position, 0)
+            response = self.client.get(url_for('main.explore', cursor=cursor))
+            self.assertEqual(response.status_code, 200)
+    
+    def test_photo_counters(self):
+        normal_user = User.query.filter_by(username='normal').first()
+        photo = Photo.query.filter_by(description='Photo 1').first()
+        self.assertEqual(photo.comments_count, 1)
+        
+        normal_user.collect(photo)
+        self.assertEqual(photo.collectors_count, 1)
+        normal_user.uncollect(photo)
+        self.assertEqual(photo.collectors_count, 0)
+        
+        db.session.delete(photo.comments[0])
+        db.session.commit()
+        self.assertEqual(photo.comments_count, 0)
+        
+        photo.collectors_count = 5
+        db.session.commit()
+        result = self.runner.invoke(args=['reconcile-counters'])
+        self.assertIn('Fixed 1 photos.', result.output)
+        self.assertEqual(photo.collectors_count, 0)
+    
+    def test_permission_cache(self):
+        admin_user = User.query.filter_by(username='admin').first()
+        normal_user = User.query.filter_by(username='normal').first()
+        self.assertTrue(admin_user.is_admin)
+        self.assertTrue(admin_user.can('ADMINISTER'))
+        self.assertTrue(normal_user.can('UPLOAD'))
+        self.assertFalse(normal_user.can('MODERATE'))
+        self.assertFalse(normal_user.can('UNKNOWN'))
+        
+        normal_user.role = Role.query.filter_by(name='Moderator').first()
+        self.assertTrue(normal_user.can('MODERATE'))
+        
+        Role.query.filter_by(name='User').first().permissions = []
+        db.session.commit()
+        Role.init_role()
+        self.assertTrue(User.query.filter_by(username='unconfirmed').first().can('UPLOAD'))
+    
+    def test_upload_derives_images(self):
+        image = io.BytesIO()
+        Image.new('RGB', (1600, 1200), 'red').save(image, 'JPEG')
+        self.login()
+        for _ in range(2):
+            response = self.client.post(url_for('main.upload'),
+                                        data={'file': (io.BytesIO(image.getvalue()), 'test.jpg')})
+            self.assertEqual(response.status_code, 200)
+        
+        photo, duplicate = Photo.query.order_by(Photo.id.desc()).limit(2).all()
+        upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+        filenames = {photo.filename}
+        try:
+            self.assertEqual(photo.blob, duplicate.blob)
+            self.assertEqual(photo.blob.ref_count, 2)
+            self.assertFalse(photo.derivatives_ready)
+            self.assertEqual(photo.filename_s, photo.filename)
+            result = self.runner.invoke(args=['albumy-worker', '--once', '--workers', '1'])
+            self.assertIn('Finished 1 jobs.', result.output)
+            self.assertTrue(photo.derivatives_ready)
+            self.assertTrue(duplicate.derivatives_ready)
+            self.assertEqual(duplicate.filename_s, photo.filename_s)
+            self.assertEqual(DerivativeJob.query.count(), 0)
+            
+            filenames = {photo.filename, photo.filename_s, photo.filename_m}
+            self.assertEqual(Image.open(os.path.join(upload_path, photo.filename_m)).size, (800, 600))
+            self.assertEqual(Image.open(os.path.join(upload_path, photo.filename_s)).size, (400, 300))
+            
+            db.session.delete(duplicate)
+            db.session.commit()
+            self.assertTrue(all(os.path.exists(os.path.join(upload_path, name)) for name in filenames))
+            db.session.delete(photo)
+            db.session.commit()
+            self.assertFalse(any(os.path.exists(os.path.join(upload_path, name)) for name in filenames))
+            self.assertEqual(Blob.query.count(), 0)
+        finally:
+            for filename in filenames:
+                if os.path.exists(os.path.join(upload_path, filename)):
+                    os.remove(os.path.join(upload_path, filename))
+    
+    def test_blob_acquire(self):
+        upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+        path = os.path.join(upload_path, 'upload.tmp')
+        # 引用数已降为 0 但还没删除的 blob 不能直接引用，新建冲突后重新取得引用
+        released = Blob(hash='abc', filename=shard_path('abc.jpg'), ref_count=0)
+        db.session.add(released)
+        db.session.commit()
+        with open(path, 'wb') as f:
+            f.write(b'abc')
+        blob, created = Blob.acquire('abc', '.jpg', path)
+        db.session.commit()
+        self.assertEqual((blob.id, created, blob.ref_count), (released.id, False, 1))
+        self.assertTrue(os.path.exists(os.path.join(upload_path, blob.filename)))
+        
+        # 取得引用后才删除重复上传的文件
+        with open(path, 'wb') as f:
+            f.write(b'abc')
+        blob, created = Blob.acquire('abc', '.jpg', path)
+        db.session.commit()
+        self.assertEqual((blob.id, created, blob.ref_count), (released.id, False, 2))
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(os.path.join(upload_path, blob.filename)))
+    
+    def test_derivative_job_retry(self):
+        photo = Photo.query.filter_by(description='Photo 1').first()
+        photo.blob = Blob(hash='missing', filename=photo.filename, ref_count=1)
+        db.session.add(DerivativeJob(blob=photo.blob))
+        db.session.commit()
+        result = self.runner.invoke(args=['albumy-worker', '--once', '--workers', '1'])
+        self.assertIn('Finished 0 jobs.', result.output)
+        
+        job = DerivativeJob.query.first()
+        self.assertEqual(job.status, 'pending')
+        self.assertEqual(job.attempts, 1)
+        self.assertIsNotNone(job.last_error)
+        self.assertGreater(job.run_after, datetime.utcnow())
+        
+        job.attempts = current_app.config['ALBUMY_JOB_MAX_ATTEMPTS'] - 1
+        job.run_after = datetime.utcnow()
+        db.session.commit()
+        self.runner.invoke(args=['albumy-worker', '--once', '--workers', '1'])
+        self.assertEqual(job.status, 'failed')
+        
+        db.session.delete(photo)
+        db.session.commit()
+        self.assertEqual(DerivativeJob.query.count(), 0)
+    
+    def test_image_caching(self):
+        upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+        with open(os.path.join(upload_path, 'cache-test.jpg'), 'wb') as f:
+            f.write(b'0123456789')
+        try:
+            response = self.client.get(url_for('main.get_image', filename='cache-test.jpg'))
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.cache_control.immutable)
+            self.assertEqual(response.cache_control.max_age, current_app.config['ALBUMY_IMAGE_CACHE_MAX_AGE'])
+            etag = response.headers['ETag']
+            self.assertFalse(etag.startswith('W/'))
+            
+            response = self.client.get(url_for('main.get_image', filename='cache-test.jpg'),
+                                       headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            response = self.client.get(url_for('main.get_image', filename='cache-test.jpg'),
+                                       headers={'Range': 'bytes=2-5'})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.data, b'2345')
+            
+            current_app.config['ALBUMY_X_ACCEL_REDIRECT_PREFIX'] = '/_uploads/'
+            response = self.client.get(url_for('main.get_image', filename='cache-test.jpg'))
+            self.assertEqual(response.headers['X-Accel-Redirect'], '/_uploads/cache-test.jpg')
+            self.assertEqual(response.mimetype, 'image/jpeg')
+            self.assertEqual(response.data, b'')
+            response = self.client.get(url_for('main.get_image', filename='missing.jpg'))
+            self.assertEqual(response.status_code, 404)
+        finally:
+            os.remove(os.path.join(upload_path, 'cache-test.jpg'))
+    
+    def test_responsive_image(self):
+        upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+        Image.new('RGB', (1600, 1200), 'blue').save(os.path.join(upload_path, 'responsive-test.jpg'))
+        with open(os.path.join(upload_path, 'responsive-broken.jpg'), 'wb') as f:
+            f.write(b'not an image')
+        photo = Photo.query.filter_by(description='Photo 1').first()
+        photo.filename = 'responsive-test.jpg'
+        db.session.add(Photo(filename='responsive-broken.jpg', author=photo.author))
+        db.session.commit()
+        current_app.config['ALBUMY_RESPONSIVE_CACHE_PATH'] = os.path.join(upload_path, 'cache-test')
+        try:
+            response = self.client.get(url_for('main.get_responsive_image', width=400, image_format='webp',
+                                               filename='responsive-test.jpg'))
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.cache_control.immutable)
+            image = Image.open(io.BytesIO(response.data))
+            self.assertEqual((image.format, image.size), ('WEBP', (400, 300)))
+            response.close()
+            
+            response = self.client.get(url_for('main.get_responsive_image', width=401, image_format='webp',
+                                               filename='responsive-test.jpg'))
+            self.assertEqual(response.status_code, 404)
+            response = self.client.get(url_for('main.get_responsive_image', width=400, image_format='gif',
+                                               filename='responsive-test.jpg'))
+            self.assertEqual(response.status_code, 404)
+            # 只有图片的原图可以作为来源，不是图片的文件返回 404 而不是 500
+            avatar = User.query.filter_by(username='normal').first().avatar_l
+            response = self.client.get(url_for('main.get_responsive_image', width=400, image_format='webp',
+                                               filename='avatars/' + avatar))
+            self.assertEqual(response.status_code, 404)
+            response = self.client.get(url_for('main.get_responsive_image', width=400, image_format='webp',
+                                               filename='responsive-broken.jpg'))
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(os.listdir(current_app.config['ALBUMY_RESPONSIVE_CACHE_PATH']),
+                             ['responsive-test_w400.webp'])
+            
+            cache = DerivativeCache(current_app.config['ALBUMY_RESPONSIVE_CACHE_PATH'], 1)
+            
+            def generate(source, path):
+                with open(path, 'wb') as f:
+                    f.write(b'x')
+            
+            cache.get(None, 'first', generate)
+            cache.get(None, 'second', generate)
+            self.assertEqual(sorted(os.listdir(cache.path)), ['second'])
+        finally:
+            os.remove(os.path.join(upload_path, 'responsive-test.jpg'))
+            os.remove(os.path.join(upload_path, 'responsive-broken.jpg'))
+            shutil.rmtree(current_app.config['ALBUMY_RESPONSIVE_CACHE_PATH'])
+    
+    def test_shard_uploads(self):
+        upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+        photo = Photo.query.filter_by(description='Photo 1').first()
+        photo.filename = 'shard-test.jpg'
+        db.session.commit()
+        with open(os.path.join(upload_path, 'shard-test.jpg'), 'wb') as f:
+            f.write(b'shard')
+        try:
+            result = self.runner.invoke(args=['shard-uploads', '--batch', '1'])
+            self.assertIn('Updated 2 rows.', result.output)
+            self.assertEqual(photo.filename, shard_path('shard-test.jpg'))
+            self.assertTrue(os.path.exists(os.path.join(upload_path, photo.filename)))
+            self.assertTrue(User.query.first().avatar_s.count('/') == 2)
+            
+            response = self.client.get(url_for('main.get_image', filename='shard-test.jpg'))
+            self.assertEqual(response.data, b'shard')
+            response.close()
+            result = self.runner.invoke(args=['shard-uploads'])
+            self.assertIn('Updated 0 rows.', result.output)
+        finally:
+            os.remove(os.path.join(upload_path, shard_path('shard-test.jpg')))
+    
+    def test_deferred_file_deletion(self):
+        upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+        photo = Photo.query.filter_by(description='Photo 1').first()
+        photo.filename = 'delete-test.jpg'
+        db.session.commit()
+        path = os.path.join(upload_path, 'delete-test.jpg')
+        with open(path, 'wb') as f:
+            f.write(b'delete')
+        try:
+            db.session.delete(photo)
+            db.session.flush()
+            self.assertEqual(PendingDelete.query.filter_by(filename='delete-test.jpg').count(), 1)
+            db.session.rollback()
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(PendingDelete.query.count(), 0)
+            
+            db.session.delete(photo)
+            db.session.commit()
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(PendingDelete.query.count(), 0)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def test_gc_uploads(self):
+        upload_path = tempfile.mkdtemp()
+        current_app.config['ALBUMY_UPLOAD_PATH'] = upload_path
+        current_app.config['AVATARS_SAVE_PATH'] = os.path.join(upload_path, 'avatars')
+        current_app.config['ALBUMY_RESPONSIVE_CACHE_PATH'] = os.path.join(upload_path, 'cache')
+        photo = Photo.query.filter_by(description='Photo 1').first()
+        photo.filename = shard_path('kept.jpg')
+        db.session.commit()
+        try:
+            for filename in photo.filename, 'orphan.jpg', 'avatars/orphan_s.png', 'cache/kept_w400.webp':
+                os.makedirs(os.path.dirname(os.path.join(upload_path, filename)), exist_ok=True)
+                with open(os.path.join(upload_path, filename), 'wb') as f:
+                    f.write(b'gc')
+            
+            result = self.runner.invoke(args=['gc-uploads', '--min-age', '3600'])
+            self.assertIn('Removed 0 files', result.output)
+            result = self.runner.invoke(args=['gc-uploads', '--min-age', '0', '--dry-run'])
+            self.assertIn('Found 2 files', result.output)
+            result = self.runner.invoke(args=['gc-uploads', '--min-age', '0'])
+            self.assertIn('Removed 2 files', result.output)
+            self.assertTrue(os.path.exists(os.path.join(upload_path, photo.filename)))
+            self.assertTrue(os.path.exists(os.path.join(upload_path, 'cache/kept_w400.webp')))
+            self.assertFalse(os.path.exists(os.path.join(upload_path, 'orphan.jpg')))
+            self.assertFalse(os.path.exists(os.path.join(upload_path, 'avatars/orphan_s.png')))
+        finally:
+            shutil.rmtree(upload_path)
+    
+    def test_identity_cache(self):
+        statements = []
+        
+        def count_statement(*args):
+            statements.append(args[2])
+        
+        normal_user = User.query.filter_by(username='normal').first()
+        user_id = normal_user.id
+        User.clear_cached()
+        db.session.expunge_all()
+        db.event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            self.assertTrue(User.get_cached(user_id).can('UPLOAD'))
+            db.session.expunge_all()
+            del statements[:]
+            user = User.get_cached(user_id)
+            self.assertEqual(user.username, 'normal')
+            self.assertTrue(user.can('UPLOAD'))
+            self.assertEqual(statements, [])
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count_statement)
+        
+        user.block()
+        db.session.commit()
+        db.session.expunge_all()
+        self.assertFalse(User.get_cached(user_id).active)
+        
+        # 解锁时重新分配默认角色，管理员账户仍是 Administrator
+        admin_id = User.query.filter_by(username='admin').first().id
+        self.assertTrue(User.get_cached(admin_id).can('MODERATE'))
+        User.get_cached(admin_id).lock()
+        db.session.commit()
+        db.session.expunge_all()
+        self.assertFalse(User.get_cached(admin_id).can('MODERATE'))
+        User.get_cached(admin_id).unlock()
+        db.session.commit()
+        db.session.expunge_all()
+        self.assertTrue(User.get_cached(admin_id).can('MODERATE'))
+        self.assertEqual(User.query.get(admin_id).role.name, 'Administrator')
+    
+    def test_unread_notification_count(self):
+        admin_user = User.query.filter_by(username='admin').first()
+        normal_user = User.query.filter_by(username='normal').first()
+        push_follow_notification(follower=admin_user, receiver=normal_user)
+        push_comment_notification(photo_id=1, receiver=normal_user)
+        self.assertEqual(normal_user.unread_notification_count, 2)
+        
+        self.login()
+        response = self.client.get(url_for('ajax.notifications_count'))
+        self.assertEqual(response.get_json()['count'], 2)
+        
+        notification = Notification.query.with_parent(normal_user).first()
+        self.client.post(url_for('main.read_notification', notification_id=notification.id))
+        self.client.post(url_for('main.read_notification', notification_id=notification.id))
+        self.assertEqual(normal_user.unread_notification_count, 1)
+        
+        self.client.post(url_for('main.read_all_notification'))
+        self.assertEqual(normal_user.unread_notification_count, 0)
+        
+        normal_user.unread_notification_count = 3
+        db.session.commit()
+        result = self.runner.invoke(args=['reconcile-counters'])
+        self.assertIn('Fixed 1 users.', result.output)
+        self.assertEqual(normal_user.unread_notification_count, 0)
+    
+    def test_bulk_notification_operations(self):
+        normal_user = User.query.filter_by(username='normal').first()
+        for i in range(5):
+            db.session.add(Notification(message='Notification %d' % i, receiver=normal_user,
+                                        timestamp=datetime(2020, 1, i + 1)))
+        db.session.commit()
+        User.reconcile_unread_notification_count()
+        notification_ids = [notification.id for notification in Notification.query.order_by(Notification.id)]
+        
+        self.login()
+        response = self.client.post(url_for('ajax.read_notifications'), json={'ids': notification_ids[:2]})
+        self.assertEqual(response.get_json()['count'], 2)
+        self.assertEqual(response.get_json()['unread'], 3)
+        for body in {'ids': ['1']}, {'ids': 5}, {'ids': [True]}, [1, 2], 'ids':
+            response = self.client.post(url_for('ajax.read_notifications'), json=body)
+            self.assertEqual(response.status_code, 400)
+        response = self.client.post(url_for('ajax.read_notifications'), data='{',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        for body in {'days': '1'}, {'days': -1}, {'days': 1000000}, {'read_only': 'no'}, [1, 2], 'days':
+            response = self.client.post(url_for('ajax.delete_notifications'), json=body)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(Notification.query.count(), 5)
+        
+        response = self.client.post(url_for('ajax.delete_notifications'), json={})
+        self.assertEqual(response.get_json()['count'], 2)
+        self.assertEqual(Notification.query.count(), 3)
+        
+        self.client.post(url_for('main.read_notifications'), data={'ids': notification_ids[2:4]})
+        self.assertEqual(normal_user.unread_notification_count, 1)
+        response = self.client.post(url_for('main.delete_notifications'), data={'days': -1}, follow_redirects=True)
+        self.assertIn('Invalid days.', response.get_data(as_text=True))
+        response = self.client.post(url_for('main.delete_notifications'), data={'days': 1000000})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Notification.query.count(), 3)
+        self.client.post(url_for('main.delete_notifications'), data={'days': 1})
+        self.assertEqual(Notification.query.count(), 1)
+        
+        self.client.post(url_for('main.read_all_notification'))
+        self.assertEqual(normal_user.unread_notification_count, 0)
+    
+    def test_notification_coalescing(self):
+        admin_user = User.query.filter_by(username='admin').first()
+        normal_user = User.query.filter_by(username='normal').first()
+        unconfirmed_user = User.query.filter_by(username='unconfirmed').first()
+        photo = Photo.query.filter_by(description='Photo 1').first()
+        for collector in admin_user, admin_user, unconfirmed_user, admin_user:
+            push_collect_notification(collector=collector, photo_id=photo.id, receiver=normal_user)
+        notification = Notification.query.one()
+        self.assertEqual(notification.actor_count, 2)
+        self.assertIn('admin', notification.message)
+        self.assertIn('and 1 other collected your', notification.message)
+        self.assertEqual(NotificationActor.query.count(), 2)
+        self.assertEqual(normal_user.unread_notification_count, 1)
+        
+        push_collect_notification(collector=admin_user, photo_id=photo.id + 1, receiver=normal_user)
+        self.assertEqual(Notification.query.count(), 2)
+        Notification.mark_read(normal_user.id)
+        push_collect_notification(collector=admin_user, photo_id=photo.id, receiver=normal_user)
+        self.assertEqual(Notification.query.count(), 3)
+        self.assertEqual(normal_user.unread_notification_count, 1)
+        
+        current_app.config['ALBUMY_NOTIFICATION_COALESCE_WINDOW'] = 0
+        push_collect_notification(collector=admin_user, photo_id=photo.id, receiver=normal_user)
+        self.assertEqual(Notification.query.count(), 4)
+        
+        Notification.delete_all(normal_user.id, read_only=False)
+        self.assertEqual(Notification.query.count(), 0)
+        self.assertEqual(NotificationActor.query.count(), 0)
+    
+    def test_local_broker(self):
+        broker = LocalBroker(maxsize=2)
+        subscription = broker.subscribe('user:1')
+        self.assertTrue(broker.has_subscribers('user:1'))
+        broker.publish('user:2', {'count': 0})
+        for count in range(3):
+            broker.publish('user:1', {'count': count})
+        # 队列满时丢弃最早的消息
+        self.assertEqual(subscription.get_nowait(), {'count': 1})
+        self.assertEqual(subscription.get_nowait(), {'count': 2})
+        broker.unsubscribe('user:1', subscription)
+        self.assertFalse(broker.has_subscribers('user:1'))
+    
+    def test_notifications_stream(self):
+        response = self.client.get(url_for('ajax.notifications_stream'))
+        self.assertEqual(response.status_code, 403)
+        
+        self.login()
+        normal_user = User.query.filter_by(username='normal').first()
+        admin_user = User.query.filter_by(username='admin').first()
+        response = self.client.get(url_for('ajax.notifications_stream'), buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = (chunk.decode() for chunk in response.response)
+        self.assertEqual(next(events), 'retry: 5000\n\n')
+        self.assertEqual(next(events), 'event: count\ndata: {"event": "count", "count": 0}\n\n')
+        
+        push_follow_notification(follower=admin_user, receiver=normal_user)
+        event, data = next(events).split('\n')[:2]
+        self.assertEqual(event, 'event: notification')
+        data = json.loads(data[len('data: '):])
+        self.assertEqual(data['count'], 1)
+        self.assertIn('followed you', data['message'])
+        
+        Notification.mark_read(normal_user.id)
+        self.assertEqual(next(events), 'event: count\ndata: {"event": "count", "count": 0}\n\n')
+        response.close()
+        
+        # 到期后服务器结束事件流，由浏览器重连
+        current_app.config['ALBUMY_EVENT_STREAM_TIMEOUT'] = 0.2
+        response = self.client.get(url_for('ajax.notifications_stream'), buffered=False)
+        events = [chunk.decode() for chunk in response.response]
+        self.assertEqual(events[:2], ['retry: 5000\n\n', 'event: count\ndata: {"event": "count", "count": 0}\n\n'])
+        self.assertFalse(get_broker().has_subscribers(user_channel(normal_user.id)))
+    
+    def test_mail_outbox(self):
+        normal_user = User.query.filter_by(username='normal').first()
+        with mail.record_messages() as outbox:
+            send_confirm_email(user=normal_user, token='token')
+            self.assertEqual(len(outbox), 1)
+            self.assertEqual(outbox[0].recipients, ['normal@helloflask.com'])
+            self.assertEqual(outbox[0].subject, '[Albumy]Confirm Your Account')
+        self.assertEqual(OutboxMail.query.count(), 0)
+        
+        class BrokenConnection:
+            def send(self, message):
+                raise ConnectionRefusedError()
+        
+        current_app.config['ALBUMY_MAIL_MAX_ATTEMPTS'] = 2
+        db.session.add(OutboxMail(recipient='normal@helloflask.com', subject='Hello', body='Hello'))
+        db.session.commit()
+        self.assertEqual(deliver(OutboxMail.claim(10), BrokenConnection()), 0)
+        outbox_mail = OutboxMail.query.one()
+        self.assertEqual((outbox_mail.status, outbox_mail.attempts), ('pending', 1))
+        self.assertIn('ConnectionRefusedError', outbox_mail.last_error)
+        # 等待重试期间不会被领取
+        self.assertEqual(OutboxMail.claim(10), [])
+        self.assertEqual(send_outbox(), 0)
+        
+        outbox_mail.run_after = datetime.utcnow()
+        db.session.commit()
+        deliver(OutboxMail.claim(10), BrokenConnection())
+        self.assertEqual(OutboxMail.query.one().status, 'failed')
+        self.assertEqual(OutboxMail.claim(10), [])
+    
+    def test_mail_queue(self):
+        current_app.config['ALBUMY_MAIL_IN_BACKGROUND'] = True
+        current_app.config['ALBUMY_MAIL_WORKERS'] = 1
+        normal_user = User.query.filter_by(username='normal').first()
+        mail_queue = MailQueue()
+        self.addCleanup(mail_queue.stop)
+        with mail.record_messages() as outbox:
+            for i in range(3):
+                outbox_mail = OutboxMail(recipient=normal_user.email, subject='Hello %d' % i, body='Hello')
+                db.session.add(outbox_mail)
+                db.session.commit()
+                mail_queue.put(current_app._get_current_object(), outbox_mail.id)
+            deadline = time.time() + 5
+            while len(outbox) < 3 and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(sorted(message.subject for message in outbox), ['Hello 0', 'Hello 1', 'Hello 2'])
+        deadline = time.time() + 5
+        while OutboxMail.query.count() and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(OutboxMail.query.count(), 0)
+        threads = list(mail_queue._threads)
+        mail_queue.stop(timeout=5)
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+    
+    def test_background_thread_stop(self):
+        current_app.config['ALBUMY_SEARCH_INDEX_DELAY'] = 60
+        indexer = SearchIndexer()
+        indexer.wake(current_app._get_current_object())
+        thread = indexer._thread
+        # 等待合并变更期间也能立即停止
+        indexer.stop(timeout=5)
+        self.assertFalse(thread.is_alive())
+        indexer.stop()
+    
+    def test_fts5_search(self):
+        current_app.config['ALBUMY_SEARCH_BACKEND'] = 'fts5'
+        backend = FTS5Backend()
+        # 前缀匹配，用户名的权重高于昵称
+        users = backend.search('user', 'use', per_page=10).items
+        self.assertEqual({user.username for user in users}, {'normal', 'locked', 'blocked'})
+        db.session.add(User(email='user@helloflask.com', name='Someone', username='user'))
+        db.session.commit()
+        self.assertEqual(backend.search('user', 'user', per_page=10).items[0].username, 'user')
+        self.assertEqual(backend.search('user', 'OR "*', per_page=10).items, [])
+        
+        # 触发器在同一事务中维护索引
+        photo = Photo.query.filter_by(description='Photo 1').first()
+        photo.description = 'Sunset over the lake'
+        db.session.commit()
+        self.assertEqual(backend.search('photo', 'sun lake', per_page=10).items, [photo])
+        self.assertEqual([p.description for p in backend.search('photo', 'photo', per_page=10).items], ['Photo 2'])
+        db.session.delete(photo)
+        db.session.commit()
+        self.assertEqual(backend.search('photo', 'sunset', per_page=10).items, [])
+        
+        for i in range(5):
+            db.session.add(Tag(name='travel %d' % i))
+        db.session.commit()
+        pagination = backend.search('tag', 'travel', per_page=3)
+        self.assertTrue(pagination.has_next)
+        next_page = backend.search('tag', 'travel', per_page=3, cursor=pagination.next_cursor)
+        self.assertEqual(len(next_page.items), 2)
+        self.assertFalse({tag.id for tag in pagination.items} & {tag.id for tag in next_page.items})
+        
+        response = self.client.get(url_for('main.search', q='travel', category='tag'))
+        self.assertIn('travel 0', response.get_data(as_text=True))
+        response = self.client.get(url_for('main.search', q='travel', category='album'))
+        self.assertEqual(response.status_code, 404)
+    
+    def test_search_index(self):
+        photo = Photo.query.filter_by(description='Photo 1').first()
+        photo.flag = 1
+        db.session.flush()
+        self.assertEqual(SearchChange.query.count(), 0)
+        photo.description = 'Sunset over the lake'
+        db.session.flush()
+        self.assertEqual(SearchChange.query.count(), 1)
+        db.session.commit()
+        # 提交后应用到索引并删除记录
+        self.assertEqual(SearchChange.query.count(), 0)
+        response = self.client.get(url_for('main.search', q='lake'))
+        self.assertIn('href="%s"' % url_for('main.show_photo', photo_id=photo.id), response.get_data(as_text=True))
+        
+        db.session.delete(photo)
+        db.session.commit()
+        response = self.client.get(url_for('main.search', q='lake'))
+        self.assertIn('No results.', response.get_data(as_text=True))
+        
+        for i in range(5):
+            db.session.add(Tag(name='travel %d' % i))
+        db.session.commit()
+        result = self.runner.invoke(args=['reindex', '--workers', '2', '--batch', '2'])
+        self.assertIn('Indexed 12 rows', result.output)
+        response = self.client.get(url_for('main.search', q='travel', category='tag'))
+        self.assertIn('travel 4', response.get_data(as_text=True))
+        response = self.client.get(url_for('main.search', q='normal', category='user'))
+        self.assertIn('Normal User', response.get_data(as_text=True))
+    
+    def test_prefix_index(self):
+        index = PrefixIndex([('apple', 1, 5), ('Apricot', 2, 9), ('banana', 3, 1), ('app', 4, 5)],
+                            cache_threshold=1, cache_size=3)
+        self.assertEqual(index.search('AP'), [('Apricot', 2), ('app', 4), ('apple', 1)])
+        self.assertEqual(index.search('ap', limit=1), [('Apricot', 2)])
+        self.assertEqual(index.search('c'), [])
+        self.assertEqual(index.search(''), [])
+        # 修改后清除受影响前缀的缓存
+        index.rename('Apricot', 'cherry', 2)
+        self.assertEqual(index.search('ap'), [('app', 4), ('apple', 1)])
+        self.assertEqual(index.search('ch'), [('cherry', 2)])
+        index.add('apex', 5, 10)
+        index.remove('app')
+        self.assertEqual(index.search('ap'), [('apex', 5), ('apple', 1)])
+        self.assertEqual(len(index), 4)
+        # 新增和改名直接合并到缓存中，删除缓存之外的条目不清除缓存
+        index = PrefixIndex([('a%d' % i, i, i) for i in range(10)], cache_threshold=1, cache_size=3)
+        self.assertEqual(index.search('a', limit=3), [('a9', 9), ('a8', 8), ('a7', 7)])
+        index.add('ab', 10, 8)
+        index.add('ac', 11, 1)
+        index.rename('a0', 'az', 0)
+        index.remove('a1')
+        self.assertIn('a', index._top)
+        self.assertEqual(index.search('a', limit=3), [('a9', 9), ('a8', 8), ('ab', 10)])
+        index.add('ab', 10, 20)
+        self.assertEqual(index.search('a', limit=3), [('ab', 10), ('a9', 9), ('a8', 8)])
+        index.remove('a9')
+        self.assertNotIn('a', index._top)
+        self.assertEqual(index.search('a', limit=3), [('ab', 10), ('a8', 8), ('a7', 7)])
+        index.add('a8', 8, 0)
+        self.assertEqual(index.search('a', limit=3), [('ab', 10), ('a7', 7), ('a6', 6)])
+    
+    def test_autocomplete(self):
+        response = self.client.get(url_for('ajax.autocomplete', kind='user', q='NO'))
+        self.assertEqual(response.get_json()['results'], [{'id': 2, 'name': 'normal'}])
+        admin_user = User.query.filter_by(username='admin').first()
+        normal_user = User.query.filter_by(username='normal').first()
+        db.session.add(User(email='nobody@helloflask.com', name='Nobody', username='nobody'))
+        normal_user.username = 'notable'
+        db.session.commit()
+        response = self.client.get(url_for('ajax.autocomplete', kind='user', q='no'))
+        # 粉丝多的用户排在前面
+        self.assertEqual([item['name'] for item in response.get_json()['results']], ['notable', 'nobody'])
+        
+        photo = Photo.query.filter_by(description='Photo 2').first()
+        photo.tags.append(Tag(name='testing'))
+        db.session.commit()
+        response = self.client.get(url_for('ajax.autocomplete', kind='tag', q='test'))
+        self.assertEqual([item['name'] for item in response.get_json()['results']], ['test tag', 'testing'])
+        db.session.delete(Tag.query.filter_by(name='testing').first())
+        db.session.commit()
+        response = self.client.get(url_for('ajax.autocomplete', kind='tag', q='test', limit=100))
+        self.assertEqual(len(response.get_json()['results']), 1)
+        self.assertEqual(self.client.get('/ajax/autocomplete/photo?q=p').status_code, 404)
+        
+        self.login(email='admin@helloflask.com', password='12345678')
+        response = self.client.get(url_for('main.show_photo', photo_id=admin_user.photos[0].id))
+        self.assertIn('list="tag-suggestions"', response.get_data(as_text=True))
+    
+    def test_autocomplete_loading(self):
+        autocomplete = Autocomplete(current_app._get_current_object())
+        calls = []
+        
+        def load_tags():
+            calls.append('tag')
+            time.sleep(0.2)
+            # 加载期间提交的修改
+            autocomplete.apply([('tag', 99, None, 'tester')])
+            return [('test tag', 1, 1)]
+        
+        with mock.patch.dict('albumy.autocomplete._loaders', {'tag': load_tags}):
+            threads = [threading.Thread(target=autocomplete.index, args=('tag',)) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # 并发的第一次查询只加载一次
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(autocomplete.index('tag').search('test'), [('test tag', 1), ('tester', 99)])
+            
+            autocomplete._load('tag')
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(autocomplete.index('tag').search('test'), [('test tag', 1), ('tester', 99)])
+    
+    def test_report(self):
+        photo = Photo.query.filter_by(description='Photo 1').first()
+        comment = Comment.query.first()
+        self.login()
+        response = self.client.post(url_for('main.report_photo', photo_id=photo.id), follow_redirects=True)
+        self.assertIn('Photo reported.', response.get_data(as_text=True))
+        # 同一个用户重复举报不再计数
+        response = self.client.post(url_for('main.report_photo', photo_id=photo.id), follow_redirects=True)
+        self.assertIn('You have already reported this photo.', response.get_data(as_text=True))
+        self.client.post(url_for('main.report_comment', comment_id=comment.id))
+        self.client.post(url_for('main.report_comment', comment_id=comment.id))
+        self.assertEqual(self.client.post(url_for('main.report_photo', photo_id=9999)).status_code, 404)
+        self.logout()
+        
+        self.login(email='admin@helloflask.com', password='12345678')
+        self.client.post(url_for('main.report_photo', photo_id=photo.id))
+        self.assertEqual((db.session.get(Photo, photo.id).flag, db.session.get(Comment, comment.id).flag), (2, 1))
+        self.assertEqual(Report.query.count(), 3)
+        
+        data = self.client.get(url_for('admin.manage_photo', order='queue')).get_data(as_text=True)
+        self.assertIn('Photo 1', data)
+        response = self.client.get(url_for('admin.manage_photo', order='queue', cursor='zz'))
+        self.assertIn('Photo 1', response.get_data(as_text=True))
+        self.assertNotIn('Photo 2', data)
+        data = self.client.get(url_for('admin.manage_comment', order='queue')).get_data(as_text=True)
+        self.assertIn('test comment body', data)
+        
+        # 清除举报后可以再次举报
+        self.client.post(url_for('admin.bulk_photo', action='unflag'), data={'ids': [photo.id]})
+        self.assertEqual(Report.query.filter_by(target_type='photo').count(), 0)
+        self.client.post(url_for('main.report_photo', photo_id=photo.id))
+        self.assertEqual(db.session.get(Photo, photo.id).flag, 1)
+        db.session.delete(db.session.get(Comment, comment.id))
+        db.session.commit()
+        self.assertEqual(Report.query.filter_by(target_type='comment').count(), 0)
+        
+        # 删除账户时撤销该用户的举报
+        self.logout()
+        self.login()
+        self.client.post(url_for('main.report_photo', photo_id=photo.id))
+        self.assertEqual(db.session.get(Photo, photo.id).flag, 2)
+        db.session.commit()
+        db.session.execute(db.text('PRAGMA foreign_keys=ON'))
+        self.assertEqual(db.session.execute(db.text('PRAGMA foreign_keys')).scalar(), 1)
+        db.session.delete(User.query.filter_by(username='normal').first())
+        db.session.commit()
+        self.assertEqual(db.session.get(Photo, photo.id).flag, 1)
+        self.assertEqual(Report.query.count(), 1)